@@ -0,0 +1,149 @@
+'''
+Compare the JSON codecs in ``trio_cdp.codec`` on CDP traffic.
+
+By default this benchmark uses a built-in sample of typical CDP messages. To
+benchmark your own traffic, pass a file that contains one CDP message per line:
+
+$ python benchmarks/bench_codec.py traffic.jsonl
+
+or a recording made by ``trio_cdp.recorder.WireRecorder``, either its directory or
+one of its ``.jsonl.gz`` files. Only the frames of a recording are benchmarked, so
+it must have been made with ``include_frames`` enabled:
+
+$ python benchmarks/bench_codec.py recordings/
+
+Each codec decodes every message and re-encodes the decoded object. The fastest
+codec for a deployment depends on its mix of messages, so it is worth running this
+on traffic recorded from that deployment.
+'''
+import argparse
+import json
+import os
+import sys
+import time
+
+from trio_cdp.codec import available_codecs, get_codec
+from trio_cdp.recorder import read_recording
+
+
+def sample_messages():
+    ''' Generate a sample of messages similar to a page load with the Network,
+    Page, and Runtime domains enabled. '''
+    messages = list()
+    for i in range(200):
+        request_id = '1000.{}'.format(i)
+        messages.append({
+            'method': 'Network.requestWillBeSent',
+            'sessionId': 'E3C1A7F0D1B2C3D4E5F6A7B8C9D0E1F2',
+            'params': {
+                'requestId': request_id,
+                'loaderId': 'B2C3D4E5F6A7B8C9D0E1F2A3B4C5D6E7',
+                'documentURL': 'https://www.example.com/',
+                'request': {
+                    'url': 'https://cdn.example.com/assets/app.{}.js'.format(i),
+                    'method': 'GET',
+                    'headers': {
+                        'Referer': 'https://www.example.com/',
+                        'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) '
+                            'AppleWebKit/537.36 (KHTML, like Gecko) '
+                            'Chrome/80.0.3987.0 Safari/537.36',
+                    },
+                    'mixedContentType': 'none',
+                    'initialPriority': 'High',
+                    'referrerPolicy': 'no-referrer-when-downgrade',
+                },
+                'timestamp': 1000.0 + i,
+                'wallTime': 1580000000.0 + i,
+                'initiator': {'type': 'parser',
+                    'url': 'https://www.example.com/', 'lineNumber': i},
+                'type': 'Script',
+                'frameId': 'C3D4E5F6A7B8C9D0E1F2A3B4C5D6E7F8',
+                'hasUserGesture': False,
+            },
+        })
+        for chunk in range(3):
+            messages.append({
+                'method': 'Network.dataReceived',
+                'sessionId': 'E3C1A7F0D1B2C3D4E5F6A7B8C9D0E1F2',
+                'params': {
+                    'requestId': request_id,
+                    'timestamp': 1000.0 + i + chunk / 10,
+                    'dataLength': 65536,
+                    'encodedDataLength': 16384,
+                },
+            })
+        messages.append({
+            'id': i,
+            'sessionId': 'E3C1A7F0D1B2C3D4E5F6A7B8C9D0E1F2',
+            'result': {
+                'result': {
+                    'type': 'string',
+                    'value': 'Example Domain — résultat {}'.format(i),
+                },
+            },
+        })
+    return [json.dumps(message) for message in messages]
+
+
+def load_messages(path):
+    ''' Load one message per line from ``path``, skipping blank lines. '''
+    with open(path) as file:
+        return [line for line in (line.strip() for line in file) if line]
+
+
+def load_recording(path):
+    ''' Load the frames of a recording. '''
+    messages = [record['frame'] for record in read_recording(path)
+        if 'frame' in record]
+    if not messages:
+        sys.exit('{} has no recorded frames. Record with include_frames=True.'
+            .format(path))
+    return messages
+
+
+def bench(codec, messages, rounds):
+    ''' Return (decode seconds, encode seconds) for ``rounds`` passes. '''
+    decoded = [codec.loads(message) for message in messages]
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for message in messages:
+            codec.loads(message)
+    decode_time = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for obj in decoded:
+            codec.dumps(obj)
+    encode_time = time.perf_counter() - start
+    return decode_time, encode_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('traffic', nargs='?',
+        help='A file with one CDP message per line, or a recording directory '
+        'or .gz file')
+    parser.add_argument('--rounds', type=int, default=20,
+        help='Number of passes over the traffic (default: 20)')
+    args = parser.parse_args()
+
+    if args.traffic is None:
+        messages = sample_messages()
+    elif os.path.isdir(args.traffic) or args.traffic.endswith('.gz'):
+        messages = load_recording(args.traffic)
+    else:
+        messages = load_messages(args.traffic)
+    total_bytes = sum(len(message) for message in messages)
+    print('{} messages, {:,} bytes, {} rounds'.format(len(messages), total_bytes,
+        args.rounds))
+    print('{:<8} {:>14} {:>14} {:>12}'.format('codec', 'decode msg/s',
+        'encode msg/s', 'decode MB/s'))
+    count = len(messages) * args.rounds
+    for name in available_codecs():
+        decode_time, encode_time = bench(get_codec(name), messages, args.rounds)
+        print('{:<8} {:>14,.0f} {:>14,.0f} {:>12.1f}'.format(name,
+            count / decode_time, count / encode_time,
+            total_bytes * args.rounds / decode_time / 1e6))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,98 @@
+import itertools
+import json
+import logging
+
+import trio
+from trio_websocket import ConnectionClosed, serve_websocket
+
+
+HOST = '127.0.0.1'
+
+
+class FakeBrowser:
+    '''
+    A minimal stand-in for a browser. It answers each command with a result from
+    ``self.results``, which maps a CDP method name to either a result dictionary
+    or a function that takes the command and returns a result dictionary.
+    Unknown methods return an empty result.
+
+    Every command is recorded in ``self.commands``. Commands whose method is in
+    ``self.ignore`` are recorded but never answered, and commands whose method is
+    in ``self.errors`` are answered with that error.
+    '''
+    def __init__(self):
+        self.commands = list()
+        self.ignore = set()
+        self.errors = dict()
+        self.connections = list()
+        self.closed_targets = list()
+        self.counter = itertools.count(1)
+        self.results = {
+            'Target.createTarget': lambda command: {
+                'targetId': 'target{}'.format(next(self.counter))},
+            'Target.attachToTarget': lambda command: {
+                'sessionId': 'session-{}'.format(command['params']['targetId'])},
+            'Target.closeTarget': self._close_target,
+            'Target.createBrowserContext': lambda command: {
+                'browserContextId': 'context{}'.format(next(self.counter))},
+            'Browser.getVersion': {'protocolVersion': '1.3', 'product': 'Fake',
+                'revision': '1', 'userAgent': 'Fake', 'jsVersion': '1'},
+            'Page.navigate': {'frameId': 'frame1'},
+            'Page.addScriptToEvaluateOnNewDocument': {'identifier': '1'},
+            'Runtime.getHeapUsage': {'usedSize': 1000, 'totalSize': 2000},
+        }
+
+    def methods(self, session_id=None):
+        ''' Return the methods received, optionally only for one session. '''
+        return [command['method'] for command in self.commands
+            if session_id is None or command.get('sessionId') == session_id]
+
+    async def start(self, nursery):
+        ''' Start serving and return the browser URL. '''
+        server = await nursery.start(serve_websocket, self._handler, HOST, 0,
+            None)
+        return f'ws://{HOST}:{server.port}/devtools/browser/uuid'
+
+    async def send(self, message):
+        ''' Send a message to every connected client. '''
+        for ws in self.connections:
+            await ws.send_message(json.dumps(message))
+
+    async def respond(self, command, result):
+        ''' Answer a command that was ignored. '''
+        response = {'id': command['id'], 'result': result}
+        if 'sessionId' in command:
+            response['sessionId'] = command['sessionId']
+        await self.send(response)
+
+    def _close_target(self, command):
+        self.closed_targets.append(command['params']['targetId'])
+        return {'success': True}
+
+    async def _handler(self, request):
+        # It's tricky to catch exceptions from the server, so exceptions are
+        # logged instead.
+        try:
+            ws = await request.accept()
+            self.connections.append(ws)
+            while True:
+                command = json.loads(await ws.get_message())
+                logging.info('Server received:  %r', command)
+                self.commands.append(command)
+                if command['method'] in self.ignore:
+                    continue
+                if command['method'] in self.errors:
+                    response = {'id': command['id'],
+                        'error': self.errors[command['method']]}
+                else:
+                    result = self.results.get(command['method'], {})
+                    if callable(result):
+                        result = result(command)
+                    response = {'id': command['id'], 'result': result}
+                if 'sessionId' in command:
+                    response['sessionId'] = command['sessionId']
+                await ws.send_message(json.dumps(response))
+        except ConnectionClosed:
+            pass
+        except Exception:
+            logging.exception('Server exception')
@@ -0,0 +1,170 @@
+import pytest
+import trio
+from trio.testing import wait_all_tasks_blocked
+
+from . import fail_after
+from trio_cdp import channels
+from trio_cdp.channels import BroadcastRing, open_event_channel
+
+
+async def drain(channel):
+    ''' Receive every event that is currently buffered. '''
+    events = list()
+    while channel.statistics().queued:
+        events.append(await channel.receive())
+    return events
+
+
+async def test_drop_newest():
+    channel = open_event_channel(2)
+    for event in range(4):
+        assert channel.offer(event)
+    assert await drain(channel) == [0, 1]
+    stats = channel.statistics()
+    assert stats.policy == 'drop-newest'
+    assert stats.accepted == 2
+    assert stats.dropped == 2
+    assert stats.high_water == 2
+
+
+async def test_drop_oldest():
+    channel = open_event_channel(2, 'drop-oldest')
+    for event in range(4):
+        channel.offer(event)
+    assert await drain(channel) == [2, 3]
+    assert channel.statistics().dropped == 2
+
+
+async def test_coalesce():
+    channel = open_event_channel(2, 'coalesce', key=lambda e: e[0])
+    for event in [('a', 1), ('b', 1), ('a', 2), ('c', 1)]:
+        channel.offer(event)
+    # ('a', 2) replaced ('a', 1) in place, then ('c', 1) evicted it as the
+    # oldest entry.
+    assert await drain(channel) == [('b', 1), ('c', 1)]
+    stats = channel.statistics()
+    assert stats.coalesced == 1
+    assert stats.dropped == 1
+
+
+def test_coalesce_requires_key():
+    with pytest.raises(ValueError):
+        open_event_channel(2, 'coalesce')
+    with pytest.raises(ValueError):
+        open_event_channel(2, 'bogus')
+
+
+async def test_spill():
+    channel = open_event_channel(2, 'spill')
+    for event in range(5):
+        channel.offer({'n': event})
+    stats = channel.statistics()
+    assert stats.queued == 5
+    assert stats.spilled == 3
+    assert await drain(channel) == [{'n': n} for n in range(5)]
+    # Once the file is drained, new events are buffered in memory again.
+    channel.offer({'n': 5})
+    assert channel.statistics().spilled == 3
+    assert await drain(channel) == [{'n': 5}]
+    await channel.aclose()
+
+
+@fail_after(1)
+async def test_spill_end():
+    channel = open_event_channel(1, 'spill')
+    for event in range(3):
+        channel.offer(event)
+    channel.end()
+    assert [event async for event in channel] == [0, 1, 2]
+
+
+@fail_after(1)
+async def test_spill_write_failure(nursery, monkeypatch):
+    def fail(file, lock, offset, batch):
+        raise OSError('No space left on device')
+    monkeypatch.setattr(channels, '_write_batch', fail)
+    channel = open_event_channel(1, 'spill')
+    channel.write_buffer = 2
+    assert channel.offer(0)
+    # This batch fails to write, so it is kept in memory.
+    assert channel.offer(1)
+    await wait_all_tasks_blocked()
+    # Without a disk, the channel holds at most write_buffer more events and
+    # then makes the reader wait.
+    assert channel.offer(2)
+    assert channel.offer(3)
+    assert not channel.offer(4)
+    nursery.start_soon(channel.put, 4)
+    await wait_all_tasks_blocked()
+    assert channel.statistics().queued == 4
+    assert [await channel.receive() for _ in range(5)] == [0, 1, 2, 3, 4]
+    stats = channel.statistics()
+    assert stats.dropped == 0
+    assert stats.blocked == 1
+    await channel.aclose()
+
+
+@fail_after(1)
+async def test_block(nursery):
+    channel = open_event_channel(1, 'block')
+    received = list()
+    assert channel.offer(0)
+    assert not channel.offer(1)
+
+    async def consume():
+        async for event in channel:
+            received.append(event)
+            if event == 2:
+                break
+    nursery.start_soon(consume)
+    await channel.put(1)
+    await channel.put(2)
+    await wait_all_tasks_blocked()
+    assert received == [0, 1, 2]
+    stats = channel.statistics()
+    assert stats.dropped == 0
+    assert stats.blocked == 2
+
+
+@fail_after(1)
+async def test_zero_buffer_hands_event_to_waiting_receiver(nursery):
+    channel = open_event_channel(0)
+    received = list()
+
+    async def consume():
+        received.append(await channel.receive())
+    nursery.start_soon(consume)
+    await wait_all_tasks_blocked()
+    channel.offer('event')
+    await wait_all_tasks_blocked()
+    assert received == ['event']
+
+
+async def test_closed_channel():
+    channel = open_event_channel(2)
+    channel.offer(0)
+    await channel.aclose()
+    assert channel.closed
+    with pytest.raises(trio.ClosedResourceError):
+        await channel.receive()
+
+
+@fail_after(1)
+async def test_broadcast():
+    ring = BroadcastRing(3)
+    fast = ring.open_receiver()
+    ring.offer(0)
+    slow = ring.open_receiver()
+    for event in range(1, 6):
+        ring.offer(event)
+    # The fast receiver joined first but only keeps up with the ring's size.
+    assert [await fast.receive() for _ in range(3)] == [3, 4, 5]
+    assert fast.statistics().dropped == 3
+    # The slow receiver joined after event 0.
+    assert slow.statistics().accepted == 5
+    assert [await slow.receive() for _ in range(3)] == [3, 4, 5]
+    assert slow.statistics().dropped == 2
+    await fast.aclose()
+    assert not ring.closed
+    await slow.aclose()
+    assert ring.closed
@@ -0,0 +1,54 @@
+import json
+
+import pytest
+
+from trio_cdp.codec import Codec, StdlibCodec, get_codec
+
+
+MESSAGE = {'id': 1, 'result': {'value': 'café'}}
+
+
+def test_default_codec():
+    codec = get_codec()
+    assert isinstance(codec, StdlibCodec)
+    assert codec.loads(codec.dumps(MESSAGE)) == MESSAGE
+
+
+def test_codec_instance_is_returned_unchanged():
+    codec = StdlibCodec()
+    assert get_codec(codec) is codec
+
+
+def test_unknown_codec():
+    with pytest.raises(ValueError):
+        get_codec('bogus')
+
+
+def test_auto_codec():
+    codec = get_codec('auto')
+    assert isinstance(codec, Codec)
+    assert codec.loads(codec.dumps(MESSAGE)) == MESSAGE
+
+
+@pytest.mark.parametrize('name', ['json', 'orjson', 'ujson'])
+def test_codec_round_trip(name):
+    pytest.importorskip(name)
+    codec = get_codec(name)
+    encoded = codec.dumps(MESSAGE)
+    assert isinstance(encoded, str)
+    assert json.loads(encoded) == MESSAGE
+    assert codec.loads(encoded) == MESSAGE
+    assert codec.loads(encoded.encode('utf8')) == MESSAGE
+    with pytest.raises(codec.decode_errors):
+        codec.loads('bogus')
+
+
+def test_codec_is_abstract():
+    class EncodeOnly(Codec):
+        def dumps(self, obj):
+            return json.dumps(obj)
+
+    with pytest.raises(TypeError):
+        Codec()
+    with pytest.raises(TypeError):
+        EncodeOnly()
@@ -0,0 +1,185 @@
+from functools import partial
+import json
+
+import pytest
+import trio
+from trio.testing import wait_all_tasks_blocked
+
+from . import fail_after
+from trio_cdp.discovery import DiscoveryClient, DiscoveryError, \
+    _default_client, get_websocket_url
+
+
+HOST = '127.0.0.1'
+
+
+async def serve_devtools(requests, stream, keep_alive=False, version=None,
+        delay=0):
+    '''
+    Answer one HTTP request like a browser's DevTools endpoint.
+
+    :param keep_alive: if true, keep the connection open after the response
+    :param version: if set, the ``/json/version`` document
+    :param delay: how long to wait before answering
+    '''
+    async with stream:
+        request = b''
+        while b'\r\n\r\n' not in request:
+            request += await stream.receive_some(1024)
+        path = request.split(b' ')[1].decode('ascii')
+        requests.append(path)
+        await trio.sleep(delay)
+        if path == '/json/version':
+            port = stream.socket.getsockname()[1]
+            body = json.dumps(version if version is not None else {
+                'Browser': 'Fake/1.0', 'Protocol-Version': '1.3',
+                'webSocketDebuggerUrl':
+                f'ws://{HOST}:{port}/devtools/browser/uuid'})
+            status = '200 OK'
+        elif path == '/json/list':
+            body = json.dumps([{'id': 'page1', 'type': 'page', 'title': 'Blank',
+                'url': 'about:blank', 'webSocketDebuggerUrl': 'ws://page1'}])
+            status = '200 OK'
+        else:
+            body = 'Not found'
+            status = '404 Not Found'
+        await stream.send_all('HTTP/1.1 {}\r\nContent-Type: application/json\r\n'
+            'Content-Length: {}\r\n\r\n{}'.format(status, len(body), body)
+            .encode('ascii'))
+        if keep_alive:
+            await trio.sleep_forever()
+
+
+async def start_server(nursery, requests, **options):
+    listeners = await nursery.start(trio.serve_tcp,
+        partial(serve_devtools, requests, **options), 0)
+    return listeners[0].socket.getsockname()[1]
+
+
+@fail_after(2)
+async def test_discovery_cache(nursery):
+    ''' Responses are cached until the TTL expires, and concurrent lookups
+    share one request. '''
+    requests = list()
+    port = await start_server(nursery, requests)
+    client = DiscoveryClient(ttl=0.2)
+
+    async with trio.open_nursery() as lookups:
+        for _ in range(3):
+            lookups.start_soon(client.websocket_url, HOST, port)
+    assert requests == ['/json/version']
+    assert client.hits == 2
+
+    version = await client.version(HOST, port)
+    assert version.browser == 'Fake/1.0'
+    assert version.websocket_url == f'ws://{HOST}:{port}/devtools/browser/uuid'
+    assert requests == ['/json/version']
+
+    targets = await client.targets(HOST, port)
+    assert [target.id for target in targets] == ['page1']
+
+    await trio.sleep(0.3)
+    await client.websocket_url(HOST, port)
+    assert requests.count('/json/version') == 2
+
+    client.invalidate(HOST, port)
+    await client.websocket_url(HOST, port)
+    assert requests.count('/json/version') == 3
+
+    with pytest.raises(DiscoveryError):
+        await client.protocol(HOST, port)
+
+
+@fail_after(2)
+async def test_discovery_fan_out(nursery):
+    ''' Many browsers are queried concurrently, and failures are returned in
+    place. '''
+    requests = list()
+    ports = [await start_server(nursery, requests) for _ in range(3)]
+    # Find a port with nothing listening on it.
+    sock = trio.socket.socket()
+    await sock.bind((HOST, 0))
+    closed_port = sock.getsockname()[1]
+    sock.close()
+
+    client = DiscoveryClient()
+    endpoints = [(HOST, port) for port in ports] + [(HOST, closed_port)]
+    results = await client.websocket_urls(endpoints, max_concurrency=2)
+    assert results[:3] == [f'ws://{HOST}:{port}/devtools/browser/uuid'
+        for port in ports]
+    assert isinstance(results[3], DiscoveryError)
+    assert client.requests == 4
+
+
+@fail_after(2)
+async def test_discovery_keep_alive(nursery):
+    ''' The response body is read up to its Content-Length, so a server that
+    keeps the connection open does not cause a timeout. '''
+    requests = list()
+    port = await start_server(nursery, requests, keep_alive=True)
+    client = DiscoveryClient(timeout=1)
+    assert await client.websocket_url(HOST, port) == \
+        f'ws://{HOST}:{port}/devtools/browser/uuid'
+    assert [target.id for target in await client.targets(HOST, port)] == \
+        ['page1']
+
+
+@fail_after(2)
+async def test_discovery_malformed_response(nursery):
+    ''' A document without a WebSocket URL raises DiscoveryError, and it does
+    not interrupt a fan-out. '''
+    requests = list()
+    good_port = await start_server(nursery, requests)
+    bad_ports = [await start_server(nursery, requests, version=version)
+        for version in ({'Browser': 'Fake/1.0'}, [])]
+    client = DiscoveryClient()
+    with pytest.raises(DiscoveryError):
+        await client.websocket_url(HOST, bad_ports[0])
+    results = await client.websocket_urls([(HOST, port) for port in
+        [good_port] + bad_ports])
+    assert results[0] == f'ws://{HOST}:{good_port}/devtools/browser/uuid'
+    assert all(isinstance(result, DiscoveryError) for result in results[1:])
+
+
+@fail_after(2)
+async def test_discovery_cancelled_request(nursery):
+    ''' If the task that sent a request is cancelled, tasks that were waiting
+    for the same response send a new request. '''
+    requests = list()
+    port = await start_server(nursery, requests, delay=0.1)
+    client = DiscoveryClient()
+    urls = list()
+
+    async def cancelled_requester():
+        with trio.move_on_after(0.05):
+            await client.websocket_url(HOST, port)
+
+    async def waiter():
+        urls.append(await client.websocket_url(HOST, port))
+
+    async with trio.open_nursery() as lookups:
+        lookups.start_soon(cancelled_requester)
+        await wait_all_tasks_blocked()
+        lookups.start_soon(waiter)
+    assert urls == [f'ws://{HOST}:{port}/devtools/browser/uuid']
+    assert client.requests == 2
+
+
+def test_default_client_per_run():
+    ''' get_websocket_url() does not share its cache between Trio runs. '''
+    clients = list()
+
+    async def lookup():
+        requests = list()
+        async with trio.open_nursery() as nursery:
+            port = await start_server(nursery, requests)
+            url = await get_websocket_url(HOST, port)
+            assert url == f'ws://{HOST}:{port}/devtools/browser/uuid'
+            assert await get_websocket_url(HOST, port) == url
+            assert requests == ['/json/version']
+            clients.append(_default_client.get())
+            nursery.cancel_scope.cancel()
+
+    trio.run(lookup)
+    trio.run(lookup)
+    assert clients[0] is not clients[1]
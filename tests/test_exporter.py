@@ -0,0 +1,67 @@
+import cdp
+import trio
+
+from . import fail_after
+from .fake_browser import FakeBrowser
+from trio_cdp import open_cdp, open_connections
+from trio_cdp.discovery import _http_get
+from trio_cdp.exporter import DEFAULT_BUCKETS, render_metrics, serve_metrics
+
+
+def parse_samples(text):
+    ''' Return a dictionary of sample names, including labels, to values. '''
+    samples = dict()
+    for line in text.splitlines():
+        if line and not line.startswith('#'):
+            name, value = line.rsplit(' ', 1)
+            samples[name] = float(value)
+    return samples
+
+
+@fail_after(2)
+async def test_scrape_metrics(nursery):
+    ''' Scrape the metrics of open connections over HTTP. '''
+    listeners = await nursery.start(serve_metrics, 0)
+    port = listeners[0].socket.getsockname()[1]
+    browser = FakeBrowser()
+    server = await browser.start(nursery)
+    async with open_cdp(server) as conn:
+        conn.label = 'browser "1"'
+        assert conn in open_connections()
+        session = await conn.connect_session(cdp.target.TargetID('target1'))
+        await session.execute(cdp.page.navigate('https://example.com'))
+        await session.execute(cdp.page.navigate('https://example.com'))
+        listener = session.listen(cdp.page.LoadEventFired)
+        await browser.send({'method': 'Page.loadEventFired',
+            'sessionId': session.session_id, 'params': {'timestamp': 1}})
+        await listener.receive()
+
+        body = (await _http_get('127.0.0.1', port, '/metrics')).decode('utf8')
+        assert '# TYPE trio_cdp_command_latency_seconds histogram' in body
+        samples = parse_samples(body)
+        browser_label = 'browser="browser \\"1\\""'
+        navigate = '{},method="Page.navigate"'.format(browser_label)
+        assert samples['trio_cdp_command_latency_seconds_count{{{}}}'.format(
+            navigate)] == 2
+        assert samples['trio_cdp_command_latency_seconds_bucket{{{},le="+Inf"}}'
+            .format(navigate)] == 2
+        buckets = [value for name, value in samples.items() if name.startswith(
+            'trio_cdp_command_latency_seconds_bucket{{{}'.format(navigate))]
+        assert buckets == sorted(buckets)
+        # Every bucket bound is exported, even if it has no counts.
+        assert len(buckets) == len(DEFAULT_BUCKETS) + 1
+        samples = parse_samples(render_metrics([conn], buckets=[1, 0.5]))
+        assert [name for name in samples if name.startswith(
+            'trio_cdp_command_latency_seconds_bucket{{{}'.format(navigate))] == [
+            'trio_cdp_command_latency_seconds_bucket{{{},le="{}"}}'.format(
+            navigate, bound) for bound in ('0.5', '1.0', '+Inf')]
+        assert samples['trio_cdp_events_total{{{},method="Page.loadEventFired"}}'
+            .format(browser_label)] == 1
+        assert samples['trio_cdp_sessions{{{}}}'.format(browser_label)] == 1
+        assert samples['trio_cdp_dropped_events_total{{{}}}'.format(
+            browser_label)] == 0
+        assert samples['trio_cdp_reconnects_total{{{}}}'.format(
+            browser_label)] == 0
+
+    assert conn not in open_connections()
+    assert 'browser \\"1\\"' not in render_metrics()
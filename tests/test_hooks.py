@@ -0,0 +1,91 @@
+import cdp
+import pytest
+import trio
+
+from . import fail_after
+from .fake_browser import FakeBrowser
+from trio_cdp import BrowserError, CdpSessionClosed, open_cdp
+
+
+@fail_after(1)
+async def test_hooks(nursery):
+    ''' Hooks see commands, responses, errors, and events from the connection
+    and its sessions. Only raw hooks get the payload. '''
+    browser = FakeBrowser()
+    server = await browser.start(nursery)
+    browser.errors['Page.reload'] = {'code': -32000, 'message': 'No page'}
+    calls = list()
+    raw_calls = list()
+
+    def broken_hook(info):
+        raise Exception('This is logged and ignored')
+
+    async with open_cdp(server) as conn:
+        for kind in ('pre_send', 'post_response', 'on_error', 'on_event'):
+            conn.hooks.add(kind, calls.append)
+        conn.hooks.add('post_response', raw_calls.append, raw=True)
+        conn.hooks.add('on_event', broken_hook)
+        session = await conn.connect_session(cdp.target.TargetID('target1'))
+        await session.execute(cdp.page.navigate('https://example.com'))
+        with pytest.raises(BrowserError):
+            await session.execute(cdp.page.reload())
+        listener = session.listen(cdp.page.LoadEventFired)
+        await browser.send({'method': 'Page.loadEventFired',
+            'sessionId': session.session_id, 'params': {'timestamp': 1}})
+        await listener.receive()
+
+        assert [(info.kind, info.method) for info in calls] == [
+            ('pre_send', 'Target.attachToTarget'),
+            ('post_response', 'Target.attachToTarget'),
+            ('pre_send', 'Page.navigate'),
+            ('post_response', 'Page.navigate'),
+            ('pre_send', 'Page.reload'),
+            ('on_error', 'Page.reload'),
+            ('on_event', 'Page.loadEventFired'),
+        ]
+        assert all(info.payload is None for info in calls)
+        navigate = calls[3]
+        assert navigate.session_id == session.session_id
+        assert navigate.latency > 0
+        assert navigate.size > 0
+        assert isinstance(calls[5].error, BrowserError)
+        assert raw_calls[1].payload['result'] == {'frameId': 'frame1'}
+
+        conn.hooks.remove('pre_send', calls.append)
+        count = len(calls)
+        await conn.execute(cdp.browser.get_version())
+        assert [info.kind for info in calls[count:]] == ['post_response']
+        with pytest.raises(ValueError):
+            conn.hooks.add('on_send', calls.append)
+
+
+@fail_after(1)
+async def test_error_hooks_on_close(nursery):
+    ''' Commands that fail because their session closed are reported to the
+    on_error hooks. '''
+    browser = FakeBrowser()
+    server = await browser.start(nursery)
+    browser.ignore.add('Runtime.getHeapUsage')
+    errors = list()
+
+    async with open_cdp(server) as conn:
+        conn.hooks.add('on_error', errors.append, raw=True)
+        session = await conn.connect_session(cdp.target.TargetID('target1'))
+
+        async def execute():
+            with pytest.raises(CdpSessionClosed):
+                await session.execute(cdp.runtime.get_heap_usage())
+
+        async with trio.open_nursery() as inner:
+            inner.start_soon(execute)
+            while 'Runtime.getHeapUsage' not in browser.methods():
+                await trio.sleep(0.01)
+            await browser.send({'method': 'Target.detachedFromTarget',
+                'params': {'sessionId': session.session_id}})
+
+        error, = errors
+        assert error.method == 'Runtime.getHeapUsage'
+        assert error.session_id == session.session_id
+        assert isinstance(error.error, CdpSessionClosed)
+        assert error.latency > 0
+        assert error.payload['method'] == 'Runtime.getHeapUsage'
@@ -0,0 +1,201 @@
+import cdp
+import trio
+from trio.testing import wait_all_tasks_blocked
+
+from . import fail_after
+from .fake_browser import FakeBrowser
+from trio_cdp import open_cdp
+
+
+async def wait_for_sent(browser, method, count):
+    while browser.methods().count(method) < count:
+        await trio.sleep(0.01)
+
+
+@fail_after(2)
+async def test_limits(nursery):
+    ''' Commands over a method, session, or connection limit wait until an
+    earlier command finishes. '''
+    browser = FakeBrowser()
+    server = await browser.start(nursery)
+    async with open_cdp(server) as conn:
+        session = await conn.connect_session(cdp.target.TargetID('target1'))
+        conn.set_limits(connection=3, session=2,
+            methods={'Page.captureScreenshot': 1})
+        browser.ignore.update({'Page.captureScreenshot',
+            'Runtime.getHeapUsage'})
+        results = list()
+
+        async def run(cdp_base, cmd):
+            results.append(await cdp_base.execute(cmd))
+
+        async with trio.open_nursery() as jobs:
+            for _ in range(2):
+                jobs.start_soon(run, session, cdp.page.capture_screenshot())
+            await wait_for_sent(browser, 'Page.captureScreenshot', 1)
+            for _ in range(2):
+                jobs.start_soon(run, session, cdp.runtime.get_heap_usage())
+            for _ in range(2):
+                jobs.start_soon(run, conn, cdp.runtime.get_heap_usage())
+            await wait_for_sent(browser, 'Runtime.getHeapUsage', 2)
+            await wait_all_tasks_blocked()
+
+            # One screenshot and one heap query fill the session. The root
+            # session's first query fills the connection.
+            assert browser.methods().count('Page.captureScreenshot') == 1
+            assert browser.methods().count('Runtime.getHeapUsage') == 2
+            method_stats, session_stats, connection_stats = \
+                session.limit_stats()
+            assert method_stats.name == 'Page.captureScreenshot'
+            assert method_stats.waiting == 1
+            assert session_stats.in_flight == 2
+            assert session_stats.waiting == 1
+            assert connection_stats.in_flight == 3
+            assert connection_stats.waiting == 1
+
+            # Answer commands until everything has run.
+            answered = 0
+            while len(results) < 6:
+                unanswered = [command for command in browser.commands if
+                    command['method'] in browser.ignore][answered:]
+                for command in unanswered:
+                    if command['method'] == 'Page.captureScreenshot':
+                        result = {'data': ''}
+                    else:
+                        result = {'usedSize': 1, 'totalSize': 2}
+                    await browser.respond(command, result)
+                answered += len(unanswered)
+                await trio.sleep(0.01)
+
+        assert session.limit_stats()[0].waited == 1
+        assert session.limit_stats()[0].max_wait > 0
+        assert all(stats.in_flight == 0 for stats in session.limit_stats())
+
+        conn.set_limits()
+        assert session.limit_stats() == []
+
+
+@fail_after(2)
+async def test_execute_many_over_limit(nursery):
+    ''' A batch larger than the limits runs to completion, because each command
+    releases its limits when its response arrives. '''
+    browser = FakeBrowser()
+    server = await browser.start(nursery)
+    async with open_cdp(server) as conn:
+        session = await conn.connect_session(cdp.target.TargetID('target1'))
+        conn.set_limits(connection=1, session=2)
+        results = await session.execute_many(cdp.runtime.get_heap_usage()
+            for _ in range(5))
+        assert results == [(1000, 2000)] * 5
+        results = await session.execute_many((cdp.runtime.get_heap_usage()
+            for _ in range(5)), window=3)
+        assert len(results) == 5
+        assert all(stats.in_flight == 0 for stats in session.limit_stats())
+        assert session.limit_stats()[-1].waited > 0
+
+
+@fail_after(2)
+async def test_method_and_domain_limits_are_shared(nursery):
+    ''' Method and domain caps apply across all sessions of a connection. '''
+    browser = FakeBrowser()
+    server = await browser.start(nursery)
+    async with open_cdp(server) as conn:
+        session1 = await conn.connect_session(cdp.target.TargetID('target1'))
+        session2 = await conn.connect_session(cdp.target.TargetID('target2'))
+        conn.set_limits(methods={'Page.captureScreenshot': 1, 'Runtime': 1})
+        browser.ignore.update({'Page.captureScreenshot',
+            'Runtime.getHeapUsage', 'Runtime.evaluate'})
+
+        async with trio.open_nursery() as jobs:
+            jobs.start_soon(session1.execute, cdp.page.capture_screenshot())
+            jobs.start_soon(session2.execute, cdp.page.capture_screenshot())
+            jobs.start_soon(session1.execute, cdp.runtime.get_heap_usage())
+            jobs.start_soon(session2.execute, cdp.runtime.evaluate('1'))
+            await wait_for_sent(browser, 'Page.captureScreenshot', 1)
+            await wait_all_tasks_blocked()
+            methods = browser.methods()
+            assert methods.count('Page.captureScreenshot') == 1
+            assert methods.count('Runtime.getHeapUsage') + \
+                methods.count('Runtime.evaluate') == 1
+            assert [stats.waiting for stats in session1.limit_stats()] == [1, 1]
+
+            answered = 0
+            while answered < 4:
+                unanswered = [command for command in browser.commands if
+                    command['method'] in browser.ignore][answered:]
+                for command in unanswered:
+                    if command['method'] == 'Page.captureScreenshot':
+                        result = {'data': ''}
+                    elif command['method'] == 'Runtime.evaluate':
+                        result = {'result': {'type': 'number', 'value': 1}}
+                    else:
+                        result = {'usedSize': 1, 'totalSize': 2}
+                    await browser.respond(command, result)
+                answered += len(unanswered)
+                await trio.sleep(0.01)
+
+
+@fail_after(2)
+async def test_cancel_while_queued(nursery):
+    ''' A command that is cancelled while waiting for a limit gives up its
+    place without taking a permit. '''
+    browser = FakeBrowser()
+    server = await browser.start(nursery)
+    async with open_cdp(server) as conn:
+        conn.set_limits(session=1)
+        browser.ignore.add('Runtime.getHeapUsage')
+        async with trio.open_nursery() as jobs:
+            jobs.start_soon(conn.execute, cdp.runtime.get_heap_usage())
+            await wait_for_sent(browser, 'Runtime.getHeapUsage', 1)
+            jobs.start_soon(conn.execute, cdp.runtime.get_heap_usage())
+            await wait_all_tasks_blocked()
+            stats, = conn.limit_stats()
+            assert stats.waiting == 1
+            jobs.cancel_scope.cancel()
+        stats, = conn.limit_stats()
+        assert stats.waiting == 0
+        # The abandoned command keeps its permit until its response arrives.
+        assert stats.in_flight == 1
+        # The queued command was never sent.
+        assert browser.methods().count('Runtime.getHeapUsage') == 1
+        browser.ignore.clear()
+        await browser.respond(browser.commands[-1], {'usedSize': 1000,
+            'totalSize': 2000})
+        assert await conn.execute(cdp.runtime.get_heap_usage()) == (1000, 2000)
+
+
+@fail_after(2)
+async def test_abandoned_commands_keep_permits(nursery):
+    ''' Commands abandoned by a timeout hold their permits until their late
+    responses arrive, so the browser never has more than the limit in
+    flight. '''
+    browser = FakeBrowser()
+    server = await browser.start(nursery)
+    async with open_cdp(server) as conn:
+        conn.set_limits(session=2)
+        browser.ignore.add('Runtime.getHeapUsage')
+        with trio.move_on_after(0.1):
+            await conn.execute_many([cdp.runtime.get_heap_usage()
+                for _ in range(2)])
+        assert conn.abandoned_commands == 2
+
+        # The cap still holds: a new command waits for a permit.
+        with trio.move_on_after(0.1) as cancel_scope:
+            await conn.execute(cdp.runtime.get_heap_usage())
+        assert cancel_scope.cancelled_caught
+        stats, = conn.limit_stats()
+        assert stats.in_flight == 2
+        assert browser.methods().count('Runtime.getHeapUsage') == 2
+
+        # Each late response frees one permit.
+        browser.ignore.clear()
+        await browser.respond(browser.commands[0], {'usedSize': 1000,
+            'totalSize': 2000})
+        assert await conn.execute(cdp.runtime.get_heap_usage()) == (1000, 2000)
+        stats, = conn.limit_stats()
+        assert stats.in_flight == 1
+        assert conn.late_responses == 1
+
+    # Closing the connection releases the rest.
+    stats, = conn.limit_stats()
+    assert stats.in_flight == 0
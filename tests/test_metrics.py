@@ -0,0 +1,96 @@
+import cdp
+import pytest
+import trio
+
+from . import fail_after
+from .fake_browser import FakeBrowser
+from trio_cdp import open_cdp
+from trio_cdp.metrics import LatencyHistogram
+
+
+def test_latency_histogram():
+    ''' Percentiles are within one bucket of the recorded values. '''
+    histogram = LatencyHistogram()
+    for microseconds in range(1, 1001):
+        histogram.record(microseconds / 1_000_000)
+    assert histogram.count == 1000
+    assert histogram.min == pytest.approx(0.000001)
+    assert histogram.max == pytest.approx(0.001)
+    assert 0.0005 <= histogram.percentile(50) <= 0.0005 * 1.125
+    assert 0.00099 <= histogram.percentile(99) <= 0.001
+    assert sum(count for _, count in histogram.buckets()) == 1000
+    bounds = [bound for bound, _ in histogram.buckets()]
+    assert bounds == sorted(bounds)
+    snapshot = histogram.snapshot()
+    assert snapshot.mean == pytest.approx(0.0005005)
+    low, half, full, above = histogram.cumulative_counts([0.0001, 0.0005,
+        0.001, 1.0])
+    assert 0.875 * 100 <= low <= 100
+    assert 0.875 * 500 <= half <= 500
+    assert 0.875 * 1000 <= full <= 1000
+    assert above == 1000
+
+
+@fail_after(1)
+async def test_connection_metrics(nursery):
+    ''' Commands and events are counted by method, and gauges are computed
+    for the snapshot. '''
+    browser = FakeBrowser()
+    server = await browser.start(nursery)
+    async with open_cdp(server) as conn:
+        session = await conn.connect_session(cdp.target.TargetID('target1'))
+        await session.execute(cdp.page.navigate('https://example.com'))
+        await session.execute(cdp.page.navigate('https://example.com'))
+        listener = session.listen(cdp.page.LoadEventFired)
+        await browser.send({'method': 'Page.loadEventFired',
+            'sessionId': session.session_id, 'params': {'timestamp': 1}})
+        await listener.receive()
+
+        snapshot = conn.metrics_snapshot()
+        navigate = snapshot.methods['Page.navigate']
+        assert navigate.count == 2
+        assert navigate.errors == 0
+        assert navigate.bytes_sent > 0
+        assert navigate.bytes_received > 0
+        assert navigate.latency.count == 2
+        assert navigate.latency.max > 0
+        assert snapshot.methods['Target.attachToTarget'].count == 1
+        assert snapshot.events['Page.loadEventFired'].count == 1
+        assert snapshot.sessions == 1
+        assert snapshot.channels == 1
+        assert snapshot.in_flight == 0
+
+
+@fail_after(1)
+async def test_dropped_events_total(nursery):
+    ''' The dropped event total keeps the drops of channels that closed. '''
+    browser = FakeBrowser()
+    server = await browser.start(nursery)
+    async with open_cdp(server) as conn:
+        listener = conn.listen(cdp.page.LoadEventFired, buffer_size=1)
+        broadcast = conn.listen(cdp.page.LoadEventFired, buffer_size=1,
+            policy='broadcast')
+        other = conn.listen(cdp.page.LoadEventFired, buffer_size=1,
+            policy='broadcast')
+        for timestamp in range(3):
+            await browser.send({'method': 'Page.loadEventFired',
+                'params': {'timestamp': timestamp}})
+        while conn.metrics_snapshot().events.get('Page.loadEventFired') is \
+                None or conn.metrics_snapshot().events[
+                'Page.loadEventFired'].count < 3:
+            await trio.sleep(0.01)
+        snapshot = conn.metrics_snapshot()
+        assert snapshot.dropped_events == 6
+        assert snapshot.dropped_events_total == 6
+
+        await listener.aclose()
+        await broadcast.aclose()
+        await browser.send({'method': 'Page.loadEventFired',
+            'params': {'timestamp': 3}})
+        while conn.metrics_snapshot().events['Page.loadEventFired'].count < 4:
+            await trio.sleep(0.01)
+        snapshot = conn.metrics_snapshot()
+        assert snapshot.channels == 1
+        assert snapshot.dropped_events == 3
+        assert snapshot.dropped_events_total == 7
+        await other.aclose()
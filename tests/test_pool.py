@@ -0,0 +1,228 @@
+from cdp import page
+import pytest
+import trio
+import trio.testing
+
+from . import fail_after
+from .fake_browser import FakeBrowser
+from trio_cdp import BrowserError, CdpSessionClosed, open_cdp
+from trio_cdp.context import get_session_context
+from trio_cdp.pool import (open_browser_context_pool, open_browser_pool,
+    open_tab_pool)
+
+
+@fail_after(2)
+async def test_tab_pool(nursery):
+    ''' Tabs are created and enabled up front, reset when they are returned,
+    and retired after ``max_uses``. '''
+    browser = FakeBrowser()
+    server = await browser.start(nursery)
+
+    async with open_cdp(server) as conn:
+        async with open_tab_pool(conn, 2, max_uses=2) as pool:
+            assert browser.methods().count('Target.createTarget') == 2
+            assert pool.stats().idle == 2
+            assert conn.session_count == 2
+            async with pool.tab() as session:
+                assert get_session_context('test') is session
+                assert pool.stats().in_use == 1
+                assert browser.methods(session.session_id) == [
+                    'Page.enable', 'Network.enable']
+                await session.execute(page.navigate('https://example.com'))
+            first_session = session
+            # Wait for the tab to be reset and returned to the pool.
+            while pool.stats().idle < 2:
+                await trio.sleep(0.01)
+            assert 'Emulation.clearDeviceMetricsOverride' in \
+                browser.methods(first_session.session_id)
+            assert browser.methods(first_session.session_id).count(
+                'Page.navigate') == 2
+
+            # Use every tab twice so that each one is retired and replaced.
+            for _ in range(4):
+                async with pool.tab() as session:
+                    pass
+                while pool.stats().idle < 2:
+                    await trio.sleep(0.01)
+            stats = pool.stats()
+            assert stats.retired == 2
+            assert stats.created == 4
+            assert first_session.closed
+            assert len(browser.closed_targets) == 2
+            assert conn.session_count == 2
+        assert len(browser.closed_targets) == 4
+        assert conn.session_count == 0
+
+
+@fail_after(2)
+async def test_tab_pool_failures(nursery):
+    ''' A tab that cannot be attached is logged and its target is closed,
+    without tearing down the pool. Only enabled domains are reset. '''
+    browser = FakeBrowser()
+    server = await browser.start(nursery)
+
+    async with open_cdp(server) as conn:
+        async with open_tab_pool(conn, 1, max_uses=1,
+                enable_commands=(page.enable,)) as pool:
+            browser.errors['Target.attachToTarget'] = {'code': -32000,
+                'message': 'No target'}
+            async with pool.tab() as session:
+                pass
+            while pool.stats().retired < 1 or \
+                    len(browser.closed_targets) < 2:
+                await trio.sleep(0.01)
+            # The retired tab and the tab that failed to attach are closed.
+            assert browser.closed_targets == ['target1', 'target2']
+            assert 'Network.setExtraHTTPHeaders' not in browser.methods()
+            assert pool.stats().idle == 0
+
+            del browser.errors['Target.attachToTarget']
+            await pool.fill()
+            async with pool.tab() as session:
+                assert session.target_id == 'target3'
+
+        browser.errors['Target.attachToTarget'] = {'code': -32000,
+            'message': 'No target'}
+        with pytest.raises(RuntimeError):
+            async with open_tab_pool(conn, 1):
+                pass
+        assert browser.closed_targets[-1] == 'target4'
+
+
+@fail_after(2)
+async def test_tab_pool_wakes_borrowers(nursery):
+    ''' Borrowers waiting for a tab fail when the pool runs out of tabs or
+    closes, instead of waiting forever. '''
+    browser = FakeBrowser()
+    server = await browser.start(nursery)
+
+    async def borrow(pool, message):
+        with pytest.raises(RuntimeError, match=message):
+            async with pool.tab():
+                pass
+
+    async with open_cdp(server) as conn:
+        async with open_tab_pool(conn, 1, max_uses=1) as pool:
+            async with trio.open_nursery() as borrowers:
+                async with pool.tab():
+                    borrowers.start_soon(borrow, pool, 'no tabs left')
+                    await trio.testing.wait_all_tasks_blocked()
+                    browser.errors['Target.attachToTarget'] = {
+                        'code': -32000, 'message': 'No target'}
+            await borrow(pool, 'no tabs left')
+
+            del browser.errors['Target.attachToTarget']
+            await pool.fill()
+            async with trio.open_nursery() as borrowers:
+                async with pool.tab():
+                    borrowers.start_soon(borrow, pool, 'closed')
+                    await trio.testing.wait_all_tasks_blocked()
+                    await pool.aclose()
+            await borrow(pool, 'closed')
+
+
+@fail_after(2)
+async def test_browser_context_pool(nursery):
+    ''' Contexts are created up front, and a returned context is disposed and
+    replaced in the background. '''
+    browser = FakeBrowser()
+    server = await browser.start(nursery)
+
+    async with open_cdp(server) as conn:
+        async with open_browser_context_pool(conn, 2) as pool:
+            assert browser.methods().count('Target.createBrowserContext') == 2
+            async with pool.context() as context:
+                assert pool.stats().in_use == 1
+                async with context.open_session() as session:
+                    assert get_session_context('test') is session
+                create = [c for c in browser.commands
+                    if c['method'] == 'Target.createTarget'][0]
+                assert create['params']['browserContextId'] == context.context_id
+            while pool.stats().idle < 2:
+                await trio.sleep(0.01)
+            assert session.closed
+            disposed = [c['params']['browserContextId'] for c in browser.commands
+                if c['method'] == 'Target.disposeBrowserContext']
+            assert disposed == [context.context_id]
+            stats = pool.stats()
+            assert stats.created == 3
+            assert stats.disposed == 1
+            assert stats.max_creation_latency >= stats.mean_creation_latency >= 0
+        assert browser.methods().count('Target.disposeBrowserContext') == 3
+
+
+@fail_after(2)
+async def test_browser_context_pool_failures(nursery):
+    ''' A context that cannot be disposed is still replaced, and the pool
+    keeps running. '''
+    browser = FakeBrowser()
+    server = await browser.start(nursery)
+
+    async with open_cdp(server) as conn:
+        async with open_browser_context_pool(conn, 1) as pool:
+            async def fail_detach(session):
+                raise CdpSessionClosed(session.session_id, 'detached')
+
+            async with pool.context() as context:
+                await context.new_session()
+                conn.detach_session = fail_detach
+            while pool.stats().created < 2 or pool.stats().idle < 1:
+                await trio.sleep(0.01)
+            assert pool.stats().disposed == 1
+            assert browser.methods().count('Target.disposeBrowserContext') == 1
+            del conn.detach_session
+
+            browser.errors['Target.createBrowserContext'] = {'code': -32000,
+                'message': 'Failed'}
+            async with pool.context() as context:
+                pass
+            while browser.methods().count('Target.createBrowserContext') < 3:
+                await trio.sleep(0.01)
+            await trio.testing.wait_all_tasks_blocked()
+            assert pool.stats().idle == 0
+            del browser.errors['Target.createBrowserContext']
+
+
+@fail_after(2)
+async def test_browser_pool(nursery):
+    ''' Sessions are placed on the least loaded browser, and a browser that
+    fails its health checks is removed from the pool. '''
+    browser1 = FakeBrowser()
+    browser2 = FakeBrowser()
+    urls = [await browser1.start(nursery), await browser2.start(nursery)]
+
+    async with open_browser_pool(urls, health_interval=0.05, health_timeout=0.05,
+            max_failures=2) as pool:
+        assert len(pool.browsers) == 2
+        async with pool.open_session() as session1:
+            async with pool.open_session() as session2:
+                assert get_session_context('test') is session2
+                conns = {load.url: load for load in pool.loads()}
+                assert all(load.sessions == 1 for load in conns.values())
+            assert browser1.methods().count('Target.createTarget') == 1
+            assert browser2.methods().count('Target.createTarget') == 1
+
+        # Browser 2 stops responding to health checks and is removed.
+        browser2.ignore.add('Browser.getVersion')
+        while len(pool.browsers) == 2:
+            await trio.sleep(0.01)
+        assert [load.url for load in pool.loads()] == [urls[0]]
+        assert browser1.methods().count('Browser.getVersion') >= 2
+        async with pool.open_session() as session:
+            pass
+        assert browser1.methods().count('Target.createTarget') == 2
+
+
+@fail_after(2)
+async def test_browser_pool_attach_failure(nursery):
+    ''' If attaching to a new target fails, the target is closed. '''
+    browser = FakeBrowser()
+    url = await browser.start(nursery)
+    async with open_browser_pool([url]) as pool:
+        browser.errors['Target.attachToTarget'] = {'code': -32000,
+            'message': 'No target'}
+        with pytest.raises(BrowserError):
+            async with pool.open_session():
+                pass
+        assert browser.closed_targets == ['target1']
+        assert pool.loads()[0].sessions == 0
@@ -0,0 +1,53 @@
+import cdp
+import pytest
+
+from . import fail_after
+from .fake_browser import FakeBrowser
+from trio_cdp import open_cdp
+from trio_cdp.profiling import STAGES, ReaderProfile
+
+
+def test_reader_profile_sampling():
+    ''' Only one message in ``sample_every`` is profiled. '''
+    profile = ReaderProfile(sample_every=3)
+    sampled = [profile.sample() for _ in range(9)]
+    assert sampled == [True, False, False] * 3
+    assert profile.messages == 9
+    with pytest.raises(ValueError):
+        ReaderProfile(sample_every=0)
+
+
+@fail_after(1)
+async def test_connection_profiling(nursery):
+    ''' The reader records stage times, per-event costs, and lag. '''
+    browser = FakeBrowser()
+    server = await browser.start(nursery)
+    async with open_cdp(server) as conn:
+        assert conn.profile is None
+        profile = conn.enable_profiling()
+        session = await conn.connect_session(cdp.target.TargetID('target1'))
+        await session.execute(cdp.page.navigate('https://example.com'))
+        listener = session.listen(cdp.page.LoadEventFired)
+        await browser.send({'method': 'Page.frameNavigated',
+            'sessionId': session.session_id, 'params': {}})
+        await browser.send({'method': 'Page.loadEventFired',
+            'sessionId': session.session_id, 'params': {'timestamp': 1}})
+        await listener.receive()
+
+        snapshot = profile.snapshot()
+        assert snapshot.sampled == 4
+        assert set(snapshot.stages) == set(STAGES)
+        assert snapshot.stages['decode'].total > 0
+        assert snapshot.stages['parse'].total > 0
+        assert snapshot.lag.count == 4
+        load = snapshot.events['Page.loadEventFired']
+        assert load.count == 1
+        assert load.bytes > 0
+        assert load.parse > 0
+        # Nobody listens to this event, so it is decoded but not parsed.
+        assert snapshot.events['Page.frameNavigated'].parse == 0
+        assert 'Target.attachToTarget' not in snapshot.events
+
+        conn.disable_profiling()
+        assert conn.profile is None
+        assert session._profile is None
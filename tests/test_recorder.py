@@ -0,0 +1,153 @@
+import gzip
+import json
+
+import cdp
+import pytest
+import trio
+
+from . import fail_after
+from .fake_browser import FakeBrowser
+from trio_cdp import open_cdp
+from trio_cdp.recorder import (analyze_recording, format_report, open_recorder,
+    read_recording, WireRecorder)
+
+
+@fail_after(2)
+async def test_record_and_analyze(nursery, tmp_path):
+    ''' Record a connection's frames and report latency and event counts. '''
+    browser = FakeBrowser()
+    server = await browser.start(nursery)
+    async with open_recorder(str(tmp_path)) as recorder:
+        async with open_cdp(server, recorder=recorder) as conn:
+            session = await conn.connect_session(cdp.target.TargetID('target1'))
+            await session.execute(cdp.page.navigate('https://example.com'))
+            await session.execute(cdp.page.navigate('https://example.com'))
+            listener = session.listen(cdp.page.LoadEventFired)
+            await browser.send({'method': 'Page.loadEventFired',
+                'sessionId': session.session_id, 'params': {'timestamp': 1}})
+            await listener.receive()
+
+    assert len(recorder.paths) == 1
+    with gzip.open(recorder.paths[0], 'rt') as file:
+        meta, first = [json.loads(line) for line in file][:2]
+    assert meta['dir'] == 'meta'
+    assert first['dir'] == 'send'
+    assert first['method'] == 'Target.attachToTarget'
+    assert first['session'] is None
+    assert first['size'] == len(first['frame'])
+    assert json.loads(first['frame'])['id'] == first['id']
+
+    report = analyze_recording(str(tmp_path))
+    assert report.sent == 3
+    assert report.received == 4
+    assert report.unanswered == 0
+    assert report.methods['Page.navigate'].count == 2
+    assert report.methods['Page.navigate'].latency.max > 0
+    assert report.methods['Target.attachToTarget'].count == 1
+    assert report.events['Page.loadEventFired'].count == 1
+    assert 'Page.navigate' in format_report(report)
+
+
+async def test_recorder_filters_and_rotation(tmp_path):
+    ''' Method filters also drop the responses of filtered commands, and old
+    files are deleted when the recording rotates. '''
+    recorder = WireRecorder(str(tmp_path), max_bytes=200, max_files=2,
+        methods={'Page'}, include_frames=False)
+    for cmd_id in range(10):
+        recorder.record(1, 'send', json.dumps({'id': cmd_id,
+            'method': 'Page.navigate', 'sessionId': 'session1'}))
+        recorder.record(1, 'send', json.dumps({'id': 100 + cmd_id,
+            'method': 'Runtime.evaluate', 'sessionId': 'session1'}))
+        recorder.record(1, 'recv', json.dumps({'id': 100 + cmd_id,
+            'sessionId': 'session1', 'result': {}}))
+        recorder.record(1, 'recv', json.dumps({'id': cmd_id,
+            'sessionId': 'session1', 'error': {'code': 1, 'message': ''}}))
+    await recorder.aclose()
+    assert recorder.records == 20
+    paths = recorder.paths
+    assert len(paths) == 2
+    records = [record for record in read_recording(paths)
+        if record['dir'] != 'meta']
+    assert records
+    assert all(record.get('method', 'Page.navigate') == 'Page.navigate'
+        and record['id'] < 100 and 'frame' not in record for record in records)
+    report = analyze_recording(paths)
+    assert report.methods['Page.navigate'].errors == \
+        report.methods['Page.navigate'].count
+
+    # Nothing is recorded when the sample rate is zero.
+    recorder = WireRecorder(str(tmp_path), sample_rate=0)
+    recorder.record(1, 'send', json.dumps({'id': 1, 'method': 'Page.navigate'}))
+    recorder.record(1, 'recv', json.dumps({'id': 1, 'result': {}}))
+    recorder.record(1, 'recv', json.dumps({'method': 'Page.loadEventFired'}))
+    await recorder.aclose()
+    assert recorder.records == 0
+    assert recorder.paths == paths
+
+    # A new recording continues after the existing files.
+    recorder = WireRecorder(str(tmp_path))
+    recorder.record(1, 'recv', json.dumps({'method': 'Page.loadEventFired'}))
+    await recorder.aclose()
+    assert recorder.paths[:2] == paths
+    assert len(recorder.paths) == 3
+
+
+async def test_recorder_scans_metadata(tmp_path, monkeypatch):
+    ''' Frames laid out like Chrome's are recorded without being decoded, and
+    other frames are decoded. '''
+    recorder = WireRecorder(str(tmp_path), include_frames=False)
+    decoded = list()
+    loads = recorder.codec.loads
+    monkeypatch.setattr(recorder.codec, 'loads',
+        lambda message: decoded.append(message) or loads(message))
+    recorder.record(1, 'send', '{"method":"Page.navigate","params":{"url":'
+        '"https://example.com","id":3},"id":5,"sessionId":"session1"}')
+    recorder.record(1, 'recv', b'{"id":5,"error":{"code":-1,"message":""},'
+        b'"sessionId":"session1"}')
+    recorder.record(1, 'recv', '{"method":"Page.frameNavigated","params":{'
+        '"frame":{"id":"frame1","sessionId":"x"}},"sessionId":"session1"}')
+    assert not decoded
+    # The session ID is in the middle, so the frame must be decoded.
+    recorder.record(1, 'recv', '{"method":"Page.loadEventFired","params":{},'
+        '"sessionId":"session1","extra":{}}')
+    assert len(decoded) == 1
+    await recorder.aclose()
+    records = [record for record in read_recording(recorder.paths)
+        if record['dir'] != 'meta']
+    assert [(r['dir'], r.get('id'), r.get('method'), r['session'],
+        r.get('error', False)) for r in records] == [
+        ('send', 5, 'Page.navigate', 'session1', False),
+        ('recv', 5, None, 'session1', True),
+        ('recv', None, 'Page.frameNavigated', 'session1', False),
+        ('recv', None, 'Page.loadEventFired', 'session1', False),
+    ]
+
+
+async def test_recorder_forgets_closed_transport(tmp_path):
+    ''' Commands that never get a response are forgotten when the transport
+    closes. '''
+    class Transport:
+        closed = False
+
+        async def send_message(self, message):
+            pass
+
+        async def get_message(self):
+            raise trio.BrokenResourceError()
+
+        async def aclose(self):
+            self.closed = True
+
+    recorder = WireRecorder(str(tmp_path))
+    for _ in range(2):
+        transport = recorder.wrap(Transport())
+        await transport.send_message(json.dumps({'method': 'Page.navigate',
+            'id': 1}))
+        assert recorder._pending
+        if transport.conn_id == 1:
+            with pytest.raises(trio.BrokenResourceError):
+                await transport.get_message()
+        else:
+            await transport.aclose()
+        assert not recorder._pending
+    await recorder.aclose()
@@ -0,0 +1,168 @@
+import cdp
+import pytest
+import trio
+
+from . import fail_after
+from .fake_browser import FakeBrowser
+from trio_cdp import CdpConnectionClosed, CdpSessionClosed
+from trio_cdp.resilient import ReplayState, is_idempotent, open_resilient_cdp
+
+
+def test_replay_state():
+    ''' Enabling records a domain, disabling forgets it, and setters keep only
+    their latest call. '''
+    state = ReplayState()
+    state.record({'method': 'Page.enable'})
+    state.record({'method': 'Network.enable', 'params': {}})
+    state.record({'method': 'Network.setExtraHTTPHeaders',
+        'params': {'headers': {'a': '1'}}})
+    state.record({'method': 'Network.setExtraHTTPHeaders',
+        'params': {'headers': {'a': '2'}}})
+    state.record({'method': 'Page.addScriptToEvaluateOnNewDocument', 'id': 1,
+        'params': {'source': '1'}})
+    state.record({'method': 'Page.addScriptToEvaluateOnNewDocument', 'id': 2,
+        'params': {'source': '2'}})
+    state.record({'method': 'Page.navigate', 'params': {'url': 'about:blank'}})
+    state.record({'method': 'Network.disable'})
+    assert state.requests() == [
+        ('Page.enable', None),
+        ('Network.setExtraHTTPHeaders', {'headers': {'a': '2'}}),
+        ('Page.addScriptToEvaluateOnNewDocument', {'source': '1'}),
+        ('Page.addScriptToEvaluateOnNewDocument', {'source': '2'}),
+    ]
+    assert is_idempotent('DOM.getDocument')
+    assert not is_idempotent('Page.enable')
+    assert not is_idempotent('Page.navigate')
+
+
+def test_replay_state_scripts():
+    ''' A removed script is not replayed, even if it was removed with the
+    identifier it had before a reconnect. '''
+    state = ReplayState()
+    add = {'method': 'Page.addScriptToEvaluateOnNewDocument', 'id': 1,
+        'params': {'source': '1'}}
+    # The response can arrive before the command is recorded.
+    state.record_result(add, {'identifier': 'a'})
+    state.record(add)
+    method, params = state.requests()[0]
+    state.record_result({'method': method, 'id': 5, 'params': params},
+        {'identifier': 'b'})
+    remove = {'method': 'Page.removeScriptToEvaluateOnNewDocument', 'id': 6,
+        'params': {'identifier': 'a'}}
+    state.prepare(remove)
+    assert remove['params'] == {'identifier': 'b'}
+    state.record(remove)
+    assert state.requests() == []
+
+
+@fail_after(5)
+async def test_reconnect_removed_script(nursery):
+    ''' A script removed after a reconnect is removed by its new identifier and
+    is not added again by the next reconnect. '''
+    browser = FakeBrowser()
+    server = await browser.start(nursery)
+    browser.results['Page.addScriptToEvaluateOnNewDocument'] = \
+        lambda command: {'identifier': 'script{}'.format(command['id'])}
+    browser.results['Target.getTargets'] = {'targetInfos': []}
+
+    async with open_resilient_cdp(server, initial_backoff=0.01) as conn:
+        identifier = await conn.execute(
+            cdp.page.add_script_to_evaluate_on_new_document('window.x = 1'))
+        for reconnects in (1, 2):
+            await browser.connections[-1].aclose()
+            while conn.reconnects < reconnects:
+                await trio.sleep(0.01)
+            await conn.execute(cdp.browser.get_version())
+            if reconnects == 1:
+                await conn.execute(
+                    cdp.page.remove_script_to_evaluate_on_new_document(
+                        identifier))
+        adds = [command for command in browser.commands if command['method']
+            == 'Page.addScriptToEvaluateOnNewDocument']
+        removes = [command for command in browser.commands if command['method']
+            == 'Page.removeScriptToEvaluateOnNewDocument']
+        assert len(adds) == 2
+        assert removes[0]['params']['identifier'] == \
+            'script{}'.format(adds[1]['id'])
+
+
+@fail_after(5)
+async def test_reconnect(nursery):
+    ''' After the WebSocket drops, the connection reconnects, re-attaches to the
+    surviving target, replays its state, and resends idempotent commands. '''
+    browser = FakeBrowser()
+    server = await browser.start(nursery)
+    browser.results['Target.getTargets'] = {'targetInfos': [{
+        'targetId': 'target1', 'type': 'page', 'title': '',
+        'url': 'about:blank', 'attached': True}]}
+
+    async with open_resilient_cdp(server, initial_backoff=0.01) as conn:
+        session1 = await conn.connect_session(
+            cdp.target.TargetID('target1'))
+        session2 = await conn.connect_session(
+            cdp.target.TargetID('target2'))
+        await session1.execute(cdp.page.enable())
+        await session1.execute(cdp.page.add_script_to_evaluate_on_new_document(
+            'window.x = 1'))
+
+        browser.ignore.update({'Runtime.getHeapUsage', 'Page.navigate'})
+        results = dict()
+
+        async def run(name, session, cmd):
+            try:
+                results[name] = await session.execute(cmd)
+            except Exception as exc:
+                results[name] = exc
+
+        nursery.start_soon(run, 'heap', session1, cdp.runtime.get_heap_usage())
+        nursery.start_soon(run, 'navigate', session1,
+            cdp.page.navigate('https://example.com'))
+        nursery.start_soon(run, 'orphan', session2, cdp.runtime.get_heap_usage())
+        while len(browser.methods()) < 7:
+            await trio.sleep(0.01)
+        browser.ignore.clear()
+        sent = len(browser.commands)
+        await browser.connections[0].aclose()
+
+        while len(results) < 3:
+            await trio.sleep(0.01)
+        assert conn.reconnects == 1
+        assert results['heap'] == (1000, 2000)
+        assert isinstance(results['navigate'], CdpConnectionClosed)
+        assert isinstance(results['orphan'], CdpSessionClosed)
+        assert session2.closed
+        assert not session1.closed
+        assert [command['method'] for command in browser.commands[sent:]] == [
+            'Target.getTargets', 'Target.attachToTarget', 'Page.enable',
+            'Page.addScriptToEvaluateOnNewDocument', 'Runtime.getHeapUsage']
+
+        # The same session object keeps working.
+        await session1.execute(cdp.page.navigate('https://example.com'))
+        assert conn.sessions == {session1.session_id: session1}
+        # Replayed and resent commands went through the writer too.
+        assert sum(lane.sent for lane in conn.writer_stats()) == \
+            len(browser.commands)
+
+
+@fail_after(5)
+async def test_reconnect_gives_up(nursery):
+    ''' If the browser does not come back, the connection closes. '''
+    browser = FakeBrowser()
+    server = await browser.start(nursery)
+    attempts = list()
+
+    async def get_url():
+        attempts.append(None)
+        if len(attempts) == 1:
+            return server
+        raise OSError('Browser is gone')
+
+    async with open_resilient_cdp(get_url, max_attempts=3,
+            initial_backoff=0.01) as conn:
+        await conn.execute(cdp.browser.get_version())
+        await browser.connections[0].aclose()
+        with pytest.raises(CdpConnectionClosed):
+            while True:
+                await conn.execute(cdp.browser.get_version())
+        assert len(attempts) == 4
+        assert conn.reconnects == 0
@@ -0,0 +1,97 @@
+import os
+
+import pytest
+import trio
+
+from . import fail_after
+from .fake_browser import FakeBrowser
+from trio_cdp import target
+from trio_cdp.sharding import ShardWorkerError, open_shard_pool
+
+
+async def count_targets(label):
+    ''' A job that runs in a worker process using the simplified API. '''
+    targets = await target.get_targets()
+    return label, os.getpid(), len(targets)
+
+
+async def fail_job():
+    raise ValueError('job failed')
+
+
+async def unpicklable_job():
+    ''' Returns a result that the worker cannot pickle. '''
+    return lambda: None
+
+
+def raise_on_load():
+    raise ValueError('cannot load this result')
+
+
+class Unloadable:
+    ''' Pickles fine, but raises when it is unpickled. '''
+    def __reduce__(self):
+        return raise_on_load, ()
+
+
+async def unloadable_job():
+    return Unloadable()
+
+
+async def sleeping_job(path):
+    ''' Sleeps until it is cancelled, and then creates ``path``. '''
+    try:
+        await trio.sleep_forever()
+    finally:
+        open(path, 'w').close()
+
+
+@pytest.mark.skipif(os.name != 'posix', reason='Sharding requires POSIX')
+@fail_after(20)
+async def test_shard_pool(nursery, tmp_path):
+    browsers = [FakeBrowser(), FakeBrowser()]
+    urls = [await browser.start(nursery) for browser in browsers]
+    for browser in browsers:
+        browser.results['Target.getTargets'] = {'targetInfos': []}
+
+    async with open_shard_pool(urls, workers=2) as shards:
+        assert len(shards.workers) == 2
+        results = list()
+
+        async def run(label):
+            results.append(await shards.run(count_targets, label))
+
+        async with trio.open_nursery() as jobs:
+            for label in range(4):
+                jobs.start_soon(run, label)
+
+        assert sorted(label for label, _, _ in results) == [0, 1, 2, 3]
+        assert all(count == 0 for _, _, count in results)
+        assert len({pid for _, pid, _ in results}) == 2
+        assert os.getpid() not in {pid for _, pid, _ in results}
+
+        with pytest.raises(ValueError, match='job failed'):
+            await shards.run(fail_job)
+        stats = shards.stats()
+        assert sum(worker.completed for worker in stats) == 5
+        assert sum(worker.failed for worker in stats) == 1
+
+        # Results that cannot be pickled or unpickled fail only their job.
+        with pytest.raises(ShardWorkerError, match='Unable to send'):
+            await shards.run(unpicklable_job)
+        with pytest.raises(ShardWorkerError, match='Unable to receive'):
+            await shards.run(unloadable_job)
+        assert len(shards.workers) == 2
+
+        # Cancelling the caller cancels the job in the worker.
+        path = tmp_path / 'cancelled'
+        with trio.move_on_after(0.5):
+            await shards.run(sleeping_job, str(path))
+        while not path.exists():
+            await trio.sleep(0.01)
+        assert all(worker.pending == 0 for worker in shards.stats())
+
+        label, _, _ = await shards.run(count_targets, 'after')
+        assert label == 'after'
+    assert sum(browser.methods().count('Target.getTargets')
+        for browser in browsers) == 5
@@ -0,0 +1,80 @@
+import trio
+
+from . import fail_after
+from .fake_browser import FakeBrowser
+from trio_cdp import open_cdp
+
+
+def target_info(target_id, type_='page', url='about:blank'):
+    return {'targetId': target_id, 'type': type_, 'title': '', 'url': url,
+        'attached': True}
+
+
+async def wait_for_command(browser, method, session_id=None):
+    while method not in browser.methods(session_id):
+        await trio.sleep(0.01)
+
+
+@fail_after(2)
+async def test_auto_attach(nursery):
+    ''' The registry tracks targets from events, sessions are created for
+    attached targets, and targets of unwanted types are detached. '''
+    browser = FakeBrowser()
+    server = await browser.start(nursery)
+
+    async with open_cdp(server) as conn:
+        targets = await conn.auto_attach(types={'page', 'iframe'},
+            wait_for_debugger=True)
+        assert conn.targets is targets
+        assert browser.methods() == ['Target.setDiscoverTargets',
+            'Target.setAutoAttach']
+        assert browser.commands[-1]['params'] == {'autoAttach': True,
+            'waitForDebuggerOnStart': True, 'flatten': True}
+
+        await browser.send({'method': 'Target.targetCreated',
+            'params': {'targetInfo': target_info('page1')}})
+        await browser.send({'method': 'Target.attachedToTarget', 'params': {
+            'sessionId': 'session1', 'targetInfo': target_info('page1'),
+            'waitingForDebugger': True}})
+        await wait_for_command(browser, 'Runtime.runIfWaitingForDebugger',
+            'session1')
+        assert browser.methods('session1') == ['Target.setAutoAttach',
+            'Runtime.runIfWaitingForDebugger']
+        session = targets.session('page1')
+        assert conn.sessions['session1'] is session
+        assert session.target_id == 'page1'
+
+        # Child targets are reported on their parent's session.
+        await browser.send({'method': 'Target.attachedToTarget',
+            'sessionId': 'session1', 'params': {'sessionId': 'session2',
+            'targetInfo': target_info('frame1', 'iframe'),
+            'waitingForDebugger': False}})
+        await wait_for_command(browser, 'Target.setAutoAttach', 'session2')
+        assert targets.session('frame1') is conn.sessions['session2']
+        assert 'Runtime.runIfWaitingForDebugger' not in \
+            browser.methods('session2')
+
+        await browser.send({'method': 'Target.attachedToTarget',
+            'sessionId': 'session1', 'params': {'sessionId': 'session3',
+            'targetInfo': target_info('worker1', 'service_worker'),
+            'waitingForDebugger': True}})
+        await wait_for_command(browser, 'Target.detachFromTarget')
+        assert browser.commands[-1]['params'] == {'sessionId': 'session3'}
+        assert targets.session('worker1') is None
+        assert 'session3' not in conn.sessions
+        assert targets.get('worker1').type_ == 'service_worker'
+
+        await browser.send({'method': 'Target.targetInfoChanged',
+            'params': {'targetInfo': target_info('page1',
+            url='https://example.com')}})
+        await browser.send({'method': 'Target.detachedFromTarget',
+            'sessionId': 'session1', 'params': {'sessionId': 'session2'}})
+        await browser.send({'method': 'Target.targetDestroyed',
+            'params': {'targetId': 'worker1'}})
+        while 'worker1' in targets:
+            await trio.sleep(0.01)
+        assert [info.url for info in targets.find(type_='page')] == [
+            'https://example.com']
+        assert targets.session('frame1') is None
+        assert 'frame1' in targets
+        assert len(targets) == 2
@@ -0,0 +1,107 @@
+import json
+import os
+import sys
+
+from cdp import runtime, target
+import pytest
+import trio
+from trio.testing import memory_stream_one_way_pair
+from trio_websocket import ConnectionClosed
+
+from . import fail_after
+from trio_cdp import open_cdp_pipe
+from trio_cdp.transport import open_process_with_pipes, PipeTransport
+
+
+# A stand-in for a browser started with --remote-debugging-pipe. It reads
+# NUL-delimited commands from fd 3 and answers each one on fd 4. Commands for
+# "Runtime.evaluate" return a string of the requested length.
+STAND_IN_BROWSER = r'''
+import json, os
+buffer = b''
+while True:
+    data = os.read(3, 65536)
+    if not data:
+        break
+    buffer += data
+    while b'\0' in buffer:
+        message, buffer = buffer.split(b'\0', 1)
+        command = json.loads(message)
+        if command['method'] == 'Runtime.evaluate':
+            size = int(command['params']['expression'])
+            result = {'result': {'type': 'string', 'value': 'x' * size}}
+        else:
+            result = {'targetInfos': []}
+        response = json.dumps({'id': command['id'], 'result': result})
+        os.write(4, response.encode('utf8') + b'\0')
+'''
+
+
+async def test_pipe_transport_send_messages():
+    ''' A batch of messages is written in one piece. '''
+    client_receive, _ = memory_stream_one_way_pair()
+    client_send, browser_receive = memory_stream_one_way_pair()
+    transport = PipeTransport(client_receive, client_send)
+    await transport.send_messages(['{"a": 1}', b'{"b": 2}'])
+    assert await browser_receive.receive_some() == b'{"a": 1}\0{"b": 2}\0'
+
+
+async def test_pipe_transport_splits_messages():
+    send_to_client, client_receive = memory_stream_one_way_pair()
+    client_send, _ = memory_stream_one_way_pair()
+    transport = PipeTransport(client_receive, client_send)
+    await send_to_client.send_all(b'{"a": 1}\0{"b"')
+    await send_to_client.send_all(b': 2}\0{"c": 3}\0')
+    assert await transport.get_message() == b'{"a": 1}'
+    assert await transport.get_message() == b'{"b": 2}'
+    arrival = transport.last_arrival
+    assert await transport.get_message() == b'{"c": 3}'
+    # Messages from the same read arrived at the same time.
+    assert transport.last_arrival == arrival is not None
+    await send_to_client.aclose()
+    with pytest.raises(ConnectionClosed):
+        await transport.get_message()
+    assert transport.closed.code == 1000
+
+
+async def test_pipe_transport_max_message_size():
+    send_to_client, client_receive = memory_stream_one_way_pair()
+    client_send, _ = memory_stream_one_way_pair()
+    transport = PipeTransport(client_receive, client_send, max_message_size=4)
+    await send_to_client.send_all(b'{"a": 1}\0')
+    with pytest.raises(ConnectionClosed):
+        await transport.get_message()
+    assert transport.closed.code == 1009
+
+
+@pytest.mark.skipif(os.name != 'posix', reason='Pipes require POSIX')
+@fail_after(5)
+async def test_open_cdp_pipe():
+    ''' Execute commands over pipes, including a response that is larger than
+    the maximum WebSocket message size. '''
+    async with open_cdp_pipe([sys.executable, '-c', STAND_IN_BROWSER]) as conn:
+        targets = await conn.execute(target.get_targets())
+        assert targets == []
+        size = 2**24 + 1
+        result, _ = await conn.execute(runtime.evaluate(str(size)))
+        assert len(result.value) == size
+    assert conn.transport.process.returncode == 0
+
+
+@pytest.mark.skipif(os.name != 'posix', reason='Pipes require POSIX')
+@fail_after(5)
+async def test_open_cdp_pipe_fds():
+    ''' The child gets only the pipes on fds 3 and 4, and a missing executable
+    is reported by the parent. '''
+    script = ('import os; '
+        'assert not os.path.exists("/proc/self/fd/5"); '
+        'assert os.read(3, 1) == b"x"; '
+        'os.write(4, b"{\\"id\\": 0, \\"result\\": {}}\\0")')
+    process, receive_stream, send_stream = await open_process_with_pipes(
+        [sys.executable, '-c', script])
+    async with receive_stream, send_stream:
+        await send_stream.send_all(b'x')
+        assert await receive_stream.receive_some() == b'{"id": 0, "result": {}}\0'
+        assert await process.wait() == 0
+    with pytest.raises(FileNotFoundError):
+        await open_process_with_pipes(['/nonexistent/browser'])
@@ -4,10 +4,12 @@ import logging
 from cdp import dom, page, target
 import pytest
 import trio
-from trio_websocket import serve_websocket
+from trio_websocket import ConnectionClosed, serve_websocket
 
 from . import fail_after
-from trio_cdp import BrowserError, open_cdp, dom as trio_cdp_dom
+from trio_cdp import (BrowserError, CdpConnectionClosed, CdpSessionClosed,
+    open_cdp, dom as trio_cdp_dom)
+from trio_cdp.codec import OrjsonCodec
 
 
 HOST = '127.0.0.1'
@@ -61,6 +63,34 @@ async def test_connection_execute(nursery):
         assert isinstance(targets[0], target.TargetInfo)
 
 
+@fail_after(1)
+async def test_connection_codec(nursery):
+    ''' A connection can use a non-default codec, including one that sends
+    binary frames. '''
+    orjson = pytest.importorskip('orjson')
+    async def handler(request):
+        # It's tricky to catch exceptions from the server, so exceptions are
+        # logged instead.
+        try:
+            ws = await request.accept()
+            message = await ws.get_message()
+            assert isinstance(message, bytes)
+            command = json.loads(message)
+            logging.info('Server received:  %r', command)
+            response = {
+                'id': command['id'],
+                'result': {'targetInfos': []},
+            }
+            await ws.send_message(json.dumps(response).encode('utf8'))
+        except Exception:
+            logging.exception('Server exception')
+    server = await start_server(nursery, handler)
+    async with open_cdp(server, codec=OrjsonCodec(binary=True)) as conn:
+        assert isinstance(conn.codec, OrjsonCodec)
+        targets = await conn.execute(target.get_targets())
+        assert targets == []
+
+
 @fail_after(1)
 async def test_connection_invalid_json():
     ''' If the server sends invalid JSON, that exception is raised on the reader
@@ -160,6 +190,19 @@ def session_handler():
             }
             logging.info('Server sending:  %r', response)
             await ws.send_message(json.dumps(response))
+
+            # Handle the "detachFromTarget" command that is sent when a session
+            # context exits.
+            try:
+                command = json.loads(await ws.get_message())
+            except ConnectionClosed:
+                return
+            assert command['method'] == 'Target.detachFromTarget'
+            assert command['params']['sessionId'] == 'session1'
+            logging.info('Server received:  %r', command)
+            response = {'id': command['id'], 'result': {}}
+            logging.info('Server sending:  %r', response)
+            await ws.send_message(json.dumps(response))
         except Exception:
             logging.exception('Server exception')
     return handler
@@ -188,6 +231,8 @@ async def test_session_context(nursery, session_handler):
             assert session.session_id == 'session1'
             node_id = await trio_cdp_dom.query_selector(dom.NodeId(0),'p.foo')
             assert node_id == 1
+        assert session.closed
+        assert conn.session_count == 0
 
 
 @fail_after(1)
@@ -241,6 +286,30 @@ async def test_wait_for_event(nursery):
         assert event.value.timestamp == 2
 
 
+@fail_after(1)
+async def test_wait_for_coalesced_event(nursery):
+    async def handler(request):
+        try:
+            ws = await request.accept()
+            for timestamp in (1, 2):
+                await ws.send_message(json.dumps({
+                    'method': 'Page.loadEventFired',
+                    'params': {'timestamp': timestamp},
+                }))
+        except Exception:
+            logging.exception('Server exception')
+    server = await start_server(nursery, handler)
+
+    async with open_cdp(server) as conn:
+        with pytest.raises(ValueError):
+            async with conn.wait_for(page.LoadEventFired, policy='coalesce'):
+                pass
+        async with conn.wait_for(page.LoadEventFired, policy='coalesce',
+                key=type) as event:
+            pass
+        assert isinstance(event.value, page.LoadEventFired)
+
+
 @fail_after(1)
 async def test_listen_for_events(nursery):
     ''' The server sends 2 different events. The client is listening for a
@@ -279,3 +348,320 @@ async def test_listen_for_events(nursery):
             if n == 2:
                 break
             n += 1
+
+
+@fail_after(1)
+async def test_unsubscribed_events_are_not_parsed(nursery):
+    ''' Events without a listener are discarded without being parsed, so even a
+    malformed event does not disturb the connection. '''
+    async def handler(request):
+        # It's tricky to catch exceptions from the server, so exceptions are
+        # logged instead.
+        try:
+            ws = await request.accept()
+
+            # This event is missing its required "timestamp" parameter, so it
+            # cannot be parsed. Nobody is listening for it.
+            event = {
+                'method': 'Page.domContentEventFired',
+                'params': {},
+            }
+            logging.info('Server sending:  %r', event)
+            await ws.send_message(json.dumps(event))
+
+            event = {
+                'method': 'Page.loadEventFired',
+                'params': {'timestamp': 1},
+            }
+            logging.info('Server sending:  %r', event)
+            await ws.send_message(json.dumps(event))
+        except Exception:
+            logging.exception('Server exception')
+    server = await start_server(nursery, handler)
+
+    async with open_cdp(server) as conn:
+        async with conn.wait_for(page.LoadEventFired) as event:
+            pass
+        assert event.value.timestamp == 1
+        assert page.DomContentEventFired not in conn.channels
+
+
+@fail_after(1)
+async def test_execute_many(nursery):
+    ''' All commands in a batch are sent before any response is received. The
+    results are returned in order, and a browser error for one command does not
+    affect the others. '''
+    async def handler(request):
+        # It's tricky to catch exceptions from the server, so exceptions are
+        # logged instead.
+        try:
+            ws = await request.accept()
+            commands = [json.loads(await ws.get_message()) for _ in range(3)]
+            logging.info('Server received:  %r', commands)
+            for command in reversed(commands):
+                if command['params']['selector'] == 'bogus':
+                    response = {
+                        'id': command['id'],
+                        'error': {'code': -32000, 'message': 'Bad selector'},
+                    }
+                else:
+                    response = {
+                        'id': command['id'],
+                        'result': {'nodeId': len(command['params']['selector'])},
+                    }
+                logging.info('Server sending:  %r', response)
+                await ws.send_message(json.dumps(response))
+        except Exception:
+            logging.exception('Server exception')
+    server = await start_server(nursery, handler)
+
+    async with open_cdp(server) as conn:
+        results = await conn.execute_many([
+            dom.query_selector(dom.NodeId(0), 'p'),
+            dom.query_selector(dom.NodeId(0), 'bogus'),
+            dom.query_selector(dom.NodeId(0), 'div'),
+        ])
+        assert results[0] == 1
+        assert isinstance(results[1], BrowserError)
+        assert results[1].code == -32000
+        assert results[2] == 3
+        assert not conn.inflight
+
+
+@fail_after(1)
+async def test_execute_many_window(nursery):
+    ''' With a window of 1, each command is sent only after the previous command
+    has completed. '''
+    async def handler(request):
+        # It's tricky to catch exceptions from the server, so exceptions are
+        # logged instead.
+        try:
+            ws = await request.accept()
+            for _ in range(3):
+                command = json.loads(await ws.get_message())
+                logging.info('Server received:  %r', command)
+                response = {'id': command['id'], 'result': {'nodeId': command['id']}}
+                await ws.send_message(json.dumps(response))
+        except Exception:
+            logging.exception('Server exception')
+    server = await start_server(nursery, handler)
+
+    async with open_cdp(server) as conn:
+        results = await conn.execute_many((dom.query_selector(dom.NodeId(0), 'p')
+            for _ in range(3)), window=1)
+        assert results == [0, 1, 2]
+
+
+@fail_after(1)
+async def test_cancelled_command_is_abandoned(nursery):
+    ''' If the caller of ``execute()`` is cancelled, the command is removed from
+    the in-flight table and its late response is discarded. '''
+    async def handler(request):
+        # It's tricky to catch exceptions from the server, so exceptions are
+        # logged instead.
+        try:
+            ws = await request.accept()
+            command1 = json.loads(await ws.get_message())
+            command2 = json.loads(await ws.get_message())
+            logging.info('Server received:  %r %r', command1, command2)
+            for command in (command1, command2):
+                response = {'id': command['id'], 'result': {'nodeId': 1}}
+                logging.info('Server sending:  %r', response)
+                await ws.send_message(json.dumps(response))
+        except Exception:
+            logging.exception('Server exception')
+    server = await start_server(nursery, handler)
+
+    async with open_cdp(server) as conn:
+        with trio.move_on_after(0.1) as cancel_scope:
+            await conn.execute(dom.query_selector(dom.NodeId(0), 'p'))
+        assert cancel_scope.cancelled_caught
+        assert not conn.inflight
+        assert conn.abandoned_commands == 1
+        node_id = await conn.execute(dom.query_selector(dom.NodeId(0), 'p'))
+        assert node_id == 1
+        assert conn.late_responses == 1
+        assert not conn.inflight
+
+
+@fail_after(1)
+async def test_listen_broadcast(nursery):
+    ''' Broadcast listeners for the same event type share one ring buffer, and
+    each listener receives every event. '''
+    async def handler(request):
+        # It's tricky to catch exceptions from the server, so exceptions are
+        # logged instead.
+        try:
+            ws = await request.accept()
+            for n in (1, 2):
+                event = {
+                    'method': 'Page.loadEventFired',
+                    'params': {'timestamp': n},
+                }
+                logging.info('Server sending:  %r', event)
+                await ws.send_message(json.dumps(event))
+        except Exception:
+            logging.exception('Server exception')
+    server = await start_server(nursery, handler)
+
+    async with open_cdp(server) as conn:
+        listener1 = conn.listen(page.LoadEventFired, policy='broadcast')
+        listener2 = conn.listen(page.LoadEventFired, policy='broadcast')
+        assert len(conn.channels[page.LoadEventFired]) == 1
+        timestamps = [(await listener1.receive()).timestamp for _ in range(2)]
+        assert timestamps == [1, 2]
+        # Each broadcast listener counts as a channel in the metrics.
+        snapshot = conn.metrics_snapshot()
+        assert snapshot.channels == 2
+        assert snapshot.queued_events == 2
+        timestamps = [(await listener2.receive()).timestamp for _ in range(2)]
+        assert timestamps == [1, 2]
+        assert conn.metrics_snapshot().queued_events == 0
+
+
+@fail_after(1)
+async def test_listen_all(nursery):
+    ''' A connection-level listener receives events from every session, tagged
+    with the session that they arrived on. '''
+    async def handler(request):
+        # It's tricky to catch exceptions from the server, so exceptions are
+        # logged instead.
+        try:
+            ws = await request.accept()
+            for n in (1, 2):
+                command = json.loads(await ws.get_message())
+                assert command['method'] == 'Target.attachToTarget'
+                response = {
+                    'id': command['id'],
+                    'result': {'sessionId': 'session{}'.format(n)},
+                }
+                logging.info('Server sending:  %r', response)
+                await ws.send_message(json.dumps(response))
+            # Wait for the client to signal that it is listening.
+            await ws.get_message()
+            for n in (1, 2):
+                event = {
+                    'method': 'Page.loadEventFired',
+                    'sessionId': 'session{}'.format(n),
+                    'params': {'timestamp': n},
+                }
+                logging.info('Server sending:  %r', event)
+                await ws.send_message(json.dumps(event))
+        except Exception:
+            logging.exception('Server exception')
+    server = await start_server(nursery, handler)
+
+    async with open_cdp(server) as conn:
+        session1 = await conn.connect_session(target.TargetID('target1'))
+        session2 = await conn.connect_session(target.TargetID('target2'))
+        listener = conn.listen_all(page.LoadEventFired)
+        await conn.ws.send_message('ready')
+        session, event = await listener.receive()
+        assert session is session1
+        assert event.timestamp == 1
+        session, event = await listener.receive()
+        assert session is session2
+        assert event.timestamp == 2
+
+
+@fail_after(1)
+async def test_session_evicted_when_target_crashes(nursery):
+    ''' When a session's target crashes, the session is removed from the
+    connection, in-flight commands fail, and listeners reach the end of their
+    channel. '''
+    async def handler(request):
+        # It's tricky to catch exceptions from the server, so exceptions are
+        # logged instead.
+        try:
+            ws = await request.accept()
+            command = json.loads(await ws.get_message())
+            response = {'id': command['id'], 'result': {'sessionId': 'session1'}}
+            await ws.send_message(json.dumps(response))
+            # Wait for a command on the session, then crash instead of
+            # responding to it.
+            command = json.loads(await ws.get_message())
+            logging.info('Server received:  %r', command)
+            event = {
+                'method': 'Inspector.targetCrashed',
+                'sessionId': 'session1',
+                'params': {},
+            }
+            logging.info('Server sending:  %r', event)
+            await ws.send_message(json.dumps(event))
+            await ws.get_message()
+        except ConnectionClosed:
+            pass
+        except Exception:
+            logging.exception('Server exception')
+    server = await start_server(nursery, handler)
+
+    async with open_cdp(server) as conn:
+        session = await conn.connect_session(target.TargetID('target1'))
+        assert conn.session_count == 1
+        listener = session.listen(page.LoadEventFired)
+        with pytest.raises(CdpSessionClosed) as exc_info:
+            await session.execute(dom.query_selector(dom.NodeId(0), 'p'))
+        assert exc_info.value.reason == 'target crashed'
+        assert conn.session_count == 0
+        assert session.closed
+        with pytest.raises(trio.EndOfChannel):
+            await listener.receive()
+        with pytest.raises(CdpSessionClosed):
+            await session.execute(dom.query_selector(dom.NodeId(0), 'p'))
+
+
+@fail_after(1)
+async def test_pending_commands_fail_when_connection_closes(nursery):
+    ''' When the WebSocket closes, commands waiting for a response on the
+    connection and its sessions raise ``CdpConnectionClosed`` immediately, and
+    listeners reach the end of their channels. '''
+    async def handler(request):
+        # It's tricky to catch exceptions from the server, so exceptions are
+        # logged instead.
+        try:
+            ws = await request.accept()
+            command = json.loads(await ws.get_message())
+            response = {'id': command['id'], 'result': {'sessionId': 'session1'}}
+            await ws.send_message(json.dumps(response))
+            # Receive one command on the connection and one on the session, then
+            # close the connection without responding.
+            for _ in range(2):
+                command = json.loads(await ws.get_message())
+                logging.info('Server received:  %r', command)
+            await ws.aclose()
+        except Exception:
+            logging.exception('Server exception')
+    server = await start_server(nursery, handler)
+
+    async with open_cdp(server) as conn:
+        session = await conn.connect_session(target.TargetID('target1'))
+        conn_listener = conn.listen(page.LoadEventFired)
+        all_listener = conn.listen_all(page.LoadEventFired)
+        errors = list()
+
+        async def execute(cdp_base):
+            try:
+                await cdp_base.execute(dom.query_selector(dom.NodeId(0), 'p'))
+            except CdpConnectionClosed as cdp_closed:
+                errors.append(cdp_closed)
+
+        async with trio.open_nursery() as inner:
+            inner.start_soon(execute, conn)
+            inner.start_soon(execute, session)
+
+        assert len(errors) == 2
+        assert conn.closed
+        assert session.closed
+        assert conn.session_count == 0
+        assert conn.teardown_stats.commands == 2
+        assert conn.teardown_stats.sessions == 1
+        assert conn.teardown_stats.channels == 2
+        for listener in (conn_listener, all_listener):
+            with pytest.raises(trio.EndOfChannel):
+                await listener.receive()
+        with pytest.raises(CdpConnectionClosed):
+            await session.execute(dom.query_selector(dom.NodeId(0), 'p'))
+        # The session's own error is not replaced by the connection's.
+        assert isinstance(session._closed_error(), CdpSessionClosed)
+        with pytest.raises(CdpConnectionClosed):
+            conn.listen(page.LoadEventFired)
@@ -0,0 +1,122 @@
+import cdp
+import pytest
+import trio
+from trio.testing import wait_all_tasks_blocked
+from trio_websocket import ConnectionClosed
+
+from . import fail_after
+from .fake_browser import FakeBrowser
+from trio_cdp import open_cdp
+from trio_cdp.writer import (CommandWriter, FlushPolicy, Priority,
+    method_priority)
+
+
+class RecordingTransport:
+    def __init__(self):
+        self.messages = list()
+        self.closed = None
+
+    async def send_message(self, message):
+        await trio.sleep(0)
+        self.messages.append(message)
+
+
+class BatchingTransport(RecordingTransport):
+    def __init__(self):
+        super().__init__()
+        self.batches = list()
+
+    async def send_messages(self, messages):
+        await trio.sleep(0)
+        self.batches.append(messages)
+
+
+class FakeConnection:
+    def __init__(self):
+        self.transport = RecordingTransport()
+
+
+def test_method_priority():
+    assert method_priority('Input.dispatchMouseEvent') == Priority.INTERACTIVE
+    assert method_priority('Page.navigate') == Priority.INTERACTIVE
+    assert method_priority('Page.captureScreenshot') == Priority.BULK
+    assert method_priority('DOM.getDocument') == Priority.NORMAL
+
+
+@fail_after(1)
+async def test_writer_priority_and_fairness(nursery):
+    ''' Urgent lanes are sent first, and sessions take turns within a lane. '''
+    conn = FakeConnection()
+    writer = CommandWriter(conn)
+    for message, priority, key in [
+            ('bulk', Priority.BULK, 'a'),
+            ('a1', Priority.NORMAL, 'a'),
+            ('a2', Priority.NORMAL, 'a'),
+            ('a3', Priority.NORMAL, 'a'),
+            ('b1', Priority.NORMAL, 'b'),
+            ('input', Priority.INTERACTIVE, 'b')]:
+        nursery.start_soon(writer.send, message, priority, key)
+        await wait_all_tasks_blocked()
+    assert writer.stats()[Priority.NORMAL].queued == 4
+
+    nursery.start_soon(writer.run)
+    while len(conn.transport.messages) < 6:
+        await trio.sleep(0.01)
+    assert conn.transport.messages == ['input', 'a1', 'b1', 'a2', 'a3', 'bulk']
+    stats = writer.stats()
+    assert [lane.sent for lane in stats] == [1, 4, 1]
+    assert all(lane.queued == 0 for lane in stats)
+
+    writer.close()
+    with pytest.raises(ConnectionClosed):
+        await writer.send('late')
+
+
+async def test_writer_promotes_waiting_messages(nursery, mock_clock):
+    ''' Messages that wait too long are sent ahead of more urgent ones, so a
+    steady stream of urgent messages cannot starve the other lanes. '''
+    for promote_after, expected in [(1, ['n1', 'bulk', 'n2']),
+            (None, ['n1', 'n2', 'bulk'])]:
+        conn = FakeConnection()
+        writer = CommandWriter(conn, FlushPolicy(promote_after=promote_after))
+        nursery.start_soon(writer.send, 'bulk', Priority.BULK)
+        nursery.start_soon(writer.send, 'n1', Priority.NORMAL)
+        await wait_all_tasks_blocked()
+        mock_clock.jump(2)
+        nursery.start_soon(writer.send, 'n2', Priority.NORMAL)
+        await wait_all_tasks_blocked()
+        nursery.start_soon(writer.run)
+        await wait_all_tasks_blocked()
+        assert conn.transport.messages == expected
+        writer.close()
+
+
+@fail_after(1)
+async def test_writer_batches(nursery):
+    ''' Messages queued by tasks that run in the same tick are written in one
+    batch, up to ``max_batch`` messages. '''
+    conn = FakeConnection()
+    conn.transport = BatchingTransport()
+    writer = CommandWriter(conn, FlushPolicy(max_batch=4))
+    nursery.start_soon(writer.run)
+    async with trio.open_nursery() as senders:
+        for index in range(6):
+            senders.start_soon(writer.send, str(index))
+    assert [len(batch) for batch in conn.transport.batches] == [4, 2]
+    assert writer.batches == 2
+    assert writer.messages == 6
+    writer.close()
+
+
+@fail_after(1)
+async def test_connection_uses_writer(nursery):
+    ''' Commands on a connection and its sessions go through the writer. '''
+    browser = FakeBrowser()
+    server = await browser.start(nursery)
+    async with open_cdp(server) as conn:
+        session = await conn.connect_session(cdp.target.TargetID('target1'))
+        await session.execute(cdp.page.navigate('https://example.com'))
+        await session.execute(cdp.page.navigate('https://example.com'),
+            priority=Priority.BULK)
+        stats = conn.writer_stats()
+        assert [lane.sent for lane in stats] == [1, 1, 1]
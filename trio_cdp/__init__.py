@@ -1,12 +1,14 @@
 from __future__ import annotations
-from collections import defaultdict
+import abc
+from collections import defaultdict, deque
 from contextlib import asynccontextmanager
 from dataclasses import dataclass
 import functools
 import itertools
-import json
 import logging
+import time
 import typing
+import weakref
 
 import cdp
 import trio # type: ignore
@@ -16,7 +18,22 @@ from trio_websocket import ( # type: ignore
     open_websocket_url
 )
 
+from .channels import (
+    BroadcastReceiveChannel,
+    BroadcastRing,
+    EventReceiveChannel,
+    open_event_channel
+)
+from .codec import Codec, get_codec
 from .context import connection_context, session_context
+from .hooks import HookInfo, Hooks, call_hooks
+from .limits import CommandLimits, ConcurrencyLimit, LimitStats
+from .metrics import Metrics, MetricsSnapshot
+from .profiling import ReaderProfile
+from .targets import TargetRegistry
+from .transport import open_pipe_process
+from .writer import (CommandWriter, FlushPolicy, LaneStats, Priority,
+    method_priority)
 from .generated import *
 
 
@@ -24,6 +41,30 @@ logger = logging.getLogger('trio_cdp')
 T = typing.TypeVar('T')
 MAX_WS_MESSAGE_SIZE = 2**24
 
+# Maps a CDP method name like "Page.loadEventFired" to its PyCDP event class. PyCDP
+# registers every event class here when its module is imported.
+_EVENT_TYPES: typing.Dict[str, type] = cdp.util._event_parsers
+
+# Events that cause a session to be removed from its connection.
+_LIFECYCLE_EVENTS = frozenset((
+    'Inspector.detached',
+    'Inspector.targetCrashed',
+    'Target.detachedFromTarget',
+    'Target.targetDestroyed',
+))
+
+# Every CdpConnection that has not been garbage collected, see open_connections().
+_connections: 'weakref.WeakSet[CdpConnection]' = weakref.WeakSet()
+_connection_ids = itertools.count(1)
+
+# Events that update a connection's target registry when auto-attach is enabled.
+_TARGET_EVENTS = frozenset((
+    'Target.attachedToTarget',
+    'Target.targetCreated',
+    'Target.targetDestroyed',
+    'Target.targetInfoChanged',
+))
+
 
 class BrowserError(Exception):
     ''' This exception is raised when the browser's response to a command
@@ -53,6 +94,24 @@ class CdpConnectionClosed(WsConnectionClosed):
         return '{}<{}>'.format(self.__class__.__name__, self.reason)
 
 
+class CdpSessionClosed(Exception):
+    ''' Raised when a command is executed on a session that has been detached,
+    or when a session is detached while a command is waiting for a response. '''
+    def __init__(self, session_id, reason):
+        '''
+        Constructor.
+
+        :param cdp.target.SessionID session_id:
+        :param str reason: why the session was closed
+        '''
+        super().__init__(session_id, reason)
+        self.session_id = session_id
+        self.reason = reason
+
+    def __str__(self):
+        return 'Session {} closed: {}'.format(self.session_id, self.reason)
+
+
 class InternalError(Exception):
     ''' This exception is only raised when there is faulty logic in TrioCDP or
     the integration with PyCDP. '''
@@ -66,55 +125,444 @@ class CmEventProxy:
     value: typing.Any = None
 
 
-class CdpBase:
+class PendingCommand:
+    '''
+    The state of a command that has been sent to the browser and is waiting for a
+    response.
+
+    The reader task resolves the command with either a result or an error, and
+    the task that executed the command waits for it to be resolved.
+    '''
+    __slots__ = ('cmd', 'request', 'permits', 'sent_at', 'size', 'done', 'error',
+        'result', '_event')
+
+    def __init__(self, cmd):
+        self.cmd = cmd
+        #: The request that was sent, as a JSON dictionary.
+        self.request: typing.Optional[dict] = None
+        #: The concurrency limits held by the command, see
+        #: :mod:`trio_cdp.limits`.
+        self.permits: typing.Tuple[ConcurrencyLimit, ...] = ()
+        #: When the command was sent, from ``time.perf_counter()``, and the size
+        #: of its request.
+        self.sent_at = 0.0
+        self.size = 0
+        self.done = False
+        self.error: typing.Optional[Exception] = None
+        self.result: typing.Any = None
+        self._event = trio.Event()
+
+    def set_result(self, result):
+        ''' Resolve the command with a result. '''
+        self.result = result
+        self._resolve()
+
+    def set_error(self, error: Exception):
+        ''' Resolve the command with an exception. '''
+        self.error = error
+        self._resolve()
+
+    def _resolve(self):
+        # The command is no longer outstanding, so its concurrency limits are
+        # released now rather than when the caller collects the result. A caller
+        # that sends more commands than a limit allows before collecting any
+        # results, like execute_many(), would otherwise wait forever.
+        self.done = True
+        if self.permits:
+            CommandLimits.release(self.permits)
+            self.permits = ()
+        self._event.set()
+
+    async def wait(self):
+        ''' Wait for the command to be resolved and return its result or raise
+        its error. '''
+        await self._event.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+def _channel_dropped(receiver) -> int:
+    ''' Return the number of events that a registered channel has dropped. A
+    broadcast ring counts the events dropped by each of its listeners. '''
+    if isinstance(receiver, BroadcastRing):
+        return receiver.released_dropped + sum(listener.statistics().dropped
+            for listener in receiver.listeners)
+    return receiver.statistics().dropped
+
+
+def _end_channels(channels: typing.Dict[type, set],
+        metrics: typing.Optional[Metrics] = None) -> int:
+    '''
+    End every channel in ``channels``, clear it, and return the number of
+    channels that were ended.
+
+    If ``metrics`` is given, the events dropped by the channels are added to its
+    running total.
+    '''
+    ended = set()
+    for receivers in channels.values():
+        for receiver in receivers:
+            if receiver not in ended:
+                receiver.end()
+                ended.add(receiver)
+                if metrics is not None:
+                    metrics.dropped_events += _channel_dropped(receiver)
+    channels.clear()
+    return len(ended)
+
+
+@dataclass
+class TeardownStats:
+    ''' Describes the cleanup that happened when a connection closed. '''
+    #: The number of sessions that were closed.
+    sessions: int
+    #: The number of in-flight commands that failed with
+    #: :class:`CdpConnectionClosed`.
+    commands: int
+    #: The number of listener channels that were ended.
+    channels: int
+
+
+class CdpBase(abc.ABC):
     '''
     Contains shared functionality between the CDP connection and session.
     '''
-    def __init__(self, ws, session_id, target_id):
+    def __init__(self, transport, session_id, target_id, codec=None):
         self.channels = defaultdict(set)
+        # Channels that receive ``(session, event)`` tuples from every session on a
+        # connection. See :meth:`CdpConnection.listen_all`.
+        self._shared_channels: typing.Dict[type, set] = dict()
+        self._broadcasts: typing.Dict[typing.FrozenSet[type], BroadcastRing] = \
+            dict()
+        self.codec = get_codec(codec)
         self.id_iter = itertools.count()
-        self.inflight_cmd = dict()
-        self.inflight_result = dict()
+        self.inflight: typing.Dict[int, PendingCommand] = dict()
+        #: The number of commands whose caller was cancelled before the response
+        #: arrived.
+        self.abandoned_commands = 0
+        #: The number of responses that arrived after their command was abandoned.
+        #: These responses are discarded.
+        self.late_responses = 0
+        self._cmd_id_limit = 0
+        # Abandoned commands that hold concurrency permits, see
+        # :meth:`_abandon_command`.
+        self._abandoned: typing.Dict[int, PendingCommand] = dict()
+        self._closed_reason: typing.Optional[str] = None
+        self._closed_error_factory: typing.Optional[
+            typing.Callable[[], Exception]] = None
         self.session_id = session_id
         self.target_id = target_id
-        self.ws = ws
+        self.transport = transport
+        # Records state to restore after a reconnect. Only set on resilient
+        # connections and their sessions, see :mod:`trio_cdp.resilient`.
+        self._replay = None
+        # Shared by a connection and its sessions once the connection's tasks
+        # are started. Without it, commands are written directly.
+        self._writer: typing.Optional[CommandWriter] = None
+        # Set by :meth:`CdpConnection.set_limits`.
+        self._limits: typing.Optional[CommandLimits] = None
+        #: Command and event counters, shared by a connection and its sessions.
+        self.metrics: typing.Optional[Metrics] = None
+        #: Instrumentation hooks, shared by a connection and its sessions. See
+        #: :mod:`trio_cdp.hooks`.
+        self.hooks = Hooks()
+        # Set by :meth:`CdpConnection.enable_profiling`.
+        self._profile: typing.Optional[ReaderProfile] = None
 
-    async def execute(self, cmd: typing.Generator[dict,T,typing.Any]) -> T:
+    @property
+    def ws(self):
+        ''' The transport. This name is kept for compatibility with older
+        versions, where the transport was always a WebSocket. '''
+        return self.transport
+
+    async def execute(self, cmd: typing.Generator[dict,T,typing.Any],
+            priority: typing.Optional[Priority] = None) -> T:
         '''
         Execute a command on the server and wait for the result.
 
         :param cmd: any CDP command
+        :param priority: when several commands are waiting to be sent, more
+            urgent ones are sent first. The default depends on the command, see
+            :func:`trio_cdp.writer.method_priority`.
         :returns: a CDP result
         '''
-        cmd_id = next(self.id_iter)
-        cmd_event = trio.Event()
-        self.inflight_cmd[cmd_id] = cmd, cmd_event
+        cmd_id, pending = await self._send_command(cmd, priority, limit=True)
+        try:
+            return await pending.wait()
+        finally:
+            if not pending.done:
+                self._abandon_command(cmd_id)
+
+    async def execute_many(self, cmds: typing.Iterable[typing.Generator[dict,
+            typing.Any, typing.Any]], window: typing.Optional[int] = None,
+            priority: typing.Optional[Priority] = None) -> \
+            typing.List[typing.Any]:
+        '''
+        Execute several independent commands and return their results in the
+        same order as the commands.
+
+        The requests are written back to back without waiting for responses, so
+        the whole batch costs roughly one round trip instead of one round trip per
+        command. If the browser reports an error for a command, then the
+        :class:`BrowserError` is placed in the results list instead of being raised,
+        and the remaining commands are unaffected.
+
+        :param cmds: an iterable of CDP commands
+        :param window: if set, at most this many commands from the batch are
+            outstanding at once. A new command is sent each time the oldest
+            outstanding command completes.
+        :param priority: the priority of every command in the batch, as in
+            :meth:`execute`
+        :returns: a list containing a CDP result or a :class:`BrowserError` for
+            each command
+        '''
+        if window is not None and window < 1:
+            raise ValueError('window must be at least 1')
+        cmds = iter(cmds)
+        results: typing.List[typing.Any] = list()
+        pending: typing.Deque[typing.Tuple[int, PendingCommand]] = deque()
+        try:
+            for cmd in cmds:
+                pending.append(await self._send_command(cmd, priority,
+                    limit=True))
+                if window is not None and len(pending) >= window:
+                    results.append(await self._wait_captured(*pending.popleft()))
+            while pending:
+                results.append(await self._wait_captured(*pending.popleft()))
+        finally:
+            # If the batch is interrupted, abandon the commands that are still
+            # outstanding so that their responses are discarded.
+            for cmd_id, pending_cmd in pending:
+                if not pending_cmd.done:
+                    self._abandon_command(cmd_id)
+        return results
+
+    def limit_stats(self) -> typing.List[LimitStats]:
+        '''
+        Return a snapshot of the concurrency limits that apply to this session's
+        commands: the method and domain limits, then the session limit, then the
+        connection limit. See :meth:`CdpConnection.set_limits`.
+        '''
+        return self._limits.stats() if self._limits is not None else []
+
+    async def _send_command(self, cmd, priority=None, limit=False) -> \
+            typing.Tuple[int, PendingCommand]:
+        '''
+        Register a command as in flight and send its request.
+
+        :param cmd: any CDP command
+        :param priority: see :meth:`execute`
+        :param limit: if true, wait for the concurrency limits first. The caller
+            must release the command's permits when it is done with it.
+        :returns: the command ID and its pending state
+        '''
+        if self._replay is None:
+            return await self._write_command(cmd, priority, limit)
+        # Wait while a resilient connection is reconnecting, then record any
+        # state that must be restored after the next reconnect.
+        await self._replay.wait_ready()
+        cmd_id, pending = await self._write_command(cmd, priority, limit)
+        self._replay.record(pending.request)
+        return cmd_id, pending
+
+    async def _write_command(self, cmd, priority=None, limit=False) -> \
+            typing.Tuple[int, PendingCommand]:
+        ''' Implements :meth:`_send_command`. '''
+        if self._closed_reason is not None:
+            raise self._closed_exception()
         request = next(cmd)
+        if self._replay is not None:
+            self._replay.prepare(request)
+        permits: typing.Tuple[ConcurrencyLimit, ...] = ()
+        if limit and self._limits is not None:
+            permits = await self._limits.acquire(request['method'])
+            if self._closed_reason is not None:
+                CommandLimits.release(permits)
+                raise self._closed_exception()
+        cmd_id = next(self.id_iter)
+        self._cmd_id_limit = cmd_id + 1
+        pending = PendingCommand(cmd)
+        pending.permits = permits
+        self.inflight[cmd_id] = pending
         request['id'] = cmd_id
         if self.session_id:
             request['sessionId'] = self.session_id
+        pending.request = request
         logger.debug('Sending command %r', request)
-        request_str = json.dumps(request)
+        request_str = self.codec.dumps(request)
+        pending.size = len(request_str)
+        pending.sent_at = time.perf_counter()
+        hooks = self.hooks
+        if hooks.pre_send:
+            call_hooks(hooks.pre_send, HookInfo('pre_send', request['method'],
+                self.session_id, cmd_id, pending.sent_at, size=pending.size),
+                request)
         try:
-            await self.ws.send_message(request_str)
+            await self._send_request(request_str, request['method'], priority)
         except WsConnectionClosed as wcc:
-            raise CdpConnectionClosed(wcc.reason) from None
-        await cmd_event.wait()
-        response = self.inflight_result.pop(cmd_id)
-        if isinstance(response, Exception):
-            raise response
-        return response
-
-    def listen(self, *event_types, buffer_size=10):
-        ''' Return an async iterator that iterates over events matching the
-        indicated types. '''
-        sender, receiver = trio.open_memory_channel(buffer_size)
+            self.inflight.pop(cmd_id, None)
+            self._release_permits(pending)
+            error = CdpConnectionClosed(wcc.reason)
+            if hooks.on_error:
+                now = time.perf_counter()
+                call_hooks(hooks.on_error, HookInfo('on_error',
+                    request['method'], self.session_id, cmd_id, now,
+                    now - pending.sent_at, error=error), request)
+            raise error from None
+        except BaseException:
+            # The request was probably not written, so there is nothing for the
+            # browser to work on.
+            self._release_permits(pending)
+            self._abandon_command(cmd_id)
+            raise
+        return cmd_id, pending
+
+    async def _send_request(self, message: typing.Union[str, bytes],
+            method: str, priority: typing.Optional[Priority] = None):
+        '''
+        Write a serialized request, through the writer task if there is one.
+
+        :param message: the serialized request
+        :param method: the request's method, which chooses the default priority
+        :param priority: see :meth:`execute`
+        '''
+        if self._writer is None:
+            await self.transport.send_message(message)
+        else:
+            if priority is None:
+                priority = method_priority(method)
+            await self._writer.send(message, priority, self.session_id)
+
+    @staticmethod
+    def _release_permits(pending: PendingCommand):
+        ''' Release the concurrency limits held by a command. '''
+        CommandLimits.release(pending.permits)
+        pending.permits = ()
+
+    async def _wait_captured(self, cmd_id, pending):
+        ''' Wait for a command's response and return it. Browser errors are
+        returned instead of raised. '''
+        try:
+            return await pending.wait()
+        except BrowserError as be:
+            return be
+        finally:
+            if not pending.done:
+                self._abandon_command(cmd_id)
+
+    @property
+    def closed(self) -> bool:
+        ''' True if this session or connection has been closed. '''
+        return self._closed_reason is not None
+
+    def _close(self, reason: str, closed_error: typing.Optional[
+            typing.Callable[[], Exception]] = None) -> typing.Tuple[int, int]:
+        '''
+        Mark this object as closed: fail every in-flight command and end every
+        listener channel. This does not send anything to the browser.
+
+        :param reason: a description of why it was closed
+        :param closed_error: a function that returns the exception for in-flight
+            and future commands. Defaults to :meth:`_closed_error`.
+        :returns: the number of commands failed and channels ended
+        '''
+        if self._closed_reason is not None:
+            return 0, 0
+        self._closed_reason = reason
+        self._closed_error_factory = closed_error
+        inflight = self.inflight
+        self.inflight = dict()
+        for cmd_id, pending in inflight.items():
+            self._fail_command(cmd_id, pending, self._closed_exception())
+        self._release_abandoned()
+        ended = _end_channels(self.channels, self.metrics)
+        self._broadcasts.clear()
+        return len(inflight), ended
+
+    def _fail_command(self, cmd_id: int, pending: PendingCommand,
+            error: Exception):
+        ''' Fail an in-flight command that will never get a response, and call
+        the ``on_error`` hooks for it. '''
+        if self.hooks.on_error and pending.request is not None:
+            now = time.perf_counter()
+            call_hooks(self.hooks.on_error, HookInfo('on_error',
+                pending.request['method'], self.session_id, cmd_id, now,
+                now - pending.sent_at, error=error), pending.request)
+        pending.set_error(error)
+
+    @abc.abstractmethod
+    def _closed_error(self) -> Exception:
+        ''' Return the exception raised by commands after :meth:`_close`. '''
+
+    def _closed_exception(self) -> Exception:
+        ''' Return the exception for commands after :meth:`_close`, from the
+        ``closed_error`` function passed to it if there was one. '''
+        if self._closed_error_factory is not None:
+            return self._closed_error_factory()
+        return self._closed_error()
+
+    def _abandon_command(self, cmd_id):
+        '''
+        Forget a command whose caller stopped waiting for it. A response that
+        arrives later is discarded.
+
+        The browser is still working on the command, so it keeps its
+        concurrency permits until its response arrives or this session or
+        connection closes.
+        '''
+        pending = self.inflight.pop(cmd_id, None)
+        if pending is not None:
+            self.abandoned_commands += 1
+            if pending.permits:
+                self._abandoned[cmd_id] = pending
+
+    def _release_abandoned(self):
+        ''' Release the permits of abandoned commands that will never get a
+        response. '''
+        for pending in self._abandoned.values():
+            self._release_permits(pending)
+        self._abandoned.clear()
+
+    def listen(self, *event_types, buffer_size=10, policy='drop-newest',
+            key=None) -> typing.Union[EventReceiveChannel,
+            BroadcastReceiveChannel]:
+        '''
+        Return an async iterator that iterates over events matching the
+        indicated types.
+
+        :param buffer_size: the number of events to buffer in memory
+        :param policy: what to do when the buffer is full, see
+            :mod:`trio_cdp.channels`. The ``broadcast`` policy shares a single
+            ring buffer among all broadcast listeners for the same event types.
+        :param key: for the ``coalesce`` policy, a function that maps an event to
+            the key that it is coalesced by
+        '''
+        if self.closed:
+            raise self._closed_exception()
+        if policy == 'broadcast':
+            return self._listen_broadcast(event_types, buffer_size)
+        receiver = open_event_channel(buffer_size, policy, key)
         for event_type in event_types:
-            self.channels[event_type].add(sender)
+            self.channels[event_type].add(receiver)
         return receiver
 
+    def _listen_broadcast(self, event_types, buffer_size) -> \
+            BroadcastReceiveChannel:
+        ''' Return a receiver on the shared broadcast ring for these event
+        types, creating the ring if needed. '''
+        ring_key = frozenset(event_types)
+        ring = self._broadcasts.get(ring_key)
+        if ring is None or ring.closed or ring.size != buffer_size:
+            ring = BroadcastRing(buffer_size)
+            self._broadcasts[ring_key] = ring
+            for event_type in event_types:
+                self.channels[event_type].add(ring)
+        return ring.open_receiver()
+
     @asynccontextmanager
-    async def wait_for(self, event_type: typing.Type[T], buffer_size=10) -> \
+    async def wait_for(self, event_type: typing.Type[T], buffer_size=10,
+            policy='drop-newest', key=None) -> \
             typing.AsyncGenerator[CmEventProxy, None]:
         '''
         Wait for an event of the given type and return it.
@@ -122,75 +570,150 @@ class CdpBase:
         This is an async context manager, so you should open it inside an async
         with block. The block will not exit until the indicated event is
         received.
+
+        The ``buffer_size``, ``policy``, and ``key`` arguments are the same as
+        for :meth:`listen`, except that the ``broadcast`` policy is not
+        supported.
         '''
-        sender, receiver = trio.open_memory_channel(buffer_size)
-        self.channels[event_type].add(sender)
+        if self.closed:
+            raise self._closed_exception()
+        receiver = open_event_channel(buffer_size, policy, key)
+        self.channels[event_type].add(receiver)
         proxy = CmEventProxy()
         yield proxy
         async with receiver:
             event = await receiver.receive()
         proxy.value = event
 
-    def _handle_data(self, data):
+    async def _handle_data(self, data, size=0):
         '''
         Handle incoming WebSocket data.
 
         :param dict data: a JSON dictionary
+        :param int size: the size of the message, for metrics
         '''
         if 'id' in data:
-            self._handle_cmd_response(data)
+            self._handle_cmd_response(data, size)
         else:
-            self._handle_event(data)
+            if self.metrics is not None:
+                self.metrics.record_event(data['method'], size)
+            if self.hooks.on_event:
+                call_hooks(self.hooks.on_event, HookInfo('on_event',
+                    data['method'], self.session_id, time=time.perf_counter(),
+                    size=size), data)
+            await self._handle_event(data)
 
-    def _handle_cmd_response(self, data):
+    def _handle_cmd_response(self, data, size=0):
         '''
         Handle a response to a command. This will set an event flag that will
         return control to the task that called the command.
 
         :param dict data: response as a JSON dictionary
+        :param int size: the size of the message, for metrics
         '''
         cmd_id = data['id']
         try:
-            cmd, event = self.inflight_cmd.pop(cmd_id)
+            pending = self.inflight.pop(cmd_id)
         except KeyError:
-            logger.warning('Got a message with a command ID that does'
-                ' not exist: {}'.format(data))
+            abandoned = self._abandoned.pop(cmd_id, None)
+            if abandoned is not None:
+                self._release_permits(abandoned)
+            if isinstance(cmd_id, int) and 0 <= cmd_id < self._cmd_id_limit:
+                # The caller was cancelled before the response arrived.
+                self.late_responses += 1
+                logger.debug('Discarding late response to abandoned command %d',
+                    cmd_id)
+            else:
+                logger.warning('Got a message with a command ID that does'
+                    ' not exist: {}'.format(data))
             return
+        now = time.perf_counter()
+        method = pending.request['method']
+        if self.metrics is not None:
+            self.metrics.record_command(method, now - pending.sent_at,
+                pending.size, size, 'error' in data)
+        hooks = self.hooks
         if 'error' in data:
             # If the server reported an error, convert it to an exception and do
             # not process the response any further.
-            self.inflight_result[cmd_id] = BrowserError(data['error'])
+            error = BrowserError(data['error'])
+            if hooks.on_error:
+                call_hooks(hooks.on_error, HookInfo('on_error', method,
+                    self.session_id, cmd_id, now, now - pending.sent_at, size,
+                    error), data)
+            pending.set_error(error)
         else:
             # Otherwise, continue the generator to parse the JSON result
             # into a CDP object.
+            if self._replay is not None:
+                self._replay.record_result(pending.request, data['result'])
             try:
-                response = cmd.send(data['result'])
+                response = pending.cmd.send(data['result'])
                 raise InternalError("The command's generator function "
                     "did not exit when expected!")
             except StopIteration as exit:
                 return_ = exit.value
-            self.inflight_result[cmd_id] = return_
-        event.set()
+            pending.set_result(return_)
+            if hooks.post_response:
+                call_hooks(hooks.post_response, HookInfo('post_response', method,
+                    self.session_id, cmd_id, now, now - pending.sent_at, size),
+                    data)
 
-    def _handle_event(self, data):
+    async def _handle_event(self, data):
         '''
         Handle an event.
 
+        The event type is looked up from the raw method name, and the event is
+        only parsed into a PyCDP object if at least one channel is listening for
+        it. Events that nobody listens to are discarded without being parsed.
+
         :param dict data: event as a JSON dictionary
         '''
-        event = cdp.util.parse_json_event(data)
+        event_type = _EVENT_TYPES.get(data['method'])
+        receivers = self.channels.get(event_type)
+        shared_receivers = self._shared_channels.get(event_type)
+        if not receivers and not shared_receivers:
+            return
+        profile = self._profile
+        if profile is not None and profile.sampling:
+            start = time.perf_counter()
+            event = event_type.from_json(data['params'])
+            profile.parse_time += time.perf_counter() - start
+        else:
+            event = event_type.from_json(data['params'])
         logger.debug('Received event: %s', event)
+        if receivers:
+            await self._dispatch_event(self.channels, event_type, event)
+        if shared_receivers:
+            await self._dispatch_event(self._shared_channels, event_type,
+                (self, event))
+
+    async def _dispatch_event(self, channels, event_type, item):
+        '''
+        Offer an item to every channel in ``channels`` that is listening for
+        ``event_type``, and remove channels that have been closed.
+        '''
+        receivers = channels[event_type]
         to_remove = set()
-        for sender in self.channels[type(event)]:
-            try:
-                sender.send_nowait(event)
-            except trio.WouldBlock:
-                logger.error('Unable to send event "%r" due to full channel %s',
-                    event, sender)
-            except trio.BrokenResourceError:
-                to_remove.add(sender)
+        for receiver in list(receivers):
+            if receiver.closed:
+                to_remove.add(receiver)
+            elif not receiver.offer(item):
+                # The channel's policy is to block the reader until there is room.
+                await receiver.put(item)
         if to_remove:
-            self.channels[type(event)] -= to_remove
+            receivers -= to_remove
+            if not receivers:
+                del channels[event_type]
+            if self.metrics is not None:
+                # Keep the drops of removed channels in the running total. A
+                # channel that listens for several event types is counted once
+                # it is gone from all of them.
+                for receiver in to_remove:
+                    if not any(receiver in others for others in
+                            channels.values()):
+                        self.metrics.dropped_events += _channel_dropped(
+                            receiver)
 
 
 class CdpConnection(CdpBase, trio.abc.AsyncResource):
@@ -206,27 +729,196 @@ class CdpConnection(CdpBase, trio.abc.AsyncResource):
     You should generally call the :func:`open_cdp()` instead of
     instantiating this class directly.
     '''
-    def __init__(self, ws):
+    def __init__(self, transport, codec=None):
         '''
         Constructor
 
-        :param trio_websocket.WebSocketConnection ws:
+        :param transport: a ``trio_websocket.WebSocketConnection`` or another
+            transport, see :mod:`trio_cdp.transport`
+        :param codec: a codec name or instance, see :func:`trio_cdp.codec.get_codec`
         '''
-        super().__init__(ws, session_id=None, target_id=None)
+        super().__init__(transport, session_id=None, target_id=None, codec=codec)
         self.sessions = dict()
+        self.metrics = Metrics()
+        #: Set when the connection closes. Describes what was cleaned up.
+        self.teardown_stats: typing.Optional[TeardownStats] = None
+        self.session_channels: typing.DefaultDict[type, set] = defaultdict(set)
+        #: Set by :meth:`auto_attach`.
+        self.targets: typing.Optional[TargetRegistry] = None
+        # The arguments of the last call to set_limits().
+        self._limit_config: typing.Optional[tuple] = None
+        self._wait_for_debugger = False
+        #: The name of this connection in exported metrics, see
+        #: :mod:`trio_cdp.exporter`. It may be changed, e.g. to the browser's
+        #: address.
+        self.label = 'cdp{}'.format(next(_connection_ids))
+        _connections.add(self)
 
     async def aclose(self):
         '''
-        Close the underlying WebSocket connection.
+        Close the underlying transport, e.g. the WebSocket connection.
 
         This will cause the reader task to gracefully exit when it tries to read
-        the next message from the WebSocket. All of the public APIs
+        the next message from the transport. All of the public APIs
         (``execute()``, ``listen()``, etc.) will raise
         ``CdpConnectionClosed`` after the CDP connection is closed.
 
         It is safe to call this multiple times.
         '''
-        await self.ws.aclose()
+        await self.transport.aclose()
+        self._teardown()
+
+    def _closed_error(self):
+        return CdpConnectionClosed(self.transport.closed)
+
+    def _start(self, nursery, flush_policy: typing.Optional[FlushPolicy] = None):
+        ''' Start the connection's reader and writer tasks. '''
+        self._writer = CommandWriter(self, flush_policy)
+        nursery.start_soon(self._writer.run)
+        nursery.start_soon(self._reader_task)
+
+    def set_limits(self, connection: typing.Optional[int] = None,
+            session: typing.Optional[int] = None,
+            methods: typing.Optional[typing.Mapping[str, int]] = None):
+        '''
+        Cap the number of commands sent with ``execute()`` or ``execute_many()``
+        that are waiting for a response. Commands over a cap wait until an earlier
+        command finishes.
+
+        The new limits apply to the root session, to every open session, and to
+        sessions opened later. Commands that are already outstanding keep their
+        old limits. Call this with no arguments to remove every limit.
+
+        :param connection: the cap for the connection and all of its sessions
+            together
+        :param session: the cap for each session, including the root session
+        :param methods: caps by method name, e.g. ``{'Page.captureScreenshot':
+            2}``, or by domain name, e.g. ``{'Runtime': 10}``. Like the
+            ``connection`` cap, each of these is shared by the connection and all
+            of its sessions.
+        '''
+        if connection is None and session is None and not methods:
+            self._limit_config = None
+            self._limits = None
+            for cdp_session in self.sessions.values():
+                cdp_session._limits = None
+            return
+        shared = ConcurrencyLimit('connection', connection) \
+            if connection is not None else None
+        method_limits = {name: ConcurrencyLimit(name, cap)
+            for name, cap in (methods or {}).items()}
+        self._limit_config = (shared, session, method_limits)
+        self._limits = self._make_limits()
+        for cdp_session in self.sessions.values():
+            cdp_session._limits = self._make_limits()
+
+    def _make_limits(self) -> typing.Optional[CommandLimits]:
+        ''' Create the limits for one session from the current config. '''
+        if self._limit_config is None:
+            return None
+        shared, session, method_limits = self._limit_config
+        return CommandLimits(ConcurrencyLimit('session', session)
+            if session is not None else None, shared, method_limits)
+
+    def metrics_snapshot(self) -> MetricsSnapshot:
+        '''
+        Return a copy of the command and event counters for this connection and
+        its sessions, along with the current in-flight commands, sessions, and
+        listener channels.
+        '''
+        bases = [self, *self.sessions.values()]
+        receivers = set()
+        for base in bases:
+            for channels in base.channels.values():
+                receivers.update(channels)
+        for channels in self.session_channels.values():
+            receivers.update(channels)
+        dropped_total = self.metrics.dropped_events + sum(
+            _channel_dropped(receiver) for receiver in receivers)
+        # A broadcast ring is registered like a channel, but each of its
+        # listeners is a channel with its own counters.
+        for ring in [r for r in receivers if isinstance(r, BroadcastRing)]:
+            receivers.discard(ring)
+            receivers.update(ring.listeners)
+        queued = dropped = 0
+        for receiver in receivers:
+            stats = receiver.statistics()
+            queued += stats.queued
+            dropped += stats.dropped
+        return self.metrics.snapshot(
+            in_flight=sum(len(base.inflight) for base in bases),
+            sessions=len(self.sessions),
+            channels=len(receivers),
+            queued_events=queued,
+            dropped_events=dropped,
+            dropped_events_total=dropped_total)
+
+    @property
+    def profile(self) -> typing.Optional[ReaderProfile]:
+        ''' The reader task's profile, or ``None`` if profiling is disabled. '''
+        return self._profile
+
+    def enable_profiling(self, sample_every: int = 1) -> ReaderProfile:
+        '''
+        Start profiling the reader task. See :mod:`trio_cdp.profiling`.
+
+        If profiling is already enabled, the existing profile is kept and its
+        sampling rate is updated.
+
+        :param sample_every: profile one message out of this many
+        :returns: the profile, which can be queried while the reader runs
+        '''
+        if self._profile is None:
+            self._profile = ReaderProfile(sample_every)
+            for session in self.sessions.values():
+                session._profile = self._profile
+        elif sample_every < 1:
+            raise ValueError('sample_every must be at least 1')
+        else:
+            self._profile.sample_every = sample_every
+        return self._profile
+
+    def disable_profiling(self):
+        ''' Stop profiling the reader task. '''
+        self._profile = None
+        for session in self.sessions.values():
+            session._profile = None
+
+    def writer_stats(self) -> typing.List[LaneStats]:
+        '''
+        Return a snapshot of the outgoing command queues, one for each
+        :class:`Priority` from most to least urgent. Each snapshot includes how
+        long commands waited to be sent.
+        '''
+        return self._writer.stats() if self._writer is not None else []
+
+    def _teardown(self):
+        '''
+        Fail every in-flight command on this connection and its sessions with
+        :class:`CdpConnectionClosed`, and end every listener channel.
+
+        This is called when the WebSocket closes. Its cost is proportional to the
+        number of pending commands and channels. It is safe to call this multiple
+        times.
+        '''
+        if self.closed:
+            return
+        if self._writer is not None:
+            self._writer.close()
+        commands, channels = self._close('connection closed')
+        sessions = list(self.sessions.values())
+        self.sessions.clear()
+        for session in sessions:
+            session_commands, session_channels = session._close(
+                'connection closed', self._closed_exception)
+            commands += session_commands
+            channels += session_channels
+        channels += _end_channels(self.session_channels, self.metrics)
+        self.teardown_stats = TeardownStats(sessions=len(sessions),
+            commands=commands, channels=channels)
+        logger.info('Connection closed (%s): failed %d commands in %d sessions '
+            'and ended %d channels', self.transport.closed, commands, len(sessions),
+            channels)
 
     @asynccontextmanager
     async def open_session(self, target_id: cdp.target.TargetID) -> \
@@ -239,8 +931,11 @@ class CdpConnection(CdpBase, trio.abc.AsyncResource):
         and it will execute on the current session automatically.
         '''
         session = await self.connect_session(target_id)
-        with session_context(session):
-            yield session
+        try:
+            with session_context(session):
+                yield session
+        finally:
+            await self.detach_session(session)
 
     async def connect_session(self, target_id: cdp.target.TargetID) -> 'CdpSession':
         '''
@@ -248,43 +943,267 @@ class CdpConnection(CdpBase, trio.abc.AsyncResource):
         '''
         session_id = await self.execute(cdp.target.attach_to_target(
             target_id, True))
-        session = CdpSession(self.ws, session_id, target_id)
-        self.sessions[session_id] = session
+        return self._add_session(session_id, target_id)
+
+    async def auto_attach(self, types: typing.Optional[typing.Iterable[str]] =
+            None, wait_for_debugger: bool = False) -> TargetRegistry:
+        '''
+        Track every target in the browser and attach to new targets
+        automatically, including iframes, workers, and popups that would be gone
+        before they could be found by polling.
+
+        A session is created for each attached target whose type is in
+        ``types`` and added to :attr:`sessions`. Auto-attach is also enabled on
+        each of these sessions, so their child targets are attached too. Targets
+        of other types are detached right away.
+
+        :param types: target types to keep sessions for, e.g. ``{"page",
+            "iframe"}``. The default is every type.
+        :param wait_for_debugger: if true, new targets are paused until their
+            session has enabled auto-attach for their own children, so that
+            nothing they start is missed
+        :returns: the registry, which is also available as :attr:`targets`
+        '''
+        self.targets = TargetRegistry(types)
+        self._wait_for_debugger = wait_for_debugger
+        await self.execute(cdp.target.set_discover_targets(True))
+        await self.execute(cdp.target.set_auto_attach(True, wait_for_debugger,
+            flatten=True))
+        return self.targets
+
+    async def detach_session(self, session: 'CdpSession'):
+        '''
+        Detach from a session's target and remove the session from this
+        connection. Commands still waiting on the session raise
+        :class:`CdpSessionClosed`.
+
+        It is safe to call this on a session that is already detached.
+        '''
+        try:
+            if not session.closed and not self.closed:
+                await self.execute(cdp.target.detach_from_target(
+                    session.session_id))
+        except (BrowserError, CdpConnectionClosed):
+            # The target may already be gone, or the connection may be closed.
+            # Either way, there is nothing left to detach.
+            pass
+        finally:
+            self._evict_session(session.session_id, 'detached')
+
+    @property
+    def session_count(self) -> int:
+        ''' The number of live sessions on this connection. '''
+        return len(self.sessions)
+
+    def _add_session(self, session_id: cdp.target.SessionID,
+            target_id: cdp.target.TargetID) -> 'CdpSession':
+        ''' Return the session with this ID, creating it if needed. '''
+        session = self.sessions.get(session_id)
+        if session is None:
+            session = CdpSession(self.transport, session_id, target_id,
+                self.codec)
+            session._shared_channels = self.session_channels
+            session._writer = self._writer
+            session._limits = self._make_limits()
+            session.metrics = self.metrics
+            session.hooks = self.hooks
+            session._profile = self._profile
+            self.sessions[session_id] = session
         return session
 
+    def _evict_session(self, session_id, reason):
+        ''' Remove a session from this connection and close it. '''
+        session = self.sessions.pop(session_id, None)
+        if session is not None:
+            logger.debug('Evicting session %s: %s', session_id, reason)
+            session._close(reason)
+            if self.targets is not None:
+                self.targets._remove_session(session)
+
+    def _handle_lifecycle_event(self, session, data):
+        '''
+        Evict sessions whose target has detached, been destroyed, or crashed.
+
+        :param CdpBase session: the session (or connection) that received the
+            event
+        :param dict data: event as a JSON dictionary
+        '''
+        method = data['method']
+        params = data.get('params', {})
+        if method == 'Target.detachedFromTarget':
+            self._evict_session(params.get('sessionId'), 'detached from target')
+        elif method == 'Target.targetDestroyed':
+            target_id = params.get('targetId')
+            for session_id in [session_id for session_id, s in
+                    self.sessions.items() if s.target_id == target_id]:
+                self._evict_session(session_id, 'target destroyed')
+        elif session is not self:
+            # Inspector events are sent on the session whose target crashed or
+            # detached.
+            reason = 'target crashed' if method == 'Inspector.targetCrashed' \
+                else 'inspector detached'
+            self._evict_session(session.session_id, reason)
+
+    async def _handle_target_event(self, data):
+        '''
+        Apply a target event to the registry. When a target is attached, create
+        its session or detach from it, depending on the registry's filter.
+
+        The commands sent here are not awaited, because the reader task must not
+        wait for a response that only it can receive.
+
+        :param dict data: event as a JSON dictionary
+        '''
+        method = data['method']
+        params = data.get('params', {})
+        if method == 'Target.targetDestroyed':
+            self.targets._remove(cdp.target.TargetID(params['targetId']))
+            return
+        info = cdp.target.TargetInfo.from_json(params['targetInfo'])
+        self.targets._update(info)
+        if method != 'Target.attachedToTarget':
+            return
+        session_id = cdp.target.SessionID(params['sessionId'])
+        if not self.targets.wants(info):
+            logger.debug('Detaching from %s target %s', info.type_,
+                info.target_id)
+            try:
+                await self._send_command(cdp.target.detach_from_target(
+                    session_id))
+            except CdpConnectionClosed:
+                pass
+            return
+        session = self._add_session(session_id, info.target_id)
+        self.targets._add_session(session)
+        try:
+            await session._send_command(cdp.target.set_auto_attach(True,
+                self._wait_for_debugger, flatten=True))
+            if params.get('waitingForDebugger'):
+                await session._send_command(
+                    cdp.runtime.run_if_waiting_for_debugger())
+        except CdpConnectionClosed:
+            # The reader task notices the closed connection on its next read.
+            pass
+
+    def listen_all(self, *event_types, buffer_size=10, policy='drop-newest',
+            key=None) -> EventReceiveChannel:
+        '''
+        Return an async iterator that iterates over events matching the
+        indicated types from every session on this connection.
+
+        Each item is a ``(session, event)`` tuple. This is cheaper than calling
+        :meth:`listen` on each session and merging the results, because the
+        events are routed to this channel by the reader task directly.
+
+        The arguments are the same as :meth:`listen`, except that the
+        ``broadcast`` policy is not supported. A ``key`` function for the
+        ``coalesce`` policy receives the ``(session, event)`` tuple.
+        '''
+        if self.closed:
+            raise self._closed_exception()
+        receiver = open_event_channel(buffer_size, policy, key)
+        for event_type in event_types:
+            self.session_channels[event_type].add(receiver)
+        return receiver
+
     async def _reader_task(self):
         '''
         Runs in the background and handles incoming messages: dispatching
         responses to commands and events to listeners.
         '''
+        await self._read_messages()
+        # If the reader task raises an exception instead, its nursery cancels the
+        # tasks waiting on commands, so they do not need to be failed here.
+        self._teardown()
+
+    async def _read_messages(self):
+        ''' Read and dispatch messages until the WebSocket is closed. '''
         while True:
+            profile = self._profile
+            if profile is not None and profile.sample():
+                if not await self._read_profiled(profile):
+                    break
+                continue
             try:
-                message = await self.ws.get_message()
+                message = await self.transport.get_message()
             except WsConnectionClosed:
                 # If the WebSocket is closed, we don't want to throw an
                 # exception from the reader task. Instead we will throw
                 # exceptions from the public API methods, and we can quietly
                 # exit the reader task here.
                 break
-            try:
-                data = json.loads(message)
-            except json.JSONDecodeError:
-                raise BrowserError({
-                    'code': -32700,
-                    'message': 'Client received invalid JSON',
-                    'data': message
-                })
-            logger.debug('Received message %r', data)
-            if 'sessionId' in data:
-                session_id = cdp.target.SessionID(data['sessionId'])
-                try:
-                    session = self.sessions[session_id]
-                except KeyError:
-                    raise BrowserError('Browser sent a message for an invalid '
-                        'session: {!r}'.format(session_id))
-                session._handle_data(data)
-            else:
-                self._handle_data(data)
+            data = self._decode(message)
+            session = self._route(data)
+            if session is not None:
+                await self._dispatch(session, data, len(message))
+
+    async def _read_profiled(self, profile: ReaderProfile) -> bool:
+        '''
+        Read and dispatch one message, recording the time of each stage in
+        ``profile``.
+
+        :returns: false if the WebSocket is closed
+        '''
+        perf_counter = time.perf_counter
+        start = perf_counter()
+        try:
+            message = await self.transport.get_message()
+        except WsConnectionClosed:
+            return False
+        received = perf_counter()
+        arrived = getattr(self.transport, 'last_arrival', None) or received
+        data = self._decode(message)
+        decoded = perf_counter()
+        session = self._route(data)
+        routed = perf_counter()
+        profile.sampling = True
+        try:
+            if session is not None:
+                await self._dispatch(session, data, len(message))
+        finally:
+            profile.sampling = False
+        done = perf_counter()
+        method = data.get('method') if 'id' not in data else None
+        profile.record(method, len(message), received - start,
+            decoded - received, routed - decoded, done - routed, done - arrived)
+        return True
+
+    def _decode(self, message) -> dict:
+        ''' Decode an incoming message. '''
+        try:
+            data = self.codec.loads(message)
+        except self.codec.decode_errors:
+            raise BrowserError({
+                'code': -32700,
+                'message': 'Client received invalid JSON',
+                'data': message
+            })
+        logger.debug('Received message %r', data)
+        return data
+
+    def _route(self, data) -> typing.Optional[CdpBase]:
+        ''' Return the session (or this connection) that a message belongs to,
+        or ``None`` if its session is unknown. '''
+        if 'sessionId' not in data:
+            return self
+        session_id = cdp.target.SessionID(data['sessionId'])
+        try:
+            return self.sessions[session_id]
+        except KeyError:
+            # This happens when a message arrives after its session was
+            # detached.
+            logger.debug('Discarding message for unknown session %s',
+                session_id)
+            return None
+
+    async def _dispatch(self, session: CdpBase, data, size: int):
+        ''' Handle a decoded message. '''
+        await session._handle_data(data, size)
+        method = data.get('method')
+        if method in _LIFECYCLE_EVENTS:
+            self._handle_lifecycle_event(session, data)
+        if self.targets is not None and method in _TARGET_EVENTS:
+            await self._handle_target_event(data)
 
 
 class CdpSession(CdpBase):
@@ -294,21 +1213,25 @@ class CdpSession(CdpBase):
     Generally you should not instantiate this object yourself; you should call
     :meth:`CdpConnection.open_session`.
     '''
-    def __init__(self, ws, session_id, target_id):
+    def __init__(self, transport, session_id, target_id, codec=None):
         '''
         Constructor.
 
-        :param trio_websocket.WebSocketConnection ws:
+        :param transport: the parent connection's transport
         :param cdp.target.SessionID session_id:
         :param cdp.target.TargetID target_id:
+        :param Codec codec: the codec used by the parent connection
         '''
-        super().__init__(ws, session_id, target_id)
+        super().__init__(transport, session_id, target_id, codec)
 
         self._dom_enable_count = 0
         self._dom_enable_lock = trio.Lock()
         self._page_enable_count = 0
         self._page_enable_lock = trio.Lock()
 
+    def _closed_error(self):
+        return CdpSessionClosed(self.session_id, self._closed_reason)
+
     @asynccontextmanager
     async def dom_enable(self):
         '''
@@ -352,8 +1275,14 @@ class CdpSession(CdpBase):
                 await self.execute(cdp.page.disable())
 
 
+def open_connections() -> typing.List[CdpConnection]:
+    ''' Return every CDP connection that has not been closed. '''
+    return [conn for conn in list(_connections) if not conn.closed]
+
+
 @asynccontextmanager
-async def open_cdp(url) -> typing.AsyncIterator[CdpConnection]:
+async def open_cdp(url, codec=None, flush_policy=None, recorder=None) -> \
+        typing.AsyncIterator[CdpConnection]:
     '''
     This async context manager opens a connection to the browser specified by
     ``url`` before entering the block, then closes the connection when the block
@@ -363,9 +1292,20 @@ async def open_cdp(url) -> typing.AsyncIterator[CdpConnection]:
     current task, so that commands like ``await target.get_targets()`` will run on this
     connection automatically. If you want to use multiple connections concurrently, it
     is recommended to open each on in a separate task.
+
+    The ``codec`` argument selects the JSON library used to encode commands and
+    decode messages. It may be a codec name such as ``'orjson'``, ``'auto'`` to pick
+    the fastest installed library, or a :class:`trio_cdp.codec.Codec` instance. The
+    default is the standard library ``json`` module.
+
+    The ``flush_policy`` argument is a :class:`trio_cdp.writer.FlushPolicy` that
+    controls how outgoing commands are batched.
+
+    If ``recorder`` is a :class:`trio_cdp.recorder.WireRecorder`, every frame sent
+    or received on the connection is offered to it.
     '''
     async with trio.open_nursery() as nursery:
-        conn = await connect_cdp(nursery, url)
+        conn = await connect_cdp(nursery, url, codec, flush_policy, recorder)
         try:
             with connection_context(conn):
                 yield conn
@@ -373,7 +1313,8 @@ async def open_cdp(url) -> typing.AsyncIterator[CdpConnection]:
             await conn.aclose()
 
 
-async def connect_cdp(nursery, url) -> CdpConnection:
+async def connect_cdp(nursery, url, codec=None, flush_policy=None,
+        recorder=None) -> CdpConnection:
     '''
     Connect to the browser specified by ``url`` and spawn a background task in the
     specified nursery.
@@ -388,9 +1329,60 @@ async def connect_cdp(nursery, url) -> CdpConnection:
     If ``set_context`` is True, then the returned connection will be installed as
     the default connection for the current task. This argument is for unusual use cases,
     such as running inside of a notebook.
+
+    The ``codec``, ``flush_policy``, and ``recorder`` arguments have the same
+    meaning as in :func:`open_cdp`.
     '''
     ws = await connect_websocket_url(nursery, url,
         max_message_size=MAX_WS_MESSAGE_SIZE)
-    cdp_conn = CdpConnection(ws)
-    nursery.start_soon(cdp_conn._reader_task)
+    if recorder is not None:
+        ws = recorder.wrap(ws)
+    cdp_conn = CdpConnection(ws, codec)
+    cdp_conn._start(nursery, flush_policy)
+    return cdp_conn
+
+
+@asynccontextmanager
+async def open_cdp_pipe(command: typing.Sequence[str], codec=None,
+        flush_policy=None, recorder=None, **options) -> typing.AsyncIterator[CdpConnection]:
+    '''
+    This async context manager starts a browser with ``command`` and connects to it
+    over pipes instead of a WebSocket. When the block exits, the connection is
+    closed and the browser is stopped.
+
+    The command must include ``--remote-debugging-pipe``, e.g. ``['chromium',
+    '--headless', '--remote-debugging-pipe']``. Compared to a WebSocket, the pipe
+    transport has less framing overhead and no maximum message size. It requires a
+    POSIX platform.
+
+    Like :func:`open_cdp`, this sets the connection as the default connection for
+    the current task. The ``codec``, ``flush_policy``, and ``recorder`` arguments
+    have the same meaning as in :func:`open_cdp`, and ``options`` are passed to
+    ``trio.lowlevel.open_process()``.
+    '''
+    async with trio.open_nursery() as nursery:
+        conn = await connect_cdp_pipe(nursery, command, codec, flush_policy,
+            recorder, **options)
+        try:
+            with connection_context(conn):
+                yield conn
+        finally:
+            await conn.aclose()
+
+
+async def connect_cdp_pipe(nursery, command: typing.Sequence[str], codec=None,
+        flush_policy=None, recorder=None, **options) -> CdpConnection:
+    '''
+    Start a browser with ``command``, connect to it over pipes, and spawn a
+    background task in the specified nursery.
+
+    The ``open_cdp_pipe()`` context manager is preferred in most situations. As with
+    :func:`connect_cdp`, the connection is not automatically closed. Closing it also
+    stops the browser.
+    '''
+    transport = await open_pipe_process(command, **options)
+    if recorder is not None:
+        transport = recorder.wrap(transport)
+    cdp_conn = CdpConnection(transport, codec)
+    cdp_conn._start(nursery, flush_policy)
     return cdp_conn
@@ -0,0 +1,688 @@
+'''
+Event channels that deliver events from a CDP connection to listeners.
+
+Each call to ``listen()`` or ``wait_for()`` creates a channel. The reader task
+offers every matching event to the channel, and the channel's backpressure policy
+decides what happens when the listener falls behind:
+
+``drop-newest``
+    Discard the incoming event when the buffer is full. This is the default.
+``drop-oldest``
+    Discard the oldest buffered event to make room for the incoming event.
+``block``
+    Make the reader task wait until the listener has room. Nothing is lost, but a
+    slow listener delays every other message on the connection.
+``coalesce``
+    Keep only the latest event for each key, e.g. one event per frame ID. If the
+    buffer is full and the key is new, the oldest event is discarded.
+``spill``
+    Write events that do not fit in the buffer to a temporary file on disk and
+    read them back in order. The file is written and read in worker threads, so
+    the reader task does not wait for the disk unless the disk falls behind.
+
+Every channel counts the events it accepted, dropped, coalesced, and spilled,
+along with the high-water mark of its buffer, so that buffer sizes can be chosen
+from data. See :meth:`EventReceiveChannel.statistics`.
+
+``listen()`` also supports a ``broadcast`` policy for event types with many
+listeners. All broadcast listeners for the same event types share one
+:class:`BroadcastRing`, so each event is appended once no matter how many
+listeners there are. Each listener has its own cursor into the ring. A listener
+that falls more than ``buffer_size`` events behind skips the events that were
+overwritten, and the skipped events are counted as dropped.
+'''
+from collections import deque, OrderedDict
+from dataclasses import dataclass
+import logging
+import pickle
+import tempfile
+import threading
+import typing
+
+import trio # type: ignore
+
+
+logger = logging.getLogger('trio_cdp')
+POLICIES = ('drop-newest', 'drop-oldest', 'block', 'coalesce', 'spill')
+
+
+@dataclass
+class EventChannelStatistics:
+    ''' A snapshot of an event channel's counters. '''
+    #: The channel's backpressure policy.
+    policy: str
+    #: The maximum number of events held in memory.
+    buffer_size: float
+    #: The number of events currently waiting to be received, including events
+    #: spilled to disk.
+    queued: int
+    #: The largest value that ``queued`` has reached.
+    high_water: int
+    #: The number of events accepted into the channel.
+    accepted: int
+    #: The number of events discarded because the buffer was full.
+    dropped: int
+    #: The number of events that replaced an older event with the same key.
+    coalesced: int
+    #: The number of events that did not fit in the buffer and were queued to
+    #: be written to disk.
+    spilled: int
+    #: The number of times the reader task had to wait for the listener.
+    blocked: int
+
+
+class EventReceiveChannel(trio.abc.ReceiveChannel):
+    '''
+    The receiving end of an event channel, returned by ``listen()``.
+
+    This behaves like a Trio memory receive channel: you can ``await
+    channel.receive()``, iterate over it with ``async for``, and close it with
+    ``async with`` or ``aclose()``. Once it is closed, the connection stops
+    delivering events to it.
+
+    This class implements the ``drop-newest`` policy. Subclasses implement the
+    other policies.
+    '''
+    policy = 'drop-newest'
+
+    def __init__(self, buffer_size: float):
+        if buffer_size < 0:
+            raise ValueError('buffer_size must be non-negative')
+        self.buffer_size = buffer_size
+        self.closed = False
+        self.ended = False
+        self._buffer: typing.Any = deque()
+        self._readable = trio.Event()
+        self._waiting = 0
+        self._accepted = 0
+        self._dropped = 0
+        self._coalesced = 0
+        self._spilled = 0
+        self._blocked = 0
+        self._high_water = 0
+
+    def offer(self, event) -> bool:
+        '''
+        Offer an event to the channel without blocking. This is called by the
+        reader task.
+
+        :returns: False if the reader task must call :meth:`put` instead,
+            otherwise True (even if the event was dropped).
+        '''
+        if self._has_room():
+            self._append(event)
+        else:
+            self._drop(event)
+        return True
+
+    async def put(self, event):
+        ''' Wait for room in the channel and then add an event. Only the
+        ``block`` policy needs this. '''
+        self._append(event)
+
+    def statistics(self) -> EventChannelStatistics:
+        ''' Return a snapshot of the channel's counters. '''
+        return EventChannelStatistics(
+            policy=self.policy,
+            buffer_size=self.buffer_size,
+            queued=self._queued(),
+            high_water=self._high_water,
+            accepted=self._accepted,
+            dropped=self._dropped,
+            coalesced=self._coalesced,
+            spilled=self._spilled,
+            blocked=self._blocked,
+        )
+
+    async def receive(self):
+        ''' Receive the next event, waiting until one is available. '''
+        while True:
+            if self.closed:
+                raise trio.ClosedResourceError()
+            if self._queued():
+                await trio.sleep(0)
+                if self.closed:
+                    raise trio.ClosedResourceError()
+                if self._queued():
+                    event = self._pop()
+                    self._on_space()
+                    return event
+                continue
+            if self.ended:
+                raise trio.EndOfChannel()
+            if self._readable.is_set():
+                self._readable = trio.Event()
+            self._waiting += 1
+            self._on_space()
+            try:
+                await self._readable.wait()
+            finally:
+                self._waiting -= 1
+
+    def end(self):
+        ''' Signal that no more events will be offered, e.g. because the
+        session was closed. Receivers get the events that are already buffered
+        and then ``trio.EndOfChannel``. '''
+        self.ended = True
+        self._readable.set()
+
+    async def aclose(self):
+        ''' Close the channel. Buffered events are discarded. '''
+        self.closed = True
+        self._readable.set()
+        self._clear()
+        await trio.sleep(0)
+
+    def _on_space(self):
+        ''' Called when an event is removed or a receiver starts waiting. '''
+
+    def _has_room(self) -> bool:
+        # A task that is already waiting to receive can always take an event,
+        # even from a channel with a zero-size buffer.
+        return len(self._buffer) < self.buffer_size or \
+            (self._waiting > 0 and not self._buffer)
+
+    def _append(self, event):
+        self._buffer.append(event)
+        self._accept()
+
+    def _accept(self):
+        self._accepted += 1
+        queued = self._queued()
+        if queued > self._high_water:
+            self._high_water = queued
+        self._readable.set()
+
+    def _drop(self, event):
+        if self._dropped == 0:
+            logger.warning('Dropping events due to full channel %r (policy=%s, '
+                'buffer_size=%s)', self, self.policy, self.buffer_size)
+        logger.debug('Dropped event "%r" due to full channel %r', event, self)
+        self._dropped += 1
+
+    def _pop(self):
+        return self._buffer.popleft()
+
+    def _queued(self) -> int:
+        return len(self._buffer)
+
+    def _clear(self):
+        self._buffer.clear()
+
+
+class DropOldestChannel(EventReceiveChannel):
+    ''' An event channel that discards the oldest event when it is full. '''
+    policy = 'drop-oldest'
+
+    def offer(self, event):
+        if not self._has_room():
+            if not self._buffer:
+                # Zero-size buffer with nobody waiting: the incoming event is
+                # the oldest one.
+                self._drop(event)
+                return True
+            self._drop(self._buffer.popleft())
+        self._append(event)
+        return True
+
+
+class BlockingChannel(EventReceiveChannel):
+    ''' An event channel that makes the reader task wait when it is full. '''
+    policy = 'block'
+
+    def __init__(self, buffer_size):
+        super().__init__(buffer_size)
+        self._writable = trio.Event()
+
+    def offer(self, event):
+        if self._has_room():
+            self._append(event)
+            return True
+        return False
+
+    async def put(self, event):
+        self._blocked += 1
+        while not self._has_room():
+            if self.closed:
+                return
+            if self._writable.is_set():
+                self._writable = trio.Event()
+            await self._writable.wait()
+        self._append(event)
+
+    async def aclose(self):
+        self._writable.set()
+        await super().aclose()
+
+    def _on_space(self):
+        self._writable.set()
+
+
+class CoalescingChannel(EventReceiveChannel):
+    '''
+    An event channel that keeps only the latest event for each key.
+
+    A new event whose key matches a buffered event replaces that event in place.
+    '''
+    policy = 'coalesce'
+
+    def __init__(self, buffer_size, key: typing.Callable[[typing.Any],
+            typing.Hashable]):
+        super().__init__(buffer_size)
+        self.key = key
+        self._buffer = OrderedDict()
+
+    def offer(self, event):
+        key = self.key(event)
+        if key in self._buffer:
+            self._buffer[key] = event
+            self._coalesced += 1
+            self._readable.set()
+            return True
+        if not self._has_room():
+            if not self._buffer:
+                self._drop(event)
+                return True
+            _, oldest = self._buffer.popitem(last=False)
+            self._drop(oldest)
+        self._buffer[key] = event
+        self._accept()
+        return True
+
+    def _pop(self):
+        return self._buffer.popitem(last=False)[1]
+
+
+class SpillChannel(EventReceiveChannel):
+    '''
+    An event channel that writes events to a temporary file when its buffer is
+    full, so that no events are lost.
+
+    The reader task never touches the disk. Events that do not fit in the buffer
+    are appended to a write buffer of up to :attr:`write_buffer` events, which a
+    worker thread pickles and writes to the file in batches. Receivers read the
+    batches back in a worker thread. Once any event has been spilled, later
+    events are also spilled until the file is drained, which keeps the events in
+    order, and the file is reused from the start whenever it is drained.
+
+    If the disk cannot keep up and the write buffer fills, the reader task waits
+    for room like it does with the ``block`` policy. If a write fails, e.g.
+    because the disk is full, the channel logs the error, keeps that batch in
+    memory, and stops spilling; from then on it behaves like the ``block``
+    policy with a buffer of :attr:`write_buffer` events.
+    '''
+    policy = 'spill'
+    #: The maximum number of events waiting to be written to disk.
+    write_buffer = 1000
+
+    def __init__(self, buffer_size):
+        super().__init__(buffer_size)
+        self._writable = trio.Event()
+        self._load_lock = trio.Lock()
+        self._file: typing.Optional[typing.BinaryIO] = None
+        self._file_lock = threading.Lock()
+        self._write_pos = 0
+        # Events waiting to be written, the batch being written, batches on
+        # disk as (offset, length, count) or in memory as (None, events, count),
+        # and events read back from disk, from newest to oldest.
+        self._pending: typing.Deque[typing.Any] = deque()
+        self._writing: typing.Optional[typing.List[typing.Any]] = None
+        self._records: typing.Deque[typing.Tuple] = deque()
+        self._loaded: typing.Deque[typing.Any] = deque()
+        self._reading = False
+        self._disk_failed = False
+
+    def offer(self, event):
+        if not self._spilling() and self._has_room():
+            self._append(event)
+            return True
+        if len(self._pending) >= self.write_buffer:
+            return False
+        self._spill(event)
+        return True
+
+    async def put(self, event):
+        self._blocked += 1
+        while len(self._pending) >= self.write_buffer:
+            if self.closed:
+                return
+            if self._writable.is_set():
+                self._writable = trio.Event()
+            await self._writable.wait()
+        self._spill(event)
+
+    async def receive(self):
+        ''' Receive the next event, waiting until one is available. '''
+        while True:
+            if self.closed:
+                raise trio.ClosedResourceError()
+            if self._buffer or self._loaded or self._records or \
+                    (self._pending and self._writing is None):
+                await trio.sleep(0)
+                if self.closed:
+                    raise trio.ClosedResourceError()
+                if not self._buffer and not self._loaded and self._records:
+                    await self._load()
+                    continue
+                if self._buffer or self._loaded or \
+                        (self._pending and self._writing is None):
+                    event = self._pop()
+                    self._on_space()
+                    return event
+                continue
+            if self.ended and not self._queued():
+                raise trio.EndOfChannel()
+            # Any events that are queued are still being written to disk.
+            if self._readable.is_set():
+                self._readable = trio.Event()
+            self._waiting += 1
+            self._on_space()
+            try:
+                await self._readable.wait()
+            finally:
+                self._waiting -= 1
+
+    async def aclose(self):
+        self._writable.set()
+        await super().aclose()
+
+    def _spilling(self) -> bool:
+        return bool(self._pending or self._writing is not None or
+            self._records or self._loaded)
+
+    def _spill(self, event):
+        self._pending.append(event)
+        self._spilled += 1
+        self._accept()
+        self._flush()
+
+    def _flush(self):
+        ''' Start writing the pending events in a worker thread, unless a
+        write is already in progress. '''
+        if self._writing is not None or not self._pending or self._disk_failed \
+                or self.closed:
+            return
+        batch = list(self._pending)
+        self._pending.clear()
+        self._writing = batch
+        token = trio.lowlevel.current_trio_token()
+        file, offset = self._file, self._write_pos
+
+        def deliver(result):
+            try:
+                token.run_sync_soon(self._written, batch, result)
+            except trio.RunFinishedError:
+                pass
+
+        trio.lowlevel.start_thread_soon(
+            lambda: _write_batch(file, self._file_lock, offset, batch), deliver)
+
+    def _written(self, batch, result):
+        ''' Called in the Trio thread when a batch has been written. '''
+        self._writing = None
+        try:
+            file, length = result.unwrap()
+        except Exception:
+            logger.exception('Unable to spill events from channel %r to disk; '
+                'keeping them in memory', self)
+            self._disk_failed = True
+            self._records.append((None, batch, len(batch)))
+        else:
+            self._file = file
+            self._records.append((self._write_pos, length, len(batch)))
+            self._write_pos += length
+        if self.closed:
+            self._clear()
+        self._readable.set()
+        self._writable.set()
+        self._flush()
+
+    async def _load(self):
+        ''' Read the oldest batch back into memory. '''
+        async with self._load_lock:
+            if self._loaded or not self._records or self.closed:
+                return
+            offset, data, count = self._records[0]
+            if offset is None:
+                events = data
+            else:
+                self._reading = True
+                try:
+                    events = await trio.to_thread.run_sync(_read_batch,
+                        self._file, self._file_lock, offset, data)
+                except Exception:
+                    logger.exception('Unable to read spilled events for '
+                        'channel %r', self)
+                    events = list()
+                    self._dropped += count
+                finally:
+                    self._reading = False
+                if self.closed:
+                    self._clear()
+                    return
+            self._records.popleft()
+            self._loaded.extend(events)
+            if self._writing is None and not any(record[0] is not None
+                    for record in self._records):
+                # Nothing else lives in the file, so start over at the
+                # beginning.
+                self._write_pos = 0
+
+    def _pop(self):
+        if self._buffer:
+            return self._buffer.popleft()
+        if self._loaded:
+            return self._loaded.popleft()
+        event = self._pending.popleft()
+        self._writable.set()
+        return event
+
+    def _queued(self):
+        return len(self._buffer) + len(self._loaded) + len(self._pending) + \
+            sum(record[2] for record in self._records) + \
+            (len(self._writing) if self._writing is not None else 0)
+
+    def _on_space(self):
+        self._writable.set()
+
+    def _clear(self):
+        super()._clear()
+        self._pending.clear()
+        self._records.clear()
+        self._loaded.clear()
+        # A worker thread may still be using the file. It is closed when the
+        # thread finishes.
+        if self._file is not None and self._writing is None and \
+                not self._reading:
+            self._file.close()
+            self._file = None
+
+
+def _write_batch(file: typing.Optional[typing.BinaryIO], lock: threading.Lock,
+        offset: int, batch: typing.List[typing.Any]) -> \
+        typing.Tuple[typing.BinaryIO, int]:
+    '''
+    Pickle a batch of events and write it to a spill file at ``offset``,
+    creating the file if needed. This runs in a worker thread.
+
+    A write and a read of the same file may run in different threads at once,
+    so each holds ``lock`` while it moves the file position.
+    '''
+    data = pickle.dumps(batch, protocol=pickle.HIGHEST_PROTOCOL)
+    if file is None:
+        file = tempfile.TemporaryFile()
+    with lock:
+        file.seek(offset)
+        file.write(data)
+        file.flush()
+    return file, len(data)
+
+
+def _read_batch(file: typing.BinaryIO, lock: threading.Lock, offset: int,
+        length: int) -> typing.List[typing.Any]:
+    ''' Read a batch of events from a spill file. This runs in a worker
+    thread. '''
+    with lock:
+        file.seek(offset)
+        data = file.read(length)
+    if len(data) != length:
+        raise EOFError('Spill file is truncated')
+    return pickle.loads(data)
+
+
+def open_event_channel(buffer_size: float = 10, policy: str = 'drop-newest',
+        key: typing.Optional[typing.Callable[[typing.Any], typing.Hashable]] = None) \
+        -> EventReceiveChannel:
+    '''
+    Create an event channel.
+
+    :param buffer_size: the maximum number of events held in memory, which may be
+        ``math.inf``
+    :param policy: one of the policies described in this module
+    :param key: for the ``coalesce`` policy, a function that returns the key of
+        an event
+    '''
+    if policy == 'coalesce':
+        if key is None:
+            raise ValueError('The coalesce policy requires a key function')
+        return CoalescingChannel(buffer_size, key)
+    if key is not None:
+        raise ValueError('A key function is only used by the coalesce policy')
+    if policy == 'drop-newest':
+        return EventReceiveChannel(buffer_size)
+    if policy == 'drop-oldest':
+        return DropOldestChannel(buffer_size)
+    if policy == 'block':
+        return BlockingChannel(buffer_size)
+    if policy == 'spill':
+        return SpillChannel(buffer_size)
+    raise ValueError('Unknown policy: {!r} (expected one of {})'.format(policy,
+        ', '.join(POLICIES)))
+
+
+class BroadcastRing:
+    '''
+    A bounded ring of events with a single producer and any number of
+    :class:`BroadcastReceiveChannel` consumers.
+
+    The ring is registered with the connection like an ordinary channel: the
+    reader task calls :meth:`offer` once per event, which never blocks.
+    '''
+    def __init__(self, size: int):
+        if size < 1:
+            raise ValueError('A broadcast buffer_size must be at least 1')
+        self.size = size
+        #: The sequence number of the next event to be appended.
+        self.seq = 0
+        #: The open receivers, which hold the per-listener counters.
+        self.listeners: typing.Set['BroadcastReceiveChannel'] = set()
+        #: The number of events dropped by receivers that have closed.
+        self.released_dropped = 0
+        self.closed = False
+        self.ended = False
+        self._events: typing.List[typing.Any] = [None] * size
+        self._readable = trio.Event()
+
+    def offer(self, event) -> bool:
+        ''' Append an event, overwriting the oldest event if the ring is full. '''
+        self._events[self.seq % self.size] = event
+        self.seq += 1
+        self._readable.set()
+        return True
+
+    async def put(self, event):
+        ''' Broadcast rings never block the reader task. '''
+        self.offer(event)
+
+    def end(self):
+        ''' Signal that no more events will be appended. '''
+        self.ended = True
+        self._readable.set()
+
+    def open_receiver(self) -> 'BroadcastReceiveChannel':
+        ''' Return a new receiver that starts at the next event. '''
+        receiver = BroadcastReceiveChannel(self)
+        self.listeners.add(receiver)
+        return receiver
+
+    @property
+    def receivers(self) -> int:
+        ''' The number of open receivers. '''
+        return len(self.listeners)
+
+    def _release(self, receiver: 'BroadcastReceiveChannel'):
+        self.released_dropped += receiver.statistics().dropped
+        self.listeners.discard(receiver)
+        if not self.listeners:
+            self.closed = True
+            self._events = [None] * self.size
+            self._readable.set()
+
+
+class BroadcastReceiveChannel(trio.abc.ReceiveChannel):
+    ''' One listener's view of a :class:`BroadcastRing`. '''
+    policy = 'broadcast'
+
+    def __init__(self, ring: BroadcastRing):
+        self.closed = False
+        self._ring = ring
+        self._start = ring.seq
+        self._cursor = ring.seq
+        self._received = 0
+        self._skipped = 0
+        self._high_water = 0
+
+    async def receive(self):
+        ''' Receive the next event, waiting until one is available. '''
+        ring = self._ring
+        while True:
+            if self.closed:
+                raise trio.ClosedResourceError()
+            lag = ring.seq - self._cursor
+            if lag:
+                await trio.sleep(0)
+                if self.closed:
+                    raise trio.ClosedResourceError()
+                # Recompute the lag, since more events may have arrived.
+                lag = ring.seq - self._cursor
+                if lag > self._high_water:
+                    self._high_water = lag
+                if lag > ring.size:
+                    skipped = lag - ring.size
+                    if self._skipped == 0:
+                        logger.warning('Broadcast listener %r fell behind and '
+                            'skipped %d events', self, skipped)
+                    self._skipped += skipped
+                    self._cursor += skipped
+                event = ring._events[self._cursor % ring.size]
+                self._cursor += 1
+                self._received += 1
+                return event
+            if ring.ended:
+                raise trio.EndOfChannel()
+            if ring._readable.is_set():
+                ring._readable = trio.Event()
+            await ring._readable.wait()
+
+    async def aclose(self):
+        ''' Close this listener. The ring is released when its last listener
+        closes. '''
+        if not self.closed:
+            self.closed = True
+            self._ring._release(self)
+        await trio.sleep(0)
+
+    def statistics(self) -> EventChannelStatistics:
+        ''' Return a snapshot of this listener's counters. '''
+        ring = self._ring
+        return EventChannelStatistics(
+            policy=self.policy,
+            buffer_size=ring.size,
+            queued=min(ring.seq - self._cursor, ring.size),
+            high_water=self._high_water,
+            accepted=ring.seq - self._start,
+            dropped=self._skipped + max(0, ring.seq - self._cursor - ring.size),
+            coalesced=0,
+            spilled=0,
+            blocked=0,
+        )
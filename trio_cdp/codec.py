@@ -0,0 +1,137 @@
+'''
+JSON codecs used to encode outgoing commands and decode incoming messages.
+
+Every command and every event passes through a codec, so on busy connections the
+choice of JSON library has a measurable effect on CPU usage. The standard library
+codec is always available. Faster codecs are used only if the corresponding
+package is installed.
+'''
+import abc
+import json
+import typing
+
+
+class Codec(abc.ABC):
+    ''' Base class for JSON codecs. '''
+    #: The name used to select this codec in :func:`get_codec`.
+    name: str = ''
+
+    #: Exception types raised by :meth:`loads` when a message is not valid JSON.
+    decode_errors: typing.Tuple[typing.Type[Exception], ...] = (ValueError,)
+
+    @abc.abstractmethod
+    def dumps(self, obj: dict) -> typing.Union[str, bytes]:
+        '''
+        Encode a JSON object. Returning ``str`` sends a WebSocket text frame,
+        and returning ``bytes`` sends a binary frame.
+        '''
+
+    @abc.abstractmethod
+    def loads(self, message: typing.Union[str, bytes]) -> dict:
+        ''' Decode a JSON message. Must accept both ``str`` and ``bytes``. '''
+
+    def __repr__(self):
+        return '{}<{}>'.format(self.__class__.__name__, self.name)
+
+
+class StdlibCodec(Codec):
+    ''' A codec based on the standard library ``json`` module. '''
+    name = 'json'
+    decode_errors = (json.JSONDecodeError, UnicodeDecodeError)
+
+    def dumps(self, obj):
+        return json.dumps(obj)
+
+    def loads(self, message):
+        return json.loads(message)
+
+
+class OrjsonCodec(Codec):
+    '''
+    A codec based on `orjson <https://github.com/ijl/orjson>`_.
+
+    ``orjson`` encodes directly to UTF-8 bytes. Chrome expects commands in text
+    frames, so by default the encoded bytes are decoded to ``str`` before sending.
+    Set ``binary=True`` to skip that step for servers that accept binary frames.
+    '''
+    name = 'orjson'
+
+    def __init__(self, binary: bool = False):
+        import orjson # type: ignore
+        self._dumps = orjson.dumps
+        self._loads = orjson.loads
+        self.binary = binary
+        self.decode_errors = (orjson.JSONDecodeError,)
+
+    def dumps(self, obj):
+        encoded = self._dumps(obj)
+        return encoded if self.binary else encoded.decode('utf8')
+
+    def loads(self, message):
+        return self._loads(message)
+
+
+class UjsonCodec(Codec):
+    ''' A codec based on `ujson <https://github.com/ultrajson/ultrajson>`_. '''
+    name = 'ujson'
+    decode_errors = (ValueError,)
+
+    def __init__(self):
+        import ujson # type: ignore
+        self._dumps = ujson.dumps
+        self._loads = ujson.loads
+
+    def dumps(self, obj):
+        return self._dumps(obj, ensure_ascii=False)
+
+    def loads(self, message):
+        return self._loads(message)
+
+
+CODECS: typing.Dict[str, typing.Type[Codec]] = {
+    'json': StdlibCodec,
+    'orjson': OrjsonCodec,
+    'ujson': UjsonCodec,
+}
+
+# The order in which codecs are tried when ``'auto'`` is requested.
+_AUTO_ORDER = ('orjson', 'ujson', 'json')
+
+
+def get_codec(codec: typing.Union[None, str, Codec] = None) -> Codec:
+    '''
+    Return a codec instance.
+
+    :param codec: ``None`` or ``'json'`` returns the standard library codec.
+        ``'auto'`` returns the fastest codec that is installed. Any other string
+        selects a codec by name and raises ``ImportError`` if its package is not
+        installed. A :class:`Codec` instance is returned unchanged.
+    '''
+    if isinstance(codec, Codec):
+        return codec
+    if codec is None:
+        return StdlibCodec()
+    if codec == 'auto':
+        for name in _AUTO_ORDER:
+            try:
+                return CODECS[name]()
+            except ImportError:
+                continue
+    try:
+        codec_class = CODECS[codec]
+    except KeyError:
+        raise ValueError('Unknown codec: {!r} (expected one of {})'.format(
+            codec, ', '.join(sorted(CODECS)))) from None
+    return codec_class()
+
+
+def available_codecs() -> typing.List[str]:
+    ''' Return the names of codecs whose packages are installed. '''
+    names = list()
+    for name, codec_class in CODECS.items():
+        try:
+            codec_class()
+        except ImportError:
+            continue
+        names.append(name)
+    return names
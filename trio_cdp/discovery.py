@@ -0,0 +1,347 @@
+'''
+Find a browser's WebSocket URL from its HTTP endpoints.
+
+A browser started with ``--remote-debugging-port`` serves a few JSON documents
+over HTTP on the same port as its WebSocket:
+
+* ``/json/version`` describes the browser and includes the browser target's
+  WebSocket URL, which is what :func:`trio_cdp.open_cdp` needs.
+* ``/json/list`` lists the page targets.
+* ``/json/protocol`` is the protocol descriptor, which describes every domain the
+  browser supports.
+
+A :class:`DiscoveryClient` queries these endpoints and caches the responses per
+``host:port`` for a configurable time. Concurrent requests for the same document
+share one HTTP request, and :meth:`DiscoveryClient.websocket_urls` queries many
+browsers at once:
+
+.. code::
+
+    client = DiscoveryClient()
+    urls = await client.websocket_urls([('127.0.0.1', port) for port in ports])
+'''
+from dataclasses import dataclass
+import logging
+import typing
+
+import trio # type: ignore
+
+from .codec import Codec, get_codec
+
+
+logger = logging.getLogger('trio_cdp')
+
+#: How long, in seconds, a discovery response is cached by default.
+DEFAULT_TTL = 10.0
+#: How long, in seconds, to wait for an HTTP response by default.
+DEFAULT_TIMEOUT = 5.0
+# The protocol descriptor is a few megabytes. Anything much larger is not a
+# DevTools endpoint.
+_MAX_RESPONSE_SIZE = 2**26
+
+Endpoint = typing.Tuple[str, int]
+
+
+class DiscoveryError(Exception):
+    ''' Raised when a browser's HTTP endpoint cannot be reached or returns an
+    unexpected response. '''
+
+
+@dataclass
+class BrowserVersion:
+    ''' The browser description returned by ``/json/version``. '''
+    browser: str
+    protocol_version: str
+    user_agent: str
+    v8_version: str
+    webkit_version: str
+    #: The browser target's WebSocket URL.
+    websocket_url: str
+
+    @classmethod
+    def from_json(cls, json: dict) -> 'BrowserVersion':
+        return cls(
+            browser=json.get('Browser', ''),
+            protocol_version=json.get('Protocol-Version', ''),
+            user_agent=json.get('User-Agent', ''),
+            v8_version=json.get('V8-Version', ''),
+            webkit_version=json.get('WebKit-Version', ''),
+            websocket_url=json['webSocketDebuggerUrl'],
+        )
+
+
+@dataclass
+class TargetDescription:
+    ''' A target listed by ``/json/list``. '''
+    id: str
+    type_: str
+    title: str
+    url: str
+    #: The WebSocket URL for connecting to this target directly. It is empty if
+    #: another client is already connected to the target.
+    websocket_url: str
+
+    @classmethod
+    def from_json(cls, json: dict) -> 'TargetDescription':
+        return cls(
+            id=json['id'],
+            type_=json.get('type', ''),
+            title=json.get('title', ''),
+            url=json.get('url', ''),
+            websocket_url=json.get('webSocketDebuggerUrl', ''),
+        )
+
+
+class _CacheEntry:
+    ''' A cached response, or a request for it that is in progress. '''
+    __slots__ = ('done', 'expires', 'value', 'error', 'cancelled')
+
+    def __init__(self):
+        self.done = trio.Event()
+        self.expires = 0.0
+        self.value: typing.Any = None
+        self.error: typing.Optional[Exception] = None
+        #: True if the task that sent the request was cancelled. Tasks that were
+        #: waiting for the response send their own request instead.
+        self.cancelled = False
+
+
+class DiscoveryClient:
+    '''
+    Queries browsers' HTTP discovery endpoints and caches the results.
+
+    Responses are cached per endpoint and path for ``ttl`` seconds. Failed
+    requests are not cached.
+    '''
+    def __init__(self, ttl: float = DEFAULT_TTL,
+            timeout: float = DEFAULT_TIMEOUT,
+            codec: typing.Union[None, str, Codec] = None):
+        '''
+        Constructor.
+
+        :param ttl: how long to cache each response, in seconds
+        :param timeout: how long to wait for each HTTP response, in seconds
+        :param codec: the codec used to parse responses, see
+            :func:`trio_cdp.codec.get_codec`
+        '''
+        self.ttl = ttl
+        self.timeout = timeout
+        self.codec = get_codec(codec)
+        #: The number of HTTP requests sent.
+        self.requests = 0
+        #: The number of lookups answered from the cache, including lookups that
+        #: waited for a request that was already in progress.
+        self.hits = 0
+        self._cache: typing.Dict[typing.Tuple[str, int, str], _CacheEntry] = \
+            dict()
+
+    async def version(self, host: str, port: int) -> BrowserVersion:
+        ''' Return the browser's ``/json/version`` description. '''
+        document = await self.get_json(host, port, '/json/version')
+        try:
+            return BrowserVersion.from_json(document)
+        except (KeyError, TypeError, AttributeError) as exc:
+            raise DiscoveryError('Unexpected version description from '
+                'http://{}:{}/json/version'.format(host, port)) from exc
+
+    async def websocket_url(self, host: str, port: int) -> str:
+        ''' Return the browser target's WebSocket URL. '''
+        return (await self.version(host, port)).websocket_url
+
+    async def targets(self, host: str, port: int) -> \
+            typing.List[TargetDescription]:
+        ''' Return the page targets listed by ``/json/list``. '''
+        document = await self.get_json(host, port, '/json/list')
+        try:
+            return [TargetDescription.from_json(target) for target in document]
+        except (KeyError, TypeError, AttributeError) as exc:
+            raise DiscoveryError('Unexpected target list from '
+                'http://{}:{}/json/list'.format(host, port)) from exc
+
+    async def protocol(self, host: str, port: int) -> dict:
+        ''' Return the browser's protocol descriptor. '''
+        return await self.get_json(host, port, '/json/protocol')
+
+    async def websocket_urls(self, endpoints: typing.Iterable[Endpoint],
+            max_concurrency: typing.Optional[int] = None) -> \
+            typing.List[typing.Union[str, DiscoveryError]]:
+        '''
+        Query many browsers concurrently and return their WebSocket URLs.
+
+        The results are in the same order as ``endpoints``. If a browser cannot be
+        queried, its result is the :class:`DiscoveryError` instead of a URL, so one
+        unreachable browser does not hide the others.
+
+        :param endpoints: ``(host, port)`` pairs
+        :param max_concurrency: if set, the maximum number of requests in progress
+            at once
+        '''
+        endpoints = list(endpoints)
+        results: typing.List[typing.Union[str, DiscoveryError]] = \
+            [None] * len(endpoints) # type: ignore
+        limiter = trio.CapacityLimiter(max_concurrency or max(1,
+            len(endpoints)))
+
+        async def query(index, host, port):
+            async with limiter:
+                try:
+                    results[index] = await self.websocket_url(host, port)
+                except DiscoveryError as de:
+                    results[index] = de
+
+        async with trio.open_nursery() as nursery:
+            for index, (host, port) in enumerate(endpoints):
+                nursery.start_soon(query, index, host, port)
+        return results
+
+    def invalidate(self, host: typing.Optional[str] = None,
+            port: typing.Optional[int] = None):
+        ''' Remove cached responses, either all of them or those for one
+        endpoint. Requests in progress are not affected. '''
+        for key in list(self._cache):
+            if (host is None or key[0] == host) and \
+                    (port is None or key[1] == port) and \
+                    self._cache[key].done.is_set():
+                del self._cache[key]
+
+    async def get_json(self, host: str, port: int, path: str) -> typing.Any:
+        '''
+        Return the parsed JSON document at ``path``, from the cache if possible.
+
+        :raises DiscoveryError: if the request fails
+        '''
+        key = (host, port, path)
+        while True:
+            entry = self._cache.get(key)
+            if entry is None or (entry.done.is_set() and
+                    trio.current_time() >= entry.expires):
+                break
+            self.hits += 1
+            await entry.done.wait()
+            if entry.cancelled:
+                # The request was abandoned, so try again.
+                continue
+            if entry.error is not None:
+                raise entry.error
+            return entry.value
+        entry = _CacheEntry()
+        self._cache[key] = entry
+        try:
+            entry.value = await self._fetch(host, port, path)
+            entry.expires = trio.current_time() + self.ttl
+        except BaseException as exc:
+            if self._cache.get(key) is entry:
+                del self._cache[key]
+            if isinstance(exc, DiscoveryError):
+                entry.error = exc
+            else:
+                entry.cancelled = True
+            raise
+        finally:
+            entry.done.set()
+        return entry.value
+
+    async def _fetch(self, host: str, port: int, path: str) -> typing.Any:
+        ''' Send one HTTP request and parse the JSON response. '''
+        self.requests += 1
+        logger.debug('Requesting http://%s:%d%s', host, port, path)
+        try:
+            with trio.fail_after(self.timeout):
+                response = await _http_get(host, port, path)
+        except trio.TooSlowError:
+            raise DiscoveryError('Timed out requesting http://{}:{}{}'.format(
+                host, port, path)) from None
+        except OSError as ose:
+            raise DiscoveryError('Unable to request http://{}:{}{}: {}'.format(
+                host, port, path, ose)) from ose
+        try:
+            return self.codec.loads(response)
+        except self.codec.decode_errors as exc:
+            raise DiscoveryError('Invalid JSON from http://{}:{}{}'.format(
+                host, port, path)) from exc
+
+
+async def _http_get(host: str, port: int, path: str) -> bytes:
+    '''
+    Send an HTTP/1.0 GET request and return the response body.
+
+    HTTP/1.0 is enough for the DevTools endpoints. The body is read up to its
+    ``Content-Length``, so servers that keep the connection open work too. If
+    there is no ``Content-Length``, the body is everything until the server
+    closes the connection.
+    '''
+    request = ('GET {} HTTP/1.0\r\nHost: {}:{}\r\nConnection: close\r\n\r\n'
+        .format(path, host, port))
+    url = 'http://{}:{}{}'.format(host, port, path)
+    stream = await trio.open_tcp_stream(host, port)
+    async with stream:
+        await stream.send_all(request.encode('ascii'))
+        buffer = bytearray()
+        length: typing.Optional[int] = None
+        head_size = None
+        while True:
+            if head_size is None:
+                end = buffer.find(b'\r\n\r\n')
+                if end != -1:
+                    head_size = end + 4
+                    head = bytes(buffer[:end]).decode('latin-1')
+                    length = _content_length(head, url)
+            if length is not None and len(buffer) >= head_size + length:
+                break
+            data = await stream.receive_some(65536)
+            if not data:
+                break
+            buffer += data
+            if len(buffer) > _MAX_RESPONSE_SIZE:
+                raise DiscoveryError('Response from {} is too large'.format(url))
+    if head_size is None or (length is not None and
+            len(buffer) < head_size + length):
+        raise DiscoveryError('Incomplete response from {}'.format(url))
+    status_line = head.split('\r\n', 1)[0]
+    parts = status_line.split(' ', 2)
+    if len(parts) < 2 or parts[1] != '200':
+        raise DiscoveryError('Unexpected response from {}: {}'.format(url,
+            status_line))
+    end = head_size + length if length is not None else len(buffer)
+    return bytes(buffer[head_size:end])
+
+
+def _content_length(head: str, url: str) -> typing.Optional[int]:
+    ''' Return the ``Content-Length`` of a response, if it has one. '''
+    for line in head.split('\r\n')[1:]:
+        name, _, value = line.partition(':')
+        if name.strip().lower() == 'content-length':
+            try:
+                length = int(value.strip())
+            except ValueError:
+                length = -1
+            if not 0 <= length <= _MAX_RESPONSE_SIZE:
+                raise DiscoveryError('Invalid Content-Length from {}: {}'
+                    .format(url, value.strip()))
+            return length
+    return None
+
+
+# The client used by get_websocket_url(). Its cache holds Trio events and
+# deadlines, which belong to one call to trio.run(), so each run gets its own.
+_default_client = trio.lowlevel.RunVar('trio_cdp.discovery.default_client')
+
+
+async def get_websocket_url(host: str = '127.0.0.1', port: int = 9222) -> str:
+    '''
+    Return the browser target's WebSocket URL for a browser started with
+    ``--remote-debugging-port``, using a :class:`DiscoveryClient` that is shared
+    within the current Trio run.
+
+    .. code::
+
+        url = await get_websocket_url(port=9222)
+        async with open_cdp(url) as conn:
+            ...
+    '''
+    try:
+        client = _default_client.get()
+    except LookupError:
+        client = DiscoveryClient()
+        _default_client.set(client)
+    return await client.websocket_url(host, port)
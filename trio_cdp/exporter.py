@@ -0,0 +1,220 @@
+'''
+Serve connection metrics in the Prometheus text exposition format.
+
+:func:`serve_metrics` is a Trio task that serves the metrics of every open
+:class:`trio_cdp.CdpConnection` on a local HTTP port, so that Prometheus (or
+anything else that reads its text format) can scrape them without any other
+service:
+
+.. code::
+
+    async with trio.open_nursery() as nursery:
+        await nursery.start(serve_metrics, 9464)
+        async with open_cdp(url) as conn:
+            conn.label = 'browser1'
+            ...
+
+Each connection's metrics are labeled with ``browser="<conn.label>"``. The
+exporter includes per-method latency histograms, command and event counters,
+listener channel gauges, sessions, and reconnects of resilient connections. Event
+rates are computed by Prometheus from the event counters, e.g.
+``rate(trio_cdp_events_total[1m])``.
+
+Latency histograms are exported with a fixed set of bucket bounds,
+:data:`DEFAULT_BUCKETS` unless others are passed to :func:`serve_metrics`, so every
+scrape has the same series and they can be aggregated across methods and
+connections. The counts come from the finer buckets of
+:class:`trio_cdp.metrics.LatencyHistogram`.
+'''
+from functools import partial
+import logging
+import typing
+
+import trio # type: ignore
+
+from . import open_connections
+
+
+logger = logging.getLogger('trio_cdp')
+
+#: The port that :func:`serve_metrics` listens on by default.
+DEFAULT_PORT = 9464
+#: The latency histogram bucket bounds, in seconds, that are exported by default.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+    2.5, 5.0, 10.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# Requests are only a few lines. A client that sends more, or that does not
+# finish its request in time, is disconnected.
+_MAX_REQUEST_SIZE = 8192
+_REQUEST_TIMEOUT = 5.0
+
+
+class _Family:
+    ''' A metric family and its samples. '''
+    def __init__(self, name: str, type_: str, help_: str):
+        self.name = name
+        self.type = type_
+        self.help = help_
+        self.samples: typing.List[typing.Tuple[str, str, typing.Any]] = list()
+
+    def add(self, labels: str, value, suffix: str = ''):
+        self.samples.append((suffix, labels, value))
+
+    def render(self, lines: typing.List[str]):
+        lines.append('# HELP {} {}'.format(self.name, self.help))
+        lines.append('# TYPE {} {}'.format(self.name, self.type))
+        for suffix, labels, value in self.samples:
+            lines.append('{}{}{{{}}} {}'.format(self.name, suffix, labels,
+                _format_value(value)))
+
+
+def _escape(value: str) -> str:
+    ''' Escape a label value. '''
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _format_value(value) -> str:
+    if isinstance(value, float):
+        if value == float('inf'):
+            return '+Inf'
+        return repr(value)
+    return str(value)
+
+
+def render_metrics(connections: typing.Optional[typing.Iterable] = None,
+        buckets: typing.Sequence[float] = DEFAULT_BUCKETS) -> str:
+    '''
+    Return the metrics of some connections in the Prometheus text format.
+
+    :param connections: the connections to include. The default is every open
+        connection, see :func:`trio_cdp.open_connections`.
+    :param buckets: the latency histogram bucket bounds, in seconds
+    '''
+    if connections is None:
+        connections = open_connections()
+    connections = list(connections)
+    buckets = sorted(buckets)
+    bounds = ['le="{}"'.format(_format_value(float(bound)))
+        for bound in buckets]
+    latency = _Family('trio_cdp_command_latency_seconds', 'histogram',
+        'Time from sending a command until its response arrived.')
+    errors = _Family('trio_cdp_command_errors_total', 'counter',
+        'Commands whose response was an error.')
+    bytes_sent = _Family('trio_cdp_command_sent_bytes_total', 'counter',
+        'Size of the commands sent.')
+    bytes_received = _Family('trio_cdp_command_received_bytes_total', 'counter',
+        'Size of the command responses received.')
+    events = _Family('trio_cdp_events_total', 'counter',
+        'Events received.')
+    event_bytes = _Family('trio_cdp_event_received_bytes_total', 'counter',
+        'Size of the events received.')
+    in_flight = _Family('trio_cdp_in_flight_commands', 'gauge',
+        'Commands waiting for a response.')
+    sessions = _Family('trio_cdp_sessions', 'gauge',
+        'Open sessions.')
+    channels = _Family('trio_cdp_listener_channels', 'gauge',
+        'Open listener channels.')
+    queued = _Family('trio_cdp_queued_events', 'gauge',
+        'Events waiting in listener channels.')
+    dropped = _Family('trio_cdp_dropped_events_total', 'counter',
+        'Events dropped by listener channels.')
+    reconnects = _Family('trio_cdp_reconnects_total', 'counter',
+        'Times the connection was restored after its WebSocket closed.')
+    families = (latency, errors, bytes_sent, bytes_received, events,
+        event_bytes, in_flight, sessions, channels, queued, dropped, reconnects)
+
+    for conn in connections:
+        browser = 'browser="{}"'.format(_escape(conn.label))
+        for method, metrics in sorted(conn.metrics.methods.items()):
+            labels = '{},method="{}"'.format(browser, _escape(method))
+            counts = metrics.latency.cumulative_counts(buckets)
+            for bound, count in zip(bounds, counts):
+                latency.add('{},{}'.format(labels, bound), count, '_bucket')
+            latency.add('{},le="+Inf"'.format(labels), metrics.latency.count,
+                '_bucket')
+            latency.add(labels, metrics.latency.total, '_sum')
+            latency.add(labels, metrics.latency.count, '_count')
+            errors.add(labels, metrics.errors)
+            bytes_sent.add(labels, metrics.bytes_sent)
+            bytes_received.add(labels, metrics.bytes_received)
+        for method, metrics in sorted(conn.metrics.events.items()):
+            labels = '{},method="{}"'.format(browser, _escape(method))
+            events.add(labels, metrics.count)
+            event_bytes.add(labels, metrics.bytes_received)
+        snapshot = conn.metrics_snapshot()
+        in_flight.add(browser, snapshot.in_flight)
+        sessions.add(browser, snapshot.sessions)
+        channels.add(browser, snapshot.channels)
+        queued.add(browser, snapshot.queued_events)
+        dropped.add(browser, snapshot.dropped_events_total)
+        reconnects.add(browser, getattr(conn, 'reconnects', 0))
+
+    lines: typing.List[str] = list()
+    lines.append('# HELP trio_cdp_connections Open CDP connections.')
+    lines.append('# TYPE trio_cdp_connections gauge')
+    lines.append('trio_cdp_connections {}'.format(len(connections)))
+    for family in families:
+        family.render(lines)
+    lines.append('')
+    return '\n'.join(lines)
+
+
+async def serve_metrics(port: int = DEFAULT_PORT, host: str = '127.0.0.1', *,
+        buckets: typing.Sequence[float] = DEFAULT_BUCKETS,
+        task_status=trio.TASK_STATUS_IGNORED):
+    '''
+    Serve the metrics of every open connection over HTTP until cancelled.
+
+    The metrics are served at ``/metrics`` (and at ``/``). Start this with
+    ``nursery.start()`` to wait until the port is open; the start value is the
+    list of listeners, so port 0 can be used to pick a free port.
+
+    :param port: the TCP port to listen on
+    :param host: the address to listen on. The default only accepts local
+        connections.
+    :param buckets: the latency histogram bucket bounds, in seconds
+    '''
+    await trio.serve_tcp(partial(_handle_scrape, buckets=buckets), port,
+        host=host, task_status=task_status)
+
+
+async def _handle_scrape(stream: trio.abc.Stream,
+        buckets: typing.Sequence[float] = DEFAULT_BUCKETS):
+    ''' Answer one HTTP request. '''
+    async with stream:
+        request = b''
+        with trio.move_on_after(_REQUEST_TIMEOUT):
+            while b'\r\n\r\n' not in request and b'\n\n' not in request:
+                if len(request) > _MAX_REQUEST_SIZE:
+                    return
+                try:
+                    data = await stream.receive_some(4096)
+                except trio.BrokenResourceError:
+                    return
+                if not data:
+                    break
+                request += data
+        parts = request.split(b'\r\n', 1)[0].split(b'\n', 1)[0].split()
+        if len(parts) < 2:
+            return
+        method, path = parts[0], parts[1].split(b'?', 1)[0]
+        if method not in (b'GET', b'HEAD'):
+            status, body = '405 Method Not Allowed', ''
+        elif path not in (b'/', b'/metrics'):
+            status, body = '404 Not Found', ''
+        else:
+            status = '200 OK'
+            try:
+                body = render_metrics(buckets=buckets)
+            except Exception:
+                logger.exception('Failed to render metrics')
+                status, body = '500 Internal Server Error', ''
+        content = body.encode('utf8')
+        head = ('HTTP/1.0 {}\r\nContent-Type: {}\r\nContent-Length: {}\r\n'
+            'Connection: close\r\n\r\n').format(status, CONTENT_TYPE,
+            len(content)).encode('ascii')
+        try:
+            await stream.send_all(head if method == b'HEAD' else head +
+                content)
+        except trio.BrokenResourceError:
+            pass
@@ -0,0 +1,124 @@
+'''
+Instrumentation hooks for commands, responses, and events.
+
+Tracing, sampling loggers, and profilers can observe a connection's traffic by
+adding hooks to :attr:`trio_cdp.CdpConnection.hooks`. The hooks are shared by the
+connection and all of its sessions. There are four kinds of hooks:
+
+* ``pre_send`` is called just before a command is written.
+* ``post_response`` is called when a command's successful response arrives.
+* ``on_error`` is called when a command fails: the browser returned an error, the
+  command could not be written, or its session or connection closed before the
+  response arrived.
+* ``on_event`` is called for each incoming event, before it is parsed.
+
+A hook is a regular function that takes a :class:`HookInfo`. It runs in the task
+that sends the command, or in the reader task for responses and events, so it must
+not block. Exceptions raised by a hook are logged and ignored.
+
+.. code::
+
+    def trace(info):
+        print(info.method, info.session_id, info.latency)
+
+    conn.hooks.add('post_response', trace)
+
+When no hooks of a kind are installed, the cost is a single list check per
+message.
+'''
+import copy
+import logging
+import typing
+
+
+logger = logging.getLogger('trio_cdp')
+
+HOOK_KINDS = ('pre_send', 'post_response', 'on_error', 'on_event')
+
+
+class HookInfo:
+    ''' Describes the message that a hook is called for. '''
+    __slots__ = ('kind', 'method', 'session_id', 'command_id', 'time', 'latency',
+        'size', 'error', 'payload')
+
+    def __init__(self, kind: str, method: str, session_id, command_id=None,
+            time: float = 0.0, latency: typing.Optional[float] = None,
+            size: int = 0, error: typing.Optional[BaseException] = None):
+        #: The kind of hook, e.g. ``"pre_send"``.
+        self.kind = kind
+        #: The CDP method of the command or event.
+        self.method = method
+        #: The session ID, or ``None`` for the root session.
+        self.session_id = session_id
+        #: The command ID, or ``None`` for events.
+        self.command_id = command_id
+        #: When the hook was called, from ``time.perf_counter()``.
+        self.time = time
+        #: For responses and errors, the time in seconds since the command was
+        #: sent.
+        self.latency = latency
+        #: The size of the message, or 0 if it is not known.
+        self.size = size
+        #: For ``on_error``, the exception.
+        self.error = error
+        #: The message as a JSON dictionary. This is only set for hooks that were
+        #: added with ``raw=True``.
+        self.payload: typing.Optional[dict] = None
+
+    def __repr__(self):
+        return 'HookInfo<{} {} session={} id={}>'.format(self.kind, self.method,
+            self.session_id, self.command_id)
+
+
+class Hooks:
+    '''
+    The hooks installed on a connection. Each attribute named after a hook kind
+    is a list of ``(hook, raw)`` pairs.
+    '''
+    def __init__(self):
+        self.pre_send: typing.List[typing.Tuple[typing.Callable, bool]] = list()
+        self.post_response: typing.List[typing.Tuple[typing.Callable, bool]] = \
+            list()
+        self.on_error: typing.List[typing.Tuple[typing.Callable, bool]] = list()
+        self.on_event: typing.List[typing.Tuple[typing.Callable, bool]] = list()
+
+    def add(self, kind: str, hook: typing.Callable[[HookInfo], None],
+            raw: bool = False):
+        '''
+        Install a hook.
+
+        :param kind: one of ``"pre_send"``, ``"post_response"``, ``"on_error"``,
+            or ``"on_event"``
+        :param hook: a function that takes a :class:`HookInfo`
+        :param raw: if true, :attr:`HookInfo.payload` is set to the message.
+            Hooks that keep payloads may keep large responses alive.
+        '''
+        self._hooks(kind).append((hook, raw))
+
+    def remove(self, kind: str, hook: typing.Callable[[HookInfo], None]):
+        ''' Remove a hook. It is not an error to remove a hook that is not
+        installed. '''
+        hooks = self._hooks(kind)
+        hooks[:] = [entry for entry in hooks if entry[0] != hook]
+
+    def _hooks(self, kind: str) -> typing.List[typing.Tuple[typing.Callable,
+            bool]]:
+        if kind not in HOOK_KINDS:
+            raise ValueError('Unknown hook kind: {!r}'.format(kind))
+        return getattr(self, kind)
+
+
+def call_hooks(hooks: typing.List[typing.Tuple[typing.Callable, bool]],
+        info: HookInfo, payload: typing.Optional[dict]):
+    ''' Call each hook with ``info``. Hooks that asked for the raw payload get a
+    copy of ``info`` that includes it. '''
+    for hook, raw in list(hooks):
+        if raw:
+            hook_info = copy.copy(info)
+            hook_info.payload = payload
+        else:
+            hook_info = info
+        try:
+            hook(hook_info)
+        except Exception:
+            logger.exception('Instrumentation hook %r failed', hook)
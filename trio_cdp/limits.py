@@ -0,0 +1,162 @@
+'''
+Limits on the number of commands that are waiting for a response.
+
+A browser runs the commands for a target on that target's renderer, so a job that
+sends thousands of commands at once can stall every other tab that shares the
+renderer or the browser. :meth:`trio_cdp.CdpConnection.set_limits` caps the number
+of outstanding commands per connection, per session, and per method or domain.
+Method and domain caps apply to the connection as a whole, so a cap of 2 on
+``Page.captureScreenshot`` allows two screenshots at once across all sessions.
+When a cap is reached, further commands wait in a queue until an earlier command
+gets its response; they do not fail.
+
+.. code::
+
+    conn.set_limits(connection=200, session=20,
+        methods={'Page.captureScreenshot': 2})
+
+Limits apply to commands sent with ``execute()`` and ``execute_many()``.
+'''
+from dataclasses import dataclass
+import typing
+
+import trio # type: ignore
+
+
+@dataclass
+class LimitStats:
+    ''' A snapshot of one limit's counters. '''
+    #: What the limit applies to, e.g. ``"connection"``, ``"session"``, or a
+    #: method or domain name.
+    name: str
+    #: The largest number of outstanding commands.
+    limit: int
+    #: The number of outstanding commands.
+    in_flight: int
+    #: The number of commands waiting for the limit.
+    waiting: int
+    #: The number of commands that have passed the limit.
+    acquired: int
+    #: The number of commands that had to wait.
+    waited: int
+    #: The average time, in seconds, that commands waited.
+    mean_wait: float
+    #: The longest time, in seconds, that a command waited.
+    max_wait: float
+
+
+class ConcurrencyLimit:
+    ''' Caps the number of outstanding commands and queues the rest in FIFO
+    order. '''
+    def __init__(self, name: str, limit: int):
+        if limit < 1:
+            raise ValueError('A concurrency limit must be at least 1')
+        self.name = name
+        self.limit = limit
+        self._semaphore = trio.Semaphore(limit)
+        self._acquired = 0
+        self._waited = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+
+    async def acquire(self):
+        ''' Wait until fewer than ``limit`` commands are outstanding. '''
+        semaphore = self._semaphore
+        if semaphore.value > 0:
+            semaphore.acquire_nowait()
+        else:
+            start = trio.current_time()
+            await semaphore.acquire()
+            wait = trio.current_time() - start
+            self._waited += 1
+            self._total_wait += wait
+            if wait > self._max_wait:
+                self._max_wait = wait
+        self._acquired += 1
+
+    def release(self):
+        ''' Release a command's slot. '''
+        self._semaphore.release()
+
+    def stats(self) -> LimitStats:
+        ''' Return a snapshot of this limit's counters. '''
+        return LimitStats(name=self.name, limit=self.limit,
+            in_flight=self.limit - self._semaphore.value,
+            waiting=self._semaphore.statistics().tasks_waiting,
+            acquired=self._acquired, waited=self._waited,
+            mean_wait=self._total_wait / self._waited if self._waited else 0.0,
+            max_wait=self._max_wait)
+
+
+class CommandLimits:
+    '''
+    The limits that apply to the commands of one session (or of a connection's
+    root session).
+
+    Limits are acquired from the narrowest to the broadest: the method limit,
+    then the domain limit, then the session limit, then the connection limit.
+    Acquiring them in a fixed order means that two commands can never wait on
+    each other.
+    '''
+    def __init__(self, session: typing.Optional[ConcurrencyLimit],
+            connection: typing.Optional[ConcurrencyLimit],
+            methods: typing.Optional[typing.Mapping[str,
+                ConcurrencyLimit]] = None):
+        '''
+        Constructor.
+
+        :param session: the limit for this session only
+        :param connection: the limit shared by every session on the connection
+        :param methods: limits by method name (e.g. ``"Page.captureScreenshot"``)
+            or domain name (e.g. ``"Page"``). These are usually shared by every
+            session on the connection too.
+        '''
+        self._method_limits = dict(methods or {})
+        self._broad = tuple(limit for limit in (session, connection)
+            if limit is not None)
+        # Maps a method to the limits that apply to it, narrowest first.
+        self._chains: typing.Dict[str, typing.Tuple[ConcurrencyLimit, ...]] = \
+            dict()
+
+    async def acquire(self, method: str) -> typing.Tuple[ConcurrencyLimit, ...]:
+        '''
+        Wait until a command for ``method`` may be sent.
+
+        :returns: the limits that were acquired, which must be passed to
+            :meth:`release` when the command is done
+        '''
+        chain = self._chains.get(method)
+        if chain is None:
+            chain = self._chains[method] = self._chain(method)
+        acquired = 0
+        try:
+            for limit in chain:
+                await limit.acquire()
+                acquired += 1
+        except BaseException:
+            self.release(chain[:acquired])
+            raise
+        return chain
+
+    @staticmethod
+    def release(limits: typing.Iterable[ConcurrencyLimit]):
+        ''' Release limits returned by :meth:`acquire`. '''
+        for limit in limits:
+            limit.release()
+
+    def stats(self) -> typing.List[LimitStats]:
+        ''' Return a snapshot of each limit's counters, with the method and
+        domain limits first. Shared limits include the commands of other
+        sessions. '''
+        return [limit.stats() for limit in self._method_limits.values()] + \
+            [limit.stats() for limit in self._broad]
+
+    def _chain(self, method: str) -> typing.Tuple[ConcurrencyLimit, ...]:
+        domain = method.partition('.')[0]
+        chain = list()
+        for name in (method, domain):
+            limit = self._method_limits.get(name)
+            if limit is not None:
+                chain.append(limit)
+        chain.extend(self._broad)
+        return tuple(chain)
@@ -0,0 +1,238 @@
+'''
+Command and event metrics.
+
+Every :class:`trio_cdp.CdpConnection` records, for each CDP method, how many
+commands were sent, how many failed, how many bytes they sent and received, and a
+histogram of their latency. It also counts the events it receives by method. Its
+sessions record into the same :class:`Metrics` object.
+
+Recording costs a few dictionary lookups and additions per message. Gauges such as
+the number of in-flight commands are not tracked on the hot path; they are computed
+when :meth:`trio_cdp.CdpConnection.metrics_snapshot` is called.
+
+Latency histograms use logarithmic buckets with 8 linear sub-buckets per power of
+two, like a low-precision HDR histogram. Values are recorded in microseconds, and
+each bucket's width is at most 12.5% of its lower bound, so percentiles are
+accurate to within that much.
+'''
+from dataclasses import dataclass
+import typing
+
+
+# The number of sub-buckets per power of two is 2 ** _SUB_BITS.
+_SUB_BITS = 3
+_SUB_COUNT = 1 << _SUB_BITS
+# Values below this many microseconds each get their own bucket.
+_LINEAR_LIMIT = 2 * _SUB_COUNT
+
+
+def _bucket_index(value: int) -> int:
+    ''' Return the bucket index for a non-negative integer value. '''
+    if value < _LINEAR_LIMIT:
+        return value
+    shift = value.bit_length() - _SUB_BITS - 1
+    return _LINEAR_LIMIT + (shift - 1) * _SUB_COUNT + (value >> shift) - \
+        _SUB_COUNT
+
+
+def _bucket_upper_bound(index: int) -> int:
+    ''' Return the smallest value that is above the bucket at ``index``. '''
+    if index < _LINEAR_LIMIT:
+        return index + 1
+    shift, sub = divmod(index - _LINEAR_LIMIT, _SUB_COUNT)
+    return (_SUB_COUNT + sub + 1) << (shift + 1)
+
+
+@dataclass
+class HistogramSnapshot:
+    ''' A summary of a latency histogram. Times are in seconds. '''
+    count: int
+    total: float
+    min: float
+    max: float
+    p50: float
+    p90: float
+    p99: float
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+
+class LatencyHistogram:
+    ''' A histogram of durations with logarithmic buckets. '''
+    __slots__ = ('counts', 'count', 'total', 'min', 'max')
+
+    def __init__(self):
+        self.counts: typing.List[int] = list()
+        self.count = 0
+        #: The sum of the recorded durations, in seconds.
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+
+    def record(self, seconds: float):
+        ''' Record a duration. '''
+        index = _bucket_index(max(0, int(seconds * 1_000_000)))
+        counts = self.counts
+        if index >= len(counts):
+            counts.extend([0] * (index + 1 - len(counts)))
+        counts[index] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds < self.min:
+            self.min = seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, percent: float) -> float:
+        ''' Return an upper bound, in seconds, for the given percentile of the
+        recorded durations. '''
+        if not self.count:
+            return 0.0
+        threshold = self.count * percent / 100
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= threshold:
+                return min(_bucket_upper_bound(index) / 1_000_000, self.max)
+        return self.max
+
+    def buckets(self) -> typing.List[typing.Tuple[float, int]]:
+        ''' Return ``(upper_bound, count)`` for each non-empty bucket, with
+        bounds in seconds. '''
+        return [(_bucket_upper_bound(index) / 1_000_000, count)
+            for index, count in enumerate(self.counts) if count]
+
+    def cumulative_counts(self, bounds: typing.Sequence[float]) -> \
+            typing.List[int]:
+        '''
+        Return the number of recorded durations at or below each of ``bounds``,
+        which are in seconds and must be sorted.
+
+        A duration is counted under a bound only if its whole bucket is, so a
+        count can be low by the durations within a bucket's width of its bound.
+        '''
+        result = list()
+        counts = self.counts
+        index = seen = 0
+        for bound in bounds:
+            limit = bound * 1_000_000
+            while index < len(counts) and _bucket_upper_bound(index) <= limit:
+                seen += counts[index]
+                index += 1
+            result.append(seen)
+        return result
+
+    def snapshot(self) -> HistogramSnapshot:
+        return HistogramSnapshot(count=self.count, total=self.total,
+            min=self.min if self.count else 0.0, max=self.max,
+            p50=self.percentile(50), p90=self.percentile(90),
+            p99=self.percentile(99))
+
+
+class MethodMetrics:
+    ''' The counters for one CDP method. '''
+    __slots__ = ('count', 'errors', 'bytes_sent', 'bytes_received', 'latency')
+
+    def __init__(self):
+        #: The number of responses received.
+        self.count = 0
+        #: The number of responses that were errors.
+        self.errors = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.latency = LatencyHistogram()
+
+
+class EventMetrics:
+    ''' The counters for one event method. '''
+    __slots__ = ('count', 'bytes_received')
+
+    def __init__(self):
+        self.count = 0
+        self.bytes_received = 0
+
+
+@dataclass
+class MethodSnapshot:
+    ''' A snapshot of one CDP method's counters. '''
+    count: int
+    errors: int
+    bytes_sent: int
+    bytes_received: int
+    latency: HistogramSnapshot
+
+
+@dataclass
+class EventSnapshot:
+    ''' A snapshot of one event method's counters. '''
+    count: int
+    bytes_received: int
+
+
+@dataclass
+class MetricsSnapshot:
+    ''' A point-in-time copy of a connection's metrics. '''
+    #: Command counters by method name.
+    methods: typing.Dict[str, MethodSnapshot]
+    #: Event counters by method name.
+    events: typing.Dict[str, EventSnapshot]
+    #: The number of commands waiting for a response.
+    in_flight: int
+    #: The number of open sessions.
+    sessions: int
+    #: The number of listener channels.
+    channels: int
+    #: The number of events waiting in listener channels.
+    queued_events: int
+    #: The number of events that the open listener channels have dropped.
+    dropped_events: int
+    #: The number of events that listener channels have dropped since the
+    #: connection opened, including channels that have since closed. Unlike
+    #: :attr:`dropped_events`, this never decreases.
+    dropped_events_total: int
+
+
+class Metrics:
+    ''' The command and event counters for a connection and its sessions. '''
+    def __init__(self):
+        self.methods: typing.Dict[str, MethodMetrics] = dict()
+        self.events: typing.Dict[str, EventMetrics] = dict()
+        #: The number of events dropped by listener channels that have been
+        #: removed from the connection.
+        self.dropped_events = 0
+
+    def record_command(self, method: str, latency: float, bytes_sent: int,
+            bytes_received: int, error: bool):
+        ''' Record a command's response. '''
+        metrics = self.methods.get(method)
+        if metrics is None:
+            metrics = self.methods[method] = MethodMetrics()
+        metrics.count += 1
+        if error:
+            metrics.errors += 1
+        metrics.bytes_sent += bytes_sent
+        metrics.bytes_received += bytes_received
+        metrics.latency.record(latency)
+
+    def record_event(self, method: str, size: int):
+        ''' Record an incoming event. '''
+        metrics = self.events.get(method)
+        if metrics is None:
+            metrics = self.events[method] = EventMetrics()
+        metrics.count += 1
+        metrics.bytes_received += size
+
+    def snapshot(self, **gauges) -> MetricsSnapshot:
+        ''' Copy the counters. The keyword arguments are the fields of
+        :class:`MetricsSnapshot` that the connection computes. '''
+        return MetricsSnapshot(
+            methods={method: MethodSnapshot(count=m.count, errors=m.errors,
+                bytes_sent=m.bytes_sent, bytes_received=m.bytes_received,
+                latency=m.latency.snapshot())
+                for method, m in self.methods.items()},
+            events={method: EventSnapshot(count=e.count,
+                bytes_received=e.bytes_received)
+                for method, e in self.events.items()},
+            **gauges)
@@ -0,0 +1,798 @@
+'''
+Pools of browser resources.
+
+Creating a target, attaching a session, and enabling domains costs several round
+trips plus renderer startup. The tab and browser context pools in this module pay
+that cost ahead of time so that it stays off the hot path of each job. The browser
+pool spreads sessions across several browsers.
+'''
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+import logging
+import typing
+
+import cdp
+import trio # type: ignore
+
+from . import BrowserError, CdpConnection, CdpConnectionClosed, CdpSession, \
+    CdpSessionClosed, connect_cdp
+from .context import session_context
+
+
+logger = logging.getLogger('trio_cdp')
+
+#: The commands that a :class:`TabPool` runs on each new tab by default.
+DEFAULT_ENABLE_COMMANDS = (cdp.page.enable, cdp.network.enable)
+
+# Errors that mean a tab or its connection is unusable. Background tasks log
+# these instead of letting them cancel the pool.
+_TAB_ERRORS = (BrowserError, CdpConnectionClosed, CdpSessionClosed)
+
+# How long to wait for a target to close when cleaning up after a failure.
+_CLEANUP_TIMEOUT = 5
+
+
+def _reset_commands(enable_commands: typing.Sequence[typing.Callable]):
+    '''
+    The commands that a :class:`TabPool` runs to reset a tab after use. Network
+    state is only reset if the Network domain is enabled.
+    '''
+    commands = [
+        cdp.page.navigate('about:blank'),
+        cdp.emulation.clear_device_metrics_override(),
+        cdp.emulation.clear_geolocation_override(),
+    ]
+    if cdp.network.enable in enable_commands:
+        commands.append(cdp.network.set_extra_http_headers(
+            cdp.network.Headers({})))
+    return commands
+
+
+async def _close_target(conn: CdpConnection, target_id: cdp.target.TargetID):
+    '''
+    Close a target, ignoring errors. This is used to clean up after a failure,
+    so it runs even if the calling task is cancelled.
+    '''
+    with trio.CancelScope(shield=True):
+        with trio.move_on_after(_CLEANUP_TIMEOUT):
+            try:
+                await conn.execute(cdp.target.close_target(target_id))
+            except (BrowserError, CdpConnectionClosed):
+                # The target is already gone.
+                pass
+
+
+@dataclass
+class TabPoolStats:
+    ''' A snapshot of a :class:`TabPool`'s counters. '''
+    #: The number of idle tabs that are ready to be handed out.
+    idle: int
+    #: The number of tabs that are currently handed out.
+    in_use: int
+    #: The total number of tabs created.
+    created: int
+    #: The total number of tabs retired.
+    retired: int
+
+
+class Tab:
+    ''' A pooled tab: a target and a session attached to it. '''
+    def __init__(self, session: CdpSession):
+        self.session = session
+        self.target_id = session.target_id
+        #: The number of times this tab has been handed out.
+        self.uses = 0
+
+
+class TabPool:
+    '''
+    Keeps a number of pre-created, pre-enabled ``about:blank`` tabs and hands
+    them out to jobs.
+
+    When a job returns a tab, the tab is reset: it navigates to ``about:blank``
+    and clears common overrides. A tab is retired and replaced in the background
+    when it has been used ``max_uses`` times, when its JavaScript heap exceeds
+    ``max_heap_size`` bytes, when its session closes, or when resetting it fails.
+
+    You should generally use :func:`open_tab_pool` instead of instantiating this
+    class directly.
+    '''
+    def __init__(self, nursery, conn: CdpConnection, size: int,
+            max_uses: typing.Optional[int] = None,
+            max_heap_size: typing.Optional[int] = None,
+            enable_commands: typing.Sequence[typing.Callable] =
+                DEFAULT_ENABLE_COMMANDS,
+            reset: typing.Optional[typing.Callable[[CdpSession],
+                typing.Awaitable[None]]] = None,
+            browser_context_id: typing.Optional[cdp.target.BrowserContextID] =
+                None):
+        '''
+        Constructor.
+
+        :param nursery: a nursery for background tasks that replace retired tabs
+        :param conn: the connection to create tabs on
+        :param size: the number of tabs in the pool
+        :param max_uses: retire a tab after it has been handed out this many times
+        :param max_heap_size: retire a tab whose used JavaScript heap is larger
+            than this many bytes after a job
+        :param enable_commands: PyCDP command functions (e.g.
+            ``cdp.page.enable``) that are run on each new tab
+        :param reset: an optional async function that performs additional
+            cleanup on a returned tab
+        :param browser_context_id: create the tabs in this browser context
+        '''
+        if size < 1:
+            raise ValueError('size must be at least 1')
+        self.conn = conn
+        self.size = size
+        self.max_uses = max_uses
+        self.max_heap_size = max_heap_size
+        self.enable_commands = enable_commands
+        self.reset = reset
+        self.browser_context_id = browser_context_id
+        self._nursery = nursery
+        self._idle_send, self._idle_receive = trio.open_memory_channel(size)
+        self._tabs: typing.Set[Tab] = set()
+        self._in_use = 0
+        self._created = 0
+        self._retired = 0
+        self._adding = 0
+        self._exhausted = False
+        self._closed = False
+
+    async def fill(self):
+        '''
+        Create tabs until the pool is full. The tabs are created concurrently.
+        Tabs that cannot be created are logged and skipped.
+
+        :raises RuntimeError: if the pool is closed or has no tabs afterward
+        '''
+        if self._closed:
+            raise RuntimeError('The tab pool is closed')
+        if self._exhausted:
+            # The pool ran out of tabs earlier, see _fail_borrowers().
+            self._idle_send, self._idle_receive = trio.open_memory_channel(
+                self.size)
+            self._exhausted = False
+        async with trio.open_nursery() as nursery:
+            for _ in range(self.size - len(self._tabs)):
+                nursery.start_soon(self._try_add_tab)
+        if not self._tabs:
+            raise RuntimeError('Unable to create any tabs')
+
+    @asynccontextmanager
+    async def tab(self) -> typing.AsyncIterator[CdpSession]:
+        '''
+        Borrow a tab for the duration of the block. This waits if every tab is in
+        use.
+
+        The tab's session is installed as the session context, so the simplified
+        API (e.g. ``await page.navigate(...)``) runs on it.
+
+        :raises RuntimeError: if the pool is closed, or if it has no tabs left
+            because replacement tabs could not be created
+        '''
+        if self._closed:
+            raise RuntimeError('The tab pool is closed')
+        try:
+            tab = await self._idle_receive.receive()
+        except (trio.EndOfChannel, trio.ClosedResourceError):
+            if self._closed:
+                raise RuntimeError('The tab pool is closed') from None
+            raise RuntimeError('The tab pool has no tabs left') from None
+        tab.uses += 1
+        self._in_use += 1
+        try:
+            with session_context(tab.session):
+                yield tab.session
+        finally:
+            self._in_use -= 1
+            self._nursery.start_soon(self._return_tab, tab)
+
+    def stats(self) -> TabPoolStats:
+        ''' Return a snapshot of the pool's counters. '''
+        return TabPoolStats(
+            idle=self._idle_receive.statistics().current_buffer_used,
+            in_use=self._in_use,
+            created=self._created,
+            retired=self._retired,
+        )
+
+    async def aclose(self):
+        ''' Close every tab in the pool. Tabs that are in use are closed when
+        they are returned. Borrowers that are waiting for a tab fail with
+        :exc:`RuntimeError`. '''
+        self._closed = True
+        self._idle_send.close()
+        async with trio.open_nursery() as nursery:
+            while True:
+                try:
+                    tab = self._idle_receive.receive_nowait()
+                except (trio.WouldBlock, trio.EndOfChannel):
+                    break
+                nursery.start_soon(self._retire_tab, tab)
+
+    async def _try_add_tab(self):
+        ''' Create a tab, logging any failure instead of raising it. '''
+        self._adding += 1
+        try:
+            await self._add_tab()
+        except _TAB_ERRORS:
+            logger.exception('Unable to create a tab')
+        finally:
+            self._adding -= 1
+        self._fail_borrowers()
+
+    def _fail_borrowers(self):
+        ''' If the pool has no tabs left and none are being created, close the
+        idle queue so that borrowers fail instead of waiting forever. '''
+        if not self._tabs and not self._adding:
+            self._exhausted = True
+            self._idle_send.close()
+
+    async def _add_tab(self):
+        '''
+        Create a tab and add it to the idle queue. If the tab cannot be set up,
+        its target is closed.
+        '''
+        target_id = await self.conn.execute(cdp.target.create_target(
+            'about:blank', browser_context_id=self.browser_context_id))
+        session = None
+        try:
+            session = await self.conn.connect_session(target_id)
+            if self.enable_commands:
+                results = await session.execute_many(command() for command in
+                    self.enable_commands)
+                errors = [r for r in results if isinstance(r, BrowserError)]
+                if errors:
+                    logger.warning('Could not enable domains on new tab %s: %s',
+                        target_id, errors[0])
+        except BaseException:
+            if session is not None:
+                with trio.CancelScope(shield=True):
+                    await self.conn.detach_session(session)
+            await _close_target(self.conn, target_id)
+            raise
+        tab = Tab(session)
+        self._tabs.add(tab)
+        self._created += 1
+        if self._closed:
+            await self._retire_tab(tab)
+        else:
+            self._idle_send.send_nowait(tab)
+
+    async def _return_tab(self, tab: Tab):
+        ''' Reset a tab that a job is done with, or retire and replace it. '''
+        if self._closed:
+            await self._retire_tab(tab)
+            return
+        reason = await self._check_tab(tab)
+        if reason is None and self._closed:
+            reason = 'pool closed'
+        if reason is None:
+            self._idle_send.send_nowait(tab)
+            return
+        logger.debug('Retiring tab %s: %s', tab.target_id, reason)
+        await self._retire_tab(tab)
+        if not self._closed:
+            await self._try_add_tab()
+
+    async def _check_tab(self, tab: Tab) -> typing.Optional[str]:
+        ''' Reset a tab and return the reason it should be retired, if any. '''
+        if tab.session.closed:
+            return 'session closed'
+        if self.max_uses is not None and tab.uses >= self.max_uses:
+            return 'used {} times'.format(tab.uses)
+        try:
+            results = await tab.session.execute_many(_reset_commands(
+                self.enable_commands))
+            for result in results:
+                if isinstance(result, BrowserError):
+                    return 'reset failed: {}'.format(result)
+            if self.reset is not None:
+                await self.reset(tab.session)
+            if self.max_heap_size is not None:
+                used, _ = await tab.session.execute(
+                    cdp.runtime.get_heap_usage())
+                if used > self.max_heap_size:
+                    return 'heap size is {} bytes'.format(int(used))
+        except (BrowserError, CdpSessionClosed, CdpConnectionClosed) as exc:
+            return 'reset failed: {}'.format(exc)
+        return None
+
+    async def _retire_tab(self, tab: Tab):
+        ''' Detach from a tab and close its target. '''
+        self._tabs.discard(tab)
+        self._retired += 1
+        await self.conn.detach_session(tab.session)
+        await _close_target(self.conn, tab.target_id)
+
+
+@asynccontextmanager
+async def open_tab_pool(conn: CdpConnection, size: int, **kwargs) -> \
+        typing.AsyncIterator[TabPool]:
+    '''
+    This async context manager creates a :class:`TabPool` with ``size`` tabs on
+    ``conn`` before entering the block, then closes the tabs when the block exits.
+
+    The keyword arguments are passed to the :class:`TabPool` constructor.
+
+    .. code::
+
+        async with open_tab_pool(conn, 8, max_uses=50) as pool:
+            async with pool.tab() as session:
+                await page.navigate(url)
+    '''
+    async with trio.open_nursery() as nursery:
+        pool = TabPool(nursery, conn, size, **kwargs)
+        try:
+            await pool.fill()
+            yield pool
+        finally:
+            await pool.aclose()
+
+
+@dataclass
+class BrowserContextPoolStats:
+    ''' A snapshot of a :class:`BrowserContextPool`'s counters. '''
+    #: The number of idle contexts that are ready to be handed out.
+    idle: int
+    #: The number of contexts that are currently handed out.
+    in_use: int
+    #: The total number of contexts created.
+    created: int
+    #: The total number of contexts disposed.
+    disposed: int
+    #: The mean time to create a context, in seconds.
+    mean_creation_latency: float
+    #: The longest time to create a context, in seconds.
+    max_creation_latency: float
+
+
+class BrowserContext:
+    '''
+    A browser context that is handed out by a :class:`BrowserContextPool`.
+
+    Targets created in a browser context share cookies and storage with each
+    other, but not with targets in other contexts. All of the targets are closed
+    when the context is returned to the pool.
+    '''
+    def __init__(self, conn: CdpConnection,
+            context_id: cdp.target.BrowserContextID, creation_latency: float):
+        self.conn = conn
+        self.context_id = context_id
+        #: How long it took to create this context, in seconds.
+        self.creation_latency = creation_latency
+        self.sessions: typing.List[CdpSession] = list()
+
+    async def new_session(self, url: str = 'about:blank') -> CdpSession:
+        ''' Create a target in this context and return a session attached to
+        it. '''
+        target_id = await self.conn.execute(cdp.target.create_target(url,
+            browser_context_id=self.context_id))
+        try:
+            session = await self.conn.connect_session(target_id)
+        except BaseException:
+            await _close_target(self.conn, target_id)
+            raise
+        self.sessions.append(session)
+        return session
+
+    @asynccontextmanager
+    async def open_session(self, url: str = 'about:blank') -> \
+            typing.AsyncIterator[CdpSession]:
+        ''' Create a target in this context and install a session attached to
+        it as the session context for the duration of the block. '''
+        session = await self.new_session(url)
+        with session_context(session):
+            yield session
+
+
+class BrowserContextPool:
+    '''
+    Keeps a number of pre-created browser contexts and hands them out to workers.
+
+    Each worker gets a fresh context, so jobs are isolated from each other's
+    cookies and storage without the cost of a new browser process. When a worker
+    returns a context, it is disposed in the background, which closes all of its
+    targets, and a replacement is created.
+
+    You should generally use :func:`open_browser_context_pool` instead of
+    instantiating this class directly.
+    '''
+    def __init__(self, nursery, conn: CdpConnection, size: int):
+        '''
+        Constructor.
+
+        :param nursery: a nursery for background tasks that dispose and replace
+            contexts
+        :param conn: the connection to create contexts on
+        :param size: the number of contexts in the pool
+        '''
+        if size < 1:
+            raise ValueError('size must be at least 1')
+        self.conn = conn
+        self.size = size
+        self._nursery = nursery
+        self._idle_send, self._idle_receive = trio.open_memory_channel(size)
+        self._in_use = 0
+        self._created = 0
+        self._disposed = 0
+        self._total_latency = 0.0
+        self._max_latency = 0.0
+        self._closed = False
+
+    async def fill(self):
+        ''' Create contexts until the pool is full. The contexts are created
+        concurrently. '''
+        missing = self.size - self._idle_receive.statistics().current_buffer_used \
+            - self._in_use
+        async with trio.open_nursery() as nursery:
+            for _ in range(missing):
+                nursery.start_soon(self._add_context)
+
+    @asynccontextmanager
+    async def context(self) -> typing.AsyncIterator[BrowserContext]:
+        '''
+        Borrow a browser context for the duration of the block. This waits if
+        every context is in use. The context is disposed when the block exits.
+        '''
+        if self._closed:
+            raise RuntimeError('The browser context pool is closed')
+        context = await self._idle_receive.receive()
+        self._in_use += 1
+        try:
+            yield context
+        finally:
+            self._in_use -= 1
+            self._nursery.start_soon(self._replace_context, context)
+
+    def stats(self) -> BrowserContextPoolStats:
+        ''' Return a snapshot of the pool's counters. '''
+        return BrowserContextPoolStats(
+            idle=self._idle_receive.statistics().current_buffer_used,
+            in_use=self._in_use,
+            created=self._created,
+            disposed=self._disposed,
+            mean_creation_latency=self._total_latency / self._created
+                if self._created else 0.0,
+            max_creation_latency=self._max_latency,
+        )
+
+    async def aclose(self):
+        ''' Dispose every idle context in the pool. Contexts that are in use
+        are disposed when they are returned. '''
+        self._closed = True
+        async with trio.open_nursery() as nursery:
+            while True:
+                try:
+                    context = self._idle_receive.receive_nowait()
+                except trio.WouldBlock:
+                    break
+                nursery.start_soon(self._dispose_context, context)
+
+    async def _add_context(self):
+        ''' Create a context and add it to the idle queue. '''
+        start = trio.current_time()
+        context_id = await self.conn.execute(
+            cdp.target.create_browser_context())
+        latency = trio.current_time() - start
+        self._created += 1
+        self._total_latency += latency
+        self._max_latency = max(self._max_latency, latency)
+        context = BrowserContext(self.conn, context_id, latency)
+        if self._closed:
+            await self._dispose_context(context)
+        else:
+            self._idle_send.send_nowait(context)
+
+    async def _replace_context(self, context: BrowserContext):
+        ''' Dispose a context that a worker is done with and create a
+        replacement. '''
+        try:
+            await self._dispose_context(context)
+        except _TAB_ERRORS:
+            logger.exception('Unable to dispose browser context %s',
+                context.context_id)
+        if self._closed:
+            return
+        try:
+            await self._add_context()
+        except _TAB_ERRORS:
+            logger.exception('Unable to replace browser context')
+
+    async def _dispose_context(self, context: BrowserContext):
+        ''' Detach the context's sessions and dispose it, which closes its
+        targets. '''
+        self._disposed += 1
+        for session in context.sessions:
+            try:
+                await self.conn.detach_session(session)
+            except CdpSessionClosed:
+                # The session is already detached.
+                pass
+        try:
+            await self.conn.execute(cdp.target.dispose_browser_context(
+                context.context_id))
+        except (BrowserError, CdpConnectionClosed) as exc:
+            logger.warning('Unable to dispose browser context %s: %s',
+                context.context_id, exc)
+
+
+@asynccontextmanager
+async def open_browser_context_pool(conn: CdpConnection, size: int) -> \
+        typing.AsyncIterator[BrowserContextPool]:
+    '''
+    This async context manager creates a :class:`BrowserContextPool` with
+    ``size`` contexts on ``conn`` before entering the block, then disposes the
+    contexts when the block exits.
+
+    .. code::
+
+        async with open_browser_context_pool(conn, 4) as pool:
+            async with pool.context() as context:
+                async with context.open_session() as session:
+                    await page.navigate(url)
+    '''
+    async with trio.open_nursery() as nursery:
+        pool = BrowserContextPool(nursery, conn, size)
+        try:
+            await pool.fill()
+            yield pool
+        finally:
+            await pool.aclose()
+
+
+@dataclass
+class BrowserLoad:
+    ''' A snapshot of the load on one browser in a :class:`BrowserPool`. '''
+    #: The browser's URL.
+    url: str
+    #: The number of live sessions on the browser's connection, plus sessions
+    #: that the pool is in the middle of creating.
+    sessions: int
+    #: The number of commands waiting for a response on the connection and its
+    #: sessions.
+    inflight: int
+    #: A moving average of the health check round trip time, in seconds.
+    latency: float
+    #: The JavaScript heap used by the pool's sessions on this browser, in bytes,
+    #: as of the last health check.
+    heap_used: float
+
+    def score(self) -> typing.Tuple[float, float, float]:
+        ''' The default placement key: lower is less loaded. '''
+        return (self.sessions + self.inflight, self.heap_used, self.latency)
+
+
+class PooledBrowser:
+    ''' The state that a :class:`BrowserPool` keeps for each browser. '''
+    def __init__(self, url: str, conn: CdpConnection):
+        self.url = url
+        self.conn = conn
+        self.latency = 0.0
+        self.heap_used = 0.0
+        self.failures = 0
+        self.placing = 0
+        self.sessions: typing.Set[CdpSession] = set()
+
+    def load(self) -> BrowserLoad:
+        ''' Return a snapshot of this browser's load. '''
+        conn = self.conn
+        inflight = len(conn.inflight) + sum(len(session.inflight)
+            for session in conn.sessions.values())
+        return BrowserLoad(url=self.url, sessions=conn.session_count +
+            self.placing, inflight=inflight, latency=self.latency,
+            heap_used=self.heap_used)
+
+
+class BrowserPool:
+    '''
+    Holds connections to several browsers and places new sessions on the least
+    loaded browser.
+
+    Each browser's connection runs in its own task, so a browser that crashes or
+    disconnects is removed from the pool without affecting the others. A
+    background task checks each browser's health periodically: it measures round
+    trip latency and the heap used by the pool's sessions, and it removes
+    browsers that fail ``max_failures`` checks in a row. New sessions are placed
+    using the latest load figures, so load shifts away from slow browsers and
+    onto browsers that are added later.
+
+    You should generally use :func:`open_browser_pool` instead of instantiating
+    this class directly.
+    '''
+    def __init__(self, nursery, health_interval: float = 5.0,
+            health_timeout: float = 5.0, max_failures: int = 3,
+            latency_smoothing: float = 0.3,
+            key: typing.Callable[[BrowserLoad], typing.Any] = BrowserLoad.score):
+        '''
+        Constructor.
+
+        :param nursery: a nursery for the connections and the health check task
+        :param health_interval: seconds between health checks
+        :param health_timeout: seconds before a health check fails
+        :param max_failures: remove a browser after this many consecutive failed
+            health checks
+        :param latency_smoothing: the weight of the newest sample in the latency
+            moving average
+        :param key: a function that maps a :class:`BrowserLoad` to a sort key.
+            New sessions are placed on the browser with the lowest key.
+        '''
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self.max_failures = max_failures
+        self.latency_smoothing = latency_smoothing
+        self.key = key
+        self.browsers: typing.Dict[CdpConnection, PooledBrowser] = dict()
+        self._nursery = nursery
+        self._closed = False
+
+    async def add_browser(self, url: str) -> CdpConnection:
+        ''' Connect to a browser and add it to the pool. '''
+        return await self._nursery.start(self._run_browser, url)
+
+    async def remove_browser(self, conn: CdpConnection):
+        ''' Remove a browser from the pool and close its connection. Sessions
+        on the browser fail with :class:`CdpConnectionClosed`. '''
+        if self.browsers.pop(conn, None) is not None:
+            logger.info('Removing browser %s from pool', conn)
+        await conn.aclose()
+
+    def least_loaded(self) -> CdpConnection:
+        ''' Return the connection to the least loaded browser. '''
+        return self._choose_browser().conn
+
+    def loads(self) -> typing.List[BrowserLoad]:
+        ''' Return a snapshot of the load on each browser in the pool. '''
+        return [browser.load() for browser in self.browsers.values()]
+
+    @asynccontextmanager
+    async def open_session(self, url: str = 'about:blank') -> \
+            typing.AsyncIterator[CdpSession]:
+        '''
+        Create a target on the least loaded browser and install a session
+        attached to it as the session context for the duration of the block.
+        The target is closed when the block exits.
+        '''
+        browser = self._choose_browser()
+        conn = browser.conn
+        browser.placing += 1
+        try:
+            target_id = await conn.execute(cdp.target.create_target(url))
+        except BaseException:
+            browser.placing -= 1
+            raise
+        session = None
+        try:
+            try:
+                session = await conn.connect_session(target_id)
+            finally:
+                browser.placing -= 1
+            browser.sessions.add(session)
+            with session_context(session):
+                yield session
+        finally:
+            # The target is closed even if attaching to it failed.
+            try:
+                if session is not None:
+                    browser.sessions.discard(session)
+                    await conn.detach_session(session)
+            finally:
+                await _close_target(conn, target_id)
+
+    async def aclose(self):
+        ''' Close every connection in the pool. '''
+        self._closed = True
+        for conn in list(self.browsers):
+            await self.remove_browser(conn)
+
+    def _choose_browser(self) -> PooledBrowser:
+        if not self.browsers:
+            raise RuntimeError('There are no healthy browsers in the pool')
+        return min(self.browsers.values(),
+            key=lambda browser: self.key(browser.load()))
+
+    async def _run_browser(self, url, task_status=trio.TASK_STATUS_IGNORED):
+        ''' Run a browser's connection in its own nursery, so that an error on
+        the connection only removes that browser. '''
+        conn = None
+        try:
+            async with trio.open_nursery() as nursery:
+                conn = await connect_cdp(nursery, url)
+                self.browsers[conn] = PooledBrowser(url, conn)
+                task_status.started(conn)
+        except Exception:
+            if conn is None:
+                raise
+            logger.exception('Browser %s failed', url)
+        finally:
+            if conn is not None:
+                # Fail any commands that are still waiting on this browser.
+                conn._teardown()
+                if self.browsers.pop(conn, None) is not None:
+                    logger.info('Browser %s disconnected', url)
+
+    async def _health_task(self):
+        ''' Periodically check the health of every browser. '''
+        while True:
+            await trio.sleep(self.health_interval)
+            async with trio.open_nursery() as nursery:
+                for browser in list(self.browsers.values()):
+                    nursery.start_soon(self._check_browser, browser)
+
+    async def _check_browser(self, browser: PooledBrowser):
+        '''
+        Measure a browser's latency and heap usage. Every browser is checked
+        concurrently by :meth:`_health_task`, and each check, including the
+        removal of a failed browser, is bounded by ``health_timeout``, so one slow
+        browser does not hold up the others.
+        '''
+        ok = False
+        with trio.move_on_after(self.health_timeout):
+            try:
+                start = trio.current_time()
+                await browser.conn.execute(cdp.browser.get_version())
+                latency = trio.current_time() - start
+                browser.latency += self.latency_smoothing * \
+                    (latency - browser.latency)
+                browser.heap_used = await self._heap_used(browser)
+                ok = True
+            except (BrowserError, CdpConnectionClosed) as exc:
+                logger.warning('Health check failed for browser %s: %s',
+                    browser.url, exc)
+        if ok:
+            browser.failures = 0
+            return
+        browser.failures += 1
+        if browser.failures >= self.max_failures:
+            logger.warning('Browser %s failed %d health checks', browser.url,
+                browser.failures)
+            with trio.move_on_after(self.health_timeout):
+                await self.remove_browser(browser.conn)
+
+    async def _heap_used(self, browser: PooledBrowser) -> float:
+        ''' Return the heap used by the pool's sessions on a browser. The
+        sessions are queried concurrently. '''
+        usage: typing.List[float] = list()
+
+        async def query(session):
+            try:
+                used, _ = await session.execute(cdp.runtime.get_heap_usage())
+            except (BrowserError, CdpSessionClosed):
+                return
+            usage.append(used)
+
+        async with trio.open_nursery() as nursery:
+            for session in list(browser.sessions):
+                nursery.start_soon(query, session)
+        return sum(usage)
+
+
+@asynccontextmanager
+async def open_browser_pool(urls: typing.Iterable[str] = (), **kwargs) -> \
+        typing.AsyncIterator[BrowserPool]:
+    '''
+    This async context manager connects to each browser in ``urls`` before
+    entering the block and closes the connections when the block exits. More
+    browsers can be added with :meth:`BrowserPool.add_browser`.
+
+    The keyword arguments are passed to the :class:`BrowserPool` constructor.
+
+    .. code::
+
+        async with open_browser_pool(browser_urls) as pool:
+            async with pool.open_session(url) as session:
+                ...
+    '''
+    async with trio.open_nursery() as nursery:
+        pool = BrowserPool(nursery, **kwargs)
+        try:
+            async with trio.open_nursery() as connect_nursery:
+                for url in urls:
+                    connect_nursery.start_soon(pool.add_browser, url)
+            nursery.start_soon(pool._health_task)
+            yield pool
+        finally:
+            await pool.aclose()
+            nursery.cancel_scope.cancel()
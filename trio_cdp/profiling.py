@@ -0,0 +1,177 @@
+'''
+Profiling for a connection's reader task.
+
+Every message from the browser passes through one reader task, so on a busy
+connection the reader can become the bottleneck for the whole browser. A
+:class:`ReaderProfile` splits the reader's time into stages:
+
+* ``receive``: waiting in the transport's ``get_message()``. This includes time
+  spent idle while the browser has nothing to send.
+* ``decode``: decoding the message with the connection's codec.
+* ``routing``: finding the session that the message belongs to.
+* ``parse``: converting event parameters into PyCDP objects.
+* ``dispatch``: resolving commands, offering events to listener channels, and
+  handling lifecycle and target events, not counting ``parse``.
+
+It also records the decode and parse cost of each event method, and the reader
+lag: the time from a message's arrival until it has been dispatched. Transports
+that set a ``last_arrival`` attribute, like the pipe transport, report when each
+message actually arrived, so the lag includes time spent queued behind other
+messages. For other transports, such as WebSockets, the lag is measured from when
+``get_message()`` returned.
+
+.. code::
+
+    profile = conn.enable_profiling(sample_every=10)
+    ...
+    snapshot = profile.snapshot()
+    print(snapshot.stages['decode'].mean, snapshot.lag.p99)
+
+Times are measured with ``time.perf_counter()``. Apart from ``receive``, the
+stages are synchronous work in the reader task, so they are CPU time unless a
+listener channel with the ``block`` policy makes the reader wait. Profiling every
+message costs a handful of clock reads per message; ``sample_every`` profiles only
+one message in that many, which is cheap enough to leave enabled.
+'''
+from dataclasses import dataclass
+import typing
+
+from .metrics import HistogramSnapshot, LatencyHistogram
+
+
+STAGES = ('receive', 'decode', 'routing', 'parse', 'dispatch')
+
+
+@dataclass
+class StageSnapshot:
+    ''' The time that sampled messages spent in one stage, in seconds. '''
+    total: float
+    max: float
+    #: The average time per sampled message.
+    mean: float
+
+
+@dataclass
+class EventCostSnapshot:
+    ''' The cost of the sampled events of one method. Times are in seconds. '''
+    count: int
+    bytes: int
+    #: The total time spent decoding the events.
+    decode: float
+    #: The total time spent parsing the events into PyCDP objects. Events that
+    #: no channel listens to are not parsed.
+    parse: float
+
+    @property
+    def mean(self) -> float:
+        ''' The average decode and parse time per event. '''
+        return (self.decode + self.parse) / self.count if self.count else 0.0
+
+
+@dataclass
+class ProfileSnapshot:
+    ''' A point-in-time copy of a reader profile. '''
+    #: The number of messages that the reader handled while profiling.
+    messages: int
+    #: The number of those messages that were profiled.
+    sampled: int
+    #: Stage times by stage name, see :data:`STAGES`.
+    stages: typing.Dict[str, StageSnapshot]
+    #: Event costs by method name.
+    events: typing.Dict[str, EventCostSnapshot]
+    #: The time from each sampled message's arrival until it was dispatched.
+    lag: HistogramSnapshot
+
+
+class _EventCost:
+    __slots__ = ('count', 'bytes', 'decode', 'parse')
+
+    def __init__(self):
+        self.count = 0
+        self.bytes = 0
+        self.decode = 0.0
+        self.parse = 0.0
+
+
+class ReaderProfile:
+    '''
+    Accumulates the reader task's time by stage. Create one with
+    :meth:`trio_cdp.CdpConnection.enable_profiling`.
+    '''
+    def __init__(self, sample_every: int = 1):
+        '''
+        Constructor.
+
+        :param sample_every: profile one message out of this many
+        '''
+        if sample_every < 1:
+            raise ValueError('sample_every must be at least 1')
+        self.sample_every = sample_every
+        #: True while the reader is handling a sampled message. Sessions check
+        #: this before timing how long an event takes to parse.
+        self.sampling = False
+        #: The parse time of the message that is being handled.
+        self.parse_time = 0.0
+        self.reset()
+
+    def reset(self):
+        ''' Clear the accumulated times. '''
+        self.messages = 0
+        self.sampled = 0
+        self._countdown = 1
+        self._totals = [0.0] * len(STAGES)
+        self._maxes = [0.0] * len(STAGES)
+        self._events: typing.Dict[str, _EventCost] = dict()
+        self._lag = LatencyHistogram()
+
+    def sample(self) -> bool:
+        ''' Count a message and return true if it should be profiled. '''
+        self.messages += 1
+        self._countdown -= 1
+        if self._countdown:
+            return False
+        self._countdown = self.sample_every
+        return True
+
+    def record(self, method: typing.Optional[str], size: int, receive: float,
+            decode: float, routing: float, dispatch: float, lag: float):
+        '''
+        Record a sampled message. ``dispatch`` includes :attr:`parse_time`, which
+        is subtracted from it here.
+
+        :param method: the event method, or ``None`` for command responses
+        '''
+        parse = self.parse_time
+        self.parse_time = 0.0
+        self.sampled += 1
+        totals = self._totals
+        maxes = self._maxes
+        for index, value in enumerate((receive, decode, routing, parse,
+                dispatch - parse)):
+            totals[index] += value
+            if value > maxes[index]:
+                maxes[index] = value
+        self._lag.record(lag)
+        if method is not None:
+            cost = self._events.get(method)
+            if cost is None:
+                cost = self._events[method] = _EventCost()
+            cost.count += 1
+            cost.bytes += size
+            cost.decode += decode
+            cost.parse += parse
+
+    def snapshot(self) -> ProfileSnapshot:
+        ''' Return a copy of the accumulated times. '''
+        sampled = self.sampled
+        return ProfileSnapshot(
+            messages=self.messages,
+            sampled=sampled,
+            stages={stage: StageSnapshot(total=total, max=max_,
+                mean=total / sampled if sampled else 0.0)
+                for stage, total, max_ in zip(STAGES, self._totals,
+                    self._maxes)},
+            events={method: EventCostSnapshot(count=cost.count,
+                bytes=cost.bytes, decode=cost.decode, parse=cost.parse)
+                for method, cost in self._events.items()},
+            lag=self._lag.snapshot())
@@ -0,0 +1,583 @@
+'''
+Record the raw CDP traffic of a connection, and analyze recordings offline.
+
+A :class:`WireRecorder` writes one JSON line per message to gzip-compressed files,
+starting a new file when the current one gets too big and deleting the oldest
+files beyond a limit. Each line records:
+
+* ``t``: a ``time.monotonic()`` timestamp
+* ``dir``: ``"send"`` or ``"recv"``
+* ``conn``: a number that identifies the connection, if one recorder is shared
+* ``size``: the size of the frame
+* ``session``: the session ID, or ``null`` for the root session
+* ``id`` and ``method``, if the message has them, and ``error`` for error
+  responses
+* ``frame``: the frame itself, unless ``include_frames`` is false
+
+Every file starts with a ``"meta"`` line that maps the monotonic clock to the wall
+clock.
+
+Frames are captured from the transport by wrapping it in a
+:class:`RecordingTransport`. The connection functions do this when they are given
+a recorder:
+
+.. code::
+
+    async with open_recorder('recordings', sample_rate=0.1) as recorder:
+        async with open_cdp(url, recorder=recorder) as conn:
+            ...
+
+Sampling and method filters apply to commands and events. A response is recorded
+if and only if its command was recorded, so every recorded command can be matched
+with its response. Records are buffered in memory and written by a background task
+in a worker thread, so the reader and writer tasks never wait for disk.
+
+The recorder does not decode frames. The sampling decision is made first, and the
+``id``, ``method``, and ``sessionId`` of a frame are read from the scalar keys at
+the start and end of the frame, which is where Chrome and this library put them.
+Only a frame whose keys are laid out some other way is decoded with the codec.
+
+:func:`analyze_recording` reads a recording and reports per-method latency and
+event rates. It can also be run from the command line::
+
+    python -m trio_cdp.recorder recordings/
+'''
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+import argparse
+import glob
+import gzip
+import itertools
+import json
+import logging
+import os
+import random
+import re
+import time
+import typing
+
+import trio # type: ignore
+
+from .codec import get_codec
+from .metrics import HistogramSnapshot, LatencyHistogram
+
+
+logger = logging.getLogger('trio_cdp')
+
+#: The size, in uncompressed bytes, at which a recording file is rotated.
+DEFAULT_MAX_BYTES = 2**26
+#: How many recording files are kept by default.
+DEFAULT_MAX_FILES = 10
+#: How often, in seconds, buffered records are written by default.
+DEFAULT_FLUSH_INTERVAL = 1.0
+#: How many records can be buffered before new records are dropped.
+DEFAULT_MAX_BUFFER = 100_000
+
+# How much of each end of a frame is scanned for its metadata.
+_SCAN_SIZE = 512
+# A key with a number or plain string value, at the start of an object or
+# following another such key.
+_HEAD_KEY = re.compile(r'\s*"(\w+)"\s*:\s*(?:(-?\d+)|"([^"\\]*)")\s*(,?)')
+# The scalar keys that end an object.
+_TAIL_KEYS = re.compile(r',\s*((?:"\w+"\s*:\s*(?:-?\d+|"[^"\\]*")\s*,\s*)*'
+    r'"\w+"\s*:\s*(?:-?\d+|"[^"\\]*"))\s*\}\s*$')
+_TAIL_KEY = re.compile(r'"(\w+)"\s*:\s*(?:(-?\d+)|"([^"\\]*)")')
+_ERROR_KEY = re.compile(r'\s*"error"\s*:')
+
+
+class WireRecorder:
+    '''
+    Writes records of CDP frames to rotating, compressed JSONL files.
+
+    Use :func:`open_recorder` to create a recorder and run its background task.
+    '''
+    def __init__(self, directory: str, prefix: str = 'cdp',
+            max_bytes: int = DEFAULT_MAX_BYTES,
+            max_files: int = DEFAULT_MAX_FILES,
+            sample_rate: float = 1.0,
+            methods: typing.Optional[typing.Iterable[str]] = None,
+            include_frames: bool = True,
+            flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+            max_buffer: int = DEFAULT_MAX_BUFFER,
+            codec=None):
+        '''
+        Constructor.
+
+        :param directory: where to write recordings. It is created if needed.
+        :param prefix: files are named ``<prefix>-<number>.jsonl.gz``
+        :param max_bytes: the uncompressed size at which to start a new file
+        :param max_files: the number of files to keep, including the current
+            one. Older files are deleted.
+        :param sample_rate: the fraction of commands and events to record
+        :param methods: if set, only record commands and events with these
+            method names (e.g. ``"Page.navigate"``) or domains (e.g. ``"Page"``)
+        :param include_frames: if false, only record the message metadata
+        :param flush_interval: how often to write buffered records, in seconds
+        :param max_buffer: the most records to buffer. Records that arrive when
+            the buffer is full are dropped.
+        :param codec: the codec used to read the metadata of frames that
+            cannot be scanned, see :func:`trio_cdp.codec.get_codec`
+        '''
+        if not 0 <= sample_rate <= 1:
+            raise ValueError('sample_rate must be between 0 and 1')
+        if max_files < 1:
+            raise ValueError('max_files must be at least 1')
+        self.directory = directory
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.sample_rate = sample_rate
+        self.methods = frozenset(methods) if methods is not None else None
+        self.include_frames = include_frames
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.codec = get_codec(codec)
+        #: The number of records written.
+        self.records = 0
+        #: The number of records dropped because the buffer was full.
+        self.dropped = 0
+        self._buffer: typing.List[str] = list()
+        self._wanted: typing.Dict[str, bool] = dict()
+        # Commands that were recorded and are waiting for a response. Entries
+        # for a connection are removed when its transport closes.
+        self._pending: typing.Set[typing.Tuple[int, typing.Any, int]] = set()
+        self._conn_ids = itertools.count(1)
+        self._flush_lock = trio.Lock()
+        self._flush_needed = trio.Event()
+        self._file: typing.Optional[typing.IO[bytes]] = None
+        self._file_size = 0
+        self._next_index = 0
+        self._closed = False
+
+    @property
+    def paths(self) -> typing.List[str]:
+        ''' The recording files, oldest first. '''
+        return sorted(glob.glob(os.path.join(glob.escape(self.directory),
+            glob.escape(self.prefix) + '-*.jsonl.gz')))
+
+    def wrap(self, transport) -> 'RecordingTransport':
+        ''' Return a transport that records the frames of ``transport``. '''
+        return RecordingTransport(transport, self)
+
+    def record(self, conn_id: int, direction: str,
+            message: typing.Union[str, bytes]):
+        '''
+        Record a frame if it passes the sampling and method filters.
+
+        :param conn_id: identifies the connection, see :meth:`wrap`
+        :param direction: ``"send"`` or ``"recv"``
+        :param message: the frame
+        '''
+        if self._closed:
+            return
+        sampled = self.sample_rate >= 1 or random.random() < self.sample_rate
+        if not sampled and not self._pending:
+            # Neither a command, an event, nor a response is recorded.
+            return
+        data = self._scan(direction, message)
+        session = data.get('sessionId')
+        cmd_id = data.get('id')
+        method = data.get('method')
+        if cmd_id is not None and direction == 'recv':
+            key = (conn_id, session, cmd_id)
+            if key not in self._pending:
+                return
+            self._pending.discard(key)
+        elif not sampled or not self._matches(method):
+            return
+        elif cmd_id is not None:
+            self._pending.add((conn_id, session, cmd_id))
+        if len(self._buffer) >= self.max_buffer:
+            self.dropped += 1
+            return
+        record = {'t': time.monotonic(), 'dir': direction, 'conn': conn_id,
+            'size': len(message), 'session': session}
+        if cmd_id is not None:
+            record['id'] = cmd_id
+        if method is not None:
+            record['method'] = method
+        if 'error' in data:
+            record['error'] = True
+        if self.include_frames:
+            record['frame'] = message.decode('utf8', 'replace') \
+                if isinstance(message, bytes) else message
+        self._buffer.append(json.dumps(record))
+        if len(self._buffer) >= self.max_buffer // 2:
+            self._flush_needed.set()
+
+    def forget(self, conn_id: int):
+        ''' Stop waiting for the responses of a connection's commands, e.g.
+        because its transport closed. '''
+        self._pending = {key for key in self._pending if key[0] != conn_id}
+
+    def _matches(self, method: typing.Optional[str]) -> bool:
+        ''' Return true if a command or event passes the method filter. '''
+        if self.methods is None:
+            return True
+        wanted = self._wanted.get(method)
+        if wanted is None:
+            wanted = self._wanted[method] = method is not None and (
+                method in self.methods or
+                method.partition('.')[0] in self.methods)
+        return wanted
+
+    def _scan(self, direction: str, message: typing.Union[str, bytes]) -> \
+            typing.Dict[str, typing.Any]:
+        '''
+        Return the ``id``, ``method``, ``sessionId``, and ``error`` keys of a
+        frame, without decoding the whole frame if possible.
+
+        Only the scalar keys at the start and end of the frame are read, since
+        those are certainly keys of the top-level object. The value of ``error``
+        is not needed, so it is recorded as ``True``. If a key that the frame
+        may have is missing from both ends but the frame mentions it, the frame
+        is decoded.
+        '''
+        head = message[:_SCAN_SIZE]
+        tail = message[-_SCAN_SIZE:]
+        if isinstance(message, bytes):
+            head = head.decode('utf8', 'replace')
+            tail = tail.decode('utf8', 'replace')
+        start = head.find('{')
+        if start < 0 or head[:start].strip():
+            return self._decode(message)
+        data: typing.Dict[str, typing.Any] = dict()
+        pos = start + 1
+        while True:
+            match = _HEAD_KEY.match(head, pos)
+            if match is None:
+                # The next value is an object or array, or the key was cut off.
+                break
+            name, number, string, comma = match.groups()
+            data[name] = int(number) if number is not None else string
+            pos = match.end()
+            if not comma:
+                break
+        if _ERROR_KEY.match(head, pos):
+            data['error'] = True
+        match = _TAIL_KEYS.search(tail)
+        if match is not None:
+            for name, number, string in _TAIL_KEY.findall(match.group(1)):
+                data[name] = int(number) if number else string
+        if direction == 'send':
+            keys: typing.Tuple[str, ...] = ('id', 'method', 'sessionId')
+        elif 'method' in data:
+            # An event, which has no ID.
+            keys = ('sessionId',)
+        elif 'id' in data:
+            keys = ('sessionId', 'error')
+        else:
+            return self._decode(message)
+        for name in keys:
+            if name in data:
+                continue
+            needle: typing.Union[str, bytes] = '"{}"'.format(name)
+            if isinstance(message, bytes):
+                needle = needle.encode('ascii')
+            if needle in message:
+                return self._decode(message)
+        if 'error' in data:
+            data['error'] = True
+        return data
+
+    def _decode(self, message: typing.Union[str, bytes]) -> typing.Dict[str,
+            typing.Any]:
+        ''' Decode a frame that :meth:`_scan` cannot read. '''
+        try:
+            data = self.codec.loads(message)
+        except self.codec.decode_errors:
+            return {}
+        return data if isinstance(data, dict) else {}
+
+    async def run(self):
+        ''' Write buffered records periodically until cancelled. '''
+        while True:
+            with trio.move_on_after(self.flush_interval):
+                await self._flush_needed.wait()
+            self._flush_needed = trio.Event()
+            await self.flush()
+
+    async def flush(self):
+        ''' Write the buffered records. '''
+        async with self._flush_lock:
+            lines, self._buffer = self._buffer, list()
+            if lines:
+                await trio.to_thread.run_sync(self._write_lines, lines)
+                self.records += len(lines)
+
+    async def aclose(self):
+        ''' Write the buffered records and close the current file. Frames that
+        arrive later are ignored. '''
+        self._closed = True
+        await self.flush()
+        async with self._flush_lock:
+            await trio.to_thread.run_sync(self._close_file)
+
+    def _write_lines(self, lines: typing.List[str]):
+        ''' Write lines to the current file, rotating it as needed. This runs
+        in a worker thread. '''
+        for line in lines:
+            if self._file is None:
+                self._open_file()
+            data = (line + '\n').encode('utf8')
+            self._file.write(data)
+            self._file_size += len(data)
+            if self._file_size >= self.max_bytes:
+                self._close_file()
+
+    def _open_file(self):
+        os.makedirs(self.directory, exist_ok=True)
+        if self._next_index == 0:
+            # Continue after any existing recording instead of overwriting it.
+            indexes = [int(os.path.basename(path)[len(self.prefix) + 1:]
+                .split('.', 1)[0]) for path in self.paths]
+            self._next_index = max(indexes, default=-1) + 1
+        path = os.path.join(self.directory, '{}-{:05d}.jsonl.gz'.format(
+            self.prefix, self._next_index))
+        self._next_index += 1
+        self._file = gzip.open(path, 'wb')
+        meta = json.dumps({'t': time.monotonic(), 'dir': 'meta',
+            'wall': time.time()})
+        self._file.write((meta + '\n').encode('utf8'))
+        self._file_size = 0
+        for old_path in self.paths[:-self.max_files]:
+            try:
+                os.remove(old_path)
+            except OSError as exc:
+                logger.warning('Could not delete old recording %s: %s',
+                    old_path, exc)
+
+    def _close_file(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class RecordingTransport:
+    '''
+    Wraps a transport and records every frame that passes through it. Other
+    attributes are passed through to the wrapped transport.
+    '''
+    def __init__(self, transport, recorder: WireRecorder):
+        '''
+        Constructor.
+
+        :param transport: the transport to wrap, see :mod:`trio_cdp.transport`
+        :param recorder: where to record frames
+        '''
+        self.transport = transport
+        self.recorder = recorder
+        self.conn_id = next(recorder._conn_ids)
+        # Only offer batched writes if the wrapped transport supports them.
+        if hasattr(transport, 'send_messages'):
+            self.send_messages = self._send_messages
+
+    @property
+    def closed(self):
+        return self.transport.closed
+
+    def __getattr__(self, name):
+        return getattr(self.transport, name)
+
+    async def send_message(self, message: typing.Union[str, bytes]):
+        self.recorder.record(self.conn_id, 'send', message)
+        await self.transport.send_message(message)
+
+    async def _send_messages(self, messages: typing.Sequence[typing.Union[str,
+            bytes]]):
+        for message in messages:
+            self.recorder.record(self.conn_id, 'send', message)
+        await self.transport.send_messages(messages)
+
+    async def get_message(self) -> typing.Union[str, bytes]:
+        try:
+            message = await self.transport.get_message()
+        except Exception:
+            # The transport is closed, so no more responses will arrive.
+            self.recorder.forget(self.conn_id)
+            raise
+        self.recorder.record(self.conn_id, 'recv', message)
+        return message
+
+    async def aclose(self):
+        self.recorder.forget(self.conn_id)
+        await self.transport.aclose()
+
+
+@asynccontextmanager
+async def open_recorder(directory: str, **options) -> \
+        typing.AsyncIterator[WireRecorder]:
+    '''
+    Create a :class:`WireRecorder` and run its background task. When the block
+    exits, buffered records are written and the file is closed.
+
+    :param directory: where to write recordings
+    :param options: the other arguments of :class:`WireRecorder`
+    '''
+    recorder = WireRecorder(directory, **options)
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(recorder.run)
+        try:
+            yield recorder
+        finally:
+            with trio.CancelScope(shield=True):
+                await recorder.aclose()
+            nursery.cancel_scope.cancel()
+
+
+@dataclass
+class MethodReport:
+    ''' The commands of one method in a recording. '''
+    count: int
+    errors: int
+    #: The time from each command until its response.
+    latency: HistogramSnapshot
+
+
+@dataclass
+class EventReport:
+    ''' The events of one method in a recording. '''
+    count: int
+    bytes: int
+    #: Events per second over the whole recording.
+    rate: float
+
+
+@dataclass
+class RecordingReport:
+    ''' A summary of a recording. '''
+    #: The time from the first record to the last, in seconds.
+    duration: float
+    #: The number of frames recorded in each direction.
+    sent: int
+    received: int
+    bytes_sent: int
+    bytes_received: int
+    #: Command reports by method name.
+    methods: typing.Dict[str, MethodReport]
+    #: Event reports by method name.
+    events: typing.Dict[str, EventReport]
+    #: The number of recorded commands with no recorded response.
+    unanswered: int
+
+
+def read_recording(paths: typing.Union[str, typing.Iterable[str]]) -> \
+        typing.Iterator[dict]:
+    '''
+    Yield the records of a recording in order.
+
+    :param paths: a directory, a file, or a list of files. The files in a
+        directory are read in name order. Files ending in ``.gz`` are
+        decompressed.
+    '''
+    if isinstance(paths, str):
+        if os.path.isdir(paths):
+            paths = sorted(glob.glob(os.path.join(glob.escape(paths),
+                '*.jsonl*')))
+        else:
+            paths = [paths]
+    for path in paths:
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rt', encoding='utf8') as file:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def analyze_recording(paths: typing.Union[str, typing.Iterable[str]]) -> \
+        RecordingReport:
+    '''
+    Report per-method latency and event rates for a recording.
+
+    :param paths: see :func:`read_recording`
+    '''
+    histograms: typing.Dict[str, LatencyHistogram] = dict()
+    errors: typing.Dict[str, int] = dict()
+    events: typing.Dict[str, typing.List[int]] = dict()
+    pending: typing.Dict[tuple, typing.Tuple[str, float]] = dict()
+    sent = received = bytes_sent = bytes_received = 0
+    first = last = None
+    for record in read_recording(paths):
+        direction = record['dir']
+        if direction not in ('send', 'recv'):
+            continue
+        t = record['t']
+        if first is None:
+            first = t
+        last = t
+        key = (record.get('conn'), record.get('session'), record.get('id'))
+        if direction == 'send':
+            sent += 1
+            bytes_sent += record['size']
+            if key[2] is not None and 'method' in record:
+                pending[key] = (record['method'], t)
+            continue
+        received += 1
+        bytes_received += record['size']
+        if key[2] is not None:
+            command = pending.pop(key, None)
+            if command is None:
+                continue
+            method, sent_at = command
+            histogram = histograms.get(method)
+            if histogram is None:
+                histogram = histograms[method] = LatencyHistogram()
+            histogram.record(t - sent_at)
+            if record.get('error'):
+                errors[method] = errors.get(method, 0) + 1
+        elif 'method' in record:
+            counts = events.setdefault(record['method'], [0, 0])
+            counts[0] += 1
+            counts[1] += record['size']
+    duration = last - first if first is not None else 0.0
+    return RecordingReport(
+        duration=duration,
+        sent=sent,
+        received=received,
+        bytes_sent=bytes_sent,
+        bytes_received=bytes_received,
+        methods={method: MethodReport(count=histogram.count,
+            errors=errors.get(method, 0), latency=histogram.snapshot())
+            for method, histogram in sorted(histograms.items())},
+        events={method: EventReport(count=count, bytes=size,
+            rate=count / duration if duration else 0.0)
+            for method, (count, size) in sorted(events.items())},
+        unanswered=len(pending))
+
+
+def format_report(report: RecordingReport) -> str:
+    ''' Format a report as text tables. '''
+    lines = ['Duration: {:.3f}s, {} frames sent ({} bytes), {} received ({} '
+        'bytes)'.format(report.duration, report.sent, report.bytes_sent,
+        report.received, report.bytes_received)]
+    if report.unanswered:
+        lines.append('Commands without a response: {}'.format(
+            report.unanswered))
+    lines.append('')
+    lines.append('{:<40} {:>8} {:>6} {:>10} {:>10} {:>10} {:>10}'.format(
+        'Command', 'Count', 'Errors', 'Mean ms', 'p50 ms', 'p99 ms', 'Max ms'))
+    for method, m in report.methods.items():
+        lines.append('{:<40} {:>8} {:>6} {:>10.3f} {:>10.3f} {:>10.3f} '
+            '{:>10.3f}'.format(method, m.count, m.errors, m.latency.mean * 1000,
+            m.latency.p50 * 1000, m.latency.p99 * 1000, m.latency.max * 1000))
+    lines.append('')
+    lines.append('{:<40} {:>8} {:>10} {:>12}'.format('Event', 'Count',
+        'Per second', 'Bytes'))
+    for method, e in report.events.items():
+        lines.append('{:<40} {:>8} {:>10.2f} {:>12}'.format(method, e.count,
+            e.rate, e.bytes))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Report per-method latency '
+        'and event rates for a CDP recording.')
+    parser.add_argument('paths', nargs='+', help='a recording directory or '
+        'recording files')
+    args = parser.parse_args()
+    paths = args.paths[0] if len(args.paths) == 1 else args.paths
+    print(format_report(analyze_recording(paths)))
+
+
+if __name__ == '__main__':
+    main()
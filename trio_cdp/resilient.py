@@ -0,0 +1,510 @@
+'''
+A connection that survives dropped WebSockets.
+
+When the WebSocket of a regular :class:`trio_cdp.CdpConnection` closes, every
+pending command fails and every session ends. A :class:`ResilientCdpConnection`
+reconnects instead, with exponential backoff, and then puts things back the way
+they were:
+
+* Sessions whose targets still exist are attached again. The same
+  :class:`trio_cdp.CdpSession` objects are reused, so code that holds a session
+  keeps working. Sessions whose targets are gone are closed.
+* State set up by earlier commands is restored on each session by sending the
+  same commands again: enabled domains (including ``Fetch.enable`` and its
+  interception patterns), scripts added with
+  ``Page.addScriptToEvaluateOnNewDocument``, bindings, extra HTTP headers, and a
+  few other overrides. See :class:`ReplayState`.
+* Commands that were waiting for a response are sent again if they are
+  idempotent, i.e. they only read state. Other commands raise
+  :class:`trio_cdp.CdpConnectionClosed`, because there is no way to know whether
+  the browser ran them.
+
+Commands sent while the connection is reconnecting wait until it is restored.
+If the connection cannot be restored after ``max_attempts`` attempts, it closes
+like a regular connection.
+
+.. code::
+
+    async with open_resilient_cdp(url) as conn:
+        ...
+'''
+from collections import defaultdict
+from contextlib import asynccontextmanager
+import json
+import logging
+import random
+import typing
+
+import cdp
+import trio # type: ignore
+from trio_websocket import ( # type: ignore
+    ConnectionClosed,
+    HandshakeError,
+    connect_websocket_url
+)
+
+from . import (
+    BrowserError,
+    CdpConnection,
+    CdpConnectionClosed,
+    CdpSession,
+    CdpSessionClosed,
+    MAX_WS_MESSAGE_SIZE,
+)
+from .context import connection_context
+from .discovery import DiscoveryError
+from .writer import FlushPolicy
+
+
+logger = logging.getLogger('trio_cdp')
+
+DEFAULT_MAX_ATTEMPTS = 10
+DEFAULT_INITIAL_BACKOFF = 0.5
+DEFAULT_MAX_BACKOFF = 30.0
+
+# Commands whose latest call replaces any earlier call.
+_REPLACED_METHODS = frozenset((
+    'Emulation.setDeviceMetricsOverride',
+    'Emulation.setUserAgentOverride',
+    'Network.setBlockedURLs',
+    'Network.setCacheDisabled',
+    'Network.setExtraHTTPHeaders',
+    'Network.setRequestInterception',
+    'Network.setUserAgentOverride',
+    'Page.setLifecycleEventsEnabled',
+    'Target.setAutoAttach',
+    'Target.setDiscoverTargets',
+))
+
+# Commands that add to earlier calls. Page.addScriptToEvaluateOnNewDocument is
+# handled separately by ReplayState, since its scripts have identifiers.
+_ACCUMULATED_METHODS = frozenset((
+    'Runtime.addBinding',
+))
+
+# Commands that undo a replaced command.
+_CLEAR_METHODS = {
+    'Emulation.clearDeviceMetricsOverride': 'Emulation.setDeviceMetricsOverride',
+}
+
+# Command name prefixes that only read state. Enabling a domain changes state, and
+# ReplayState already enables the domain again after a reconnect.
+_IDEMPOTENT_PREFIXES = ('get', 'describe', 'query', 'resolve')
+
+Url = typing.Union[str, typing.Callable[[], typing.Awaitable[str]]]
+
+
+def is_idempotent(method: str) -> bool:
+    '''
+    Return true if a command can safely be sent again after a reconnect, i.e. it
+    only reads state, such as ``DOM.getDocument``. Commands that enable a domain
+    are not resent, because the replayed state enables the domain again.
+
+    :param method: the CDP method name
+    '''
+    return method.partition('.')[2].startswith(_IDEMPOTENT_PREFIXES)
+
+
+def _raw_command(method: str, params: typing.Optional[dict]):
+    ''' A CDP command built from a method name and its JSON parameters. '''
+    request: typing.Dict[str, typing.Any] = {'method': method}
+    if params is not None:
+        request['params'] = params
+    response = yield request
+    return response
+
+
+class ReplayState:
+    '''
+    The state of one session (or a connection's root session) that is restored
+    after a reconnect, and a flag that holds back new commands while the session
+    is being restored.
+
+    The state is the list of commands that set it up. Enabling a domain is
+    recorded and disabling it removes the record. Commands in
+    ``_REPLACED_METHODS`` keep only their latest call, and commands in
+    ``_ACCUMULATED_METHODS`` keep every distinct call.
+
+    Scripts added with ``Page.addScriptToEvaluateOnNewDocument`` get a new
+    identifier each time they are replayed. The state keeps the identifier that
+    the caller received and maps it to the script's current identifier, so
+    ``Page.removeScriptToEvaluateOnNewDocument`` removes the right script and
+    stops it from being replayed.
+    '''
+    def __init__(self):
+        self._requests: typing.Dict[tuple, typing.Tuple[str,
+            typing.Optional[dict]]] = dict()
+        # The identifier that the caller received for each recorded script, and
+        # the current identifier for each of those. A script's response can
+        # arrive before its command is recorded, so its identifier is kept by
+        # command ID until then.
+        self._script_origins: typing.Dict[tuple, str] = dict()
+        self._script_ids: typing.Dict[str, str] = dict()
+        self._early_ids: typing.Dict[int, str] = dict()
+        self._ready = trio.Event()
+        self._ready.set()
+
+    def __len__(self):
+        return len(self._requests)
+
+    def requests(self) -> typing.List[typing.Tuple[str, typing.Optional[dict]]]:
+        ''' Return the recorded ``(method, params)`` pairs in the order they
+        should be sent. '''
+        return list(self._requests.values())
+
+    def prepare(self, request: dict):
+        ''' Update a request before it is sent, replacing a script identifier
+        from before a reconnect with the script's current identifier. '''
+        if request['method'] == 'Page.removeScriptToEvaluateOnNewDocument':
+            params = request['params']
+            params['identifier'] = self._script_ids.get(params['identifier'],
+                params['identifier'])
+
+    def record_result(self, request: dict, result: dict):
+        ''' Update the state from the result of a command. '''
+        if request['method'] != 'Page.addScriptToEvaluateOnNewDocument':
+            return
+        identifier = result['identifier']
+        # A replayed command sends the recorded parameters themselves.
+        params = request.get('params')
+        for key, (_, recorded) in self._requests.items():
+            if recorded is params:
+                break
+        else:
+            self._early_ids[request['id']] = identifier
+            return
+        origin = self._script_origins.setdefault(key, identifier)
+        self._script_ids[origin] = identifier
+
+    def record(self, request: dict):
+        ''' Update the state from a request that was sent. '''
+        method = request['method']
+        domain, _, name = method.partition('.')
+        params = request.get('params')
+        if name == 'enable':
+            key: tuple = (domain,)
+        elif name == 'disable':
+            self._requests.pop((domain,), None)
+            return
+        elif method in _REPLACED_METHODS:
+            key = (method,)
+        elif method == 'Page.addScriptToEvaluateOnNewDocument':
+            # Each call adds a script, even if the source is the same, so each
+            # call is a separate entry until the script is removed.
+            key = (method, request['id'])
+            identifier = self._early_ids.pop(request['id'], None)
+            if identifier is not None:
+                self._script_origins[key] = identifier
+                self._script_ids[identifier] = identifier
+        elif method == 'Page.removeScriptToEvaluateOnNewDocument':
+            current = params['identifier']
+            for key, origin in list(self._script_origins.items()):
+                if self._script_ids.get(origin) == current:
+                    del self._script_origins[key]
+                    del self._script_ids[origin]
+                    self._requests.pop(key, None)
+            return
+        elif method in _ACCUMULATED_METHODS:
+            key = (method, json.dumps(params, sort_keys=True))
+        elif method in _CLEAR_METHODS:
+            self._requests.pop((_CLEAR_METHODS[method],), None)
+            return
+        elif method == 'Runtime.removeBinding':
+            for key in [key for key, (m, p) in self._requests.items()
+                    if m == 'Runtime.addBinding' and p['name'] ==
+                    params['name']]:
+                del self._requests[key]
+            return
+        else:
+            return
+        # Move the command to the end so that the replay order matches the
+        # order of the latest calls.
+        self._requests.pop(key, None)
+        self._requests[key] = (method, params)
+
+    async def wait_ready(self):
+        ''' Wait until the session is not being restored. '''
+        if not self._ready.is_set():
+            await self._ready.wait()
+
+    def pause(self):
+        ''' Hold back new commands. '''
+        if self._ready.is_set():
+            self._ready = trio.Event()
+
+    def resume(self):
+        ''' Release new commands. '''
+        self._ready.set()
+
+
+class ResilientCdpConnection(CdpConnection):
+    '''
+    A CDP connection that reconnects when its WebSocket closes unexpectedly.
+
+    You should generally use :func:`open_resilient_cdp` instead of instantiating
+    this class directly.
+    '''
+    def __init__(self, nursery, url: Url, codec=None,
+            max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+            initial_backoff: float = DEFAULT_INITIAL_BACKOFF,
+            max_backoff: float = DEFAULT_MAX_BACKOFF,
+            idempotent: typing.Callable[[str], bool] = is_idempotent,
+            flush_policy: typing.Optional[FlushPolicy] = None,
+            recorder=None):
+        '''
+        Constructor.
+
+        :param nursery: the nursery that runs the WebSocket connections
+        :param url: the browser's WebSocket URL, or an async function that
+            returns it, such as
+            ``functools.partial(trio_cdp.discovery.get_websocket_url, port=9222)``.
+            A function is called before each attempt, which helps when the browser
+            restarts with a new URL.
+        :param codec: a codec name or instance, see
+            :func:`trio_cdp.codec.get_codec`
+        :param max_attempts: the number of reconnect attempts before giving up
+        :param initial_backoff: the delay before the first attempt, in seconds.
+            The delay doubles after each failed attempt, with random jitter.
+        :param max_backoff: the longest delay between attempts, in seconds
+        :param idempotent: a function that takes a CDP method name and returns
+            true if a command with that method can be sent again
+        :param flush_policy: how outgoing commands are batched, see
+            :class:`trio_cdp.writer.FlushPolicy`
+        :param recorder: if set, a :class:`trio_cdp.recorder.WireRecorder` that
+            records the frames of every WebSocket
+        '''
+        super().__init__(None, codec)
+        self.url = url
+        self.max_attempts = max_attempts
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.idempotent = idempotent
+        self.flush_policy = flush_policy
+        self.recorder = recorder
+        #: The number of times this connection has reconnected.
+        self.reconnects = 0
+        self._nursery = nursery
+        self._replay = ReplayState()
+        self._closing = False
+        # Sessions waiting to be attached again after a reconnect.
+        self._orphans: typing.DefaultDict[cdp.target.TargetID,
+            typing.List[CdpSession]] = defaultdict(list)
+
+    async def connect(self):
+        ''' Open the first WebSocket and start the reader task. '''
+        self.transport = await self._open_transport()
+        self._start(self._nursery, self.flush_policy)
+
+    async def aclose(self):
+        '''
+        Close the connection without reconnecting.
+
+        It is safe to call this multiple times.
+        '''
+        self._closing = True
+        await super().aclose()
+
+    def _add_session(self, session_id: cdp.target.SessionID,
+            target_id: cdp.target.TargetID) -> CdpSession:
+        '''
+        Return the session with this ID, creating it if needed. If a session for
+        the same target is waiting to be attached again, reuse it and restore its
+        state in the background.
+        '''
+        orphans = self._orphans.get(target_id)
+        if not orphans:
+            session = super()._add_session(session_id, target_id)
+            if session._replay is None:
+                session._replay = ReplayState()
+            return session
+        session = orphans.pop(0)
+        if not orphans:
+            del self._orphans[target_id]
+        logger.debug('Session %s for target %s is now %s', session.session_id,
+            target_id, session_id)
+        session.session_id = session_id
+        self.sessions[session_id] = session
+        self._nursery.start_soon(self._resume, session)
+        return session
+
+    def _teardown(self):
+        for orphans in self._orphans.values():
+            for session in orphans:
+                self.sessions[session.session_id] = session
+        self._orphans.clear()
+        sessions = list(self.sessions.values())
+        super()._teardown()
+        # Release commands that are waiting for a reconnect so that they raise.
+        self._replay.resume()
+        for session in sessions:
+            session._replay.resume()
+
+    async def _open_transport(self):
+        url = self.url if isinstance(self.url, str) else await self.url()
+        ws = await connect_websocket_url(self._nursery, url,
+            max_message_size=MAX_WS_MESSAGE_SIZE)
+        return self.recorder.wrap(ws) if self.recorder is not None else ws
+
+    async def _reader_task(self):
+        '''
+        Handle incoming messages, and reconnect whenever the WebSocket closes
+        unless the connection was closed on purpose.
+        '''
+        while True:
+            await self._read_messages()
+            if self._closing or not await self._reconnect():
+                break
+        self._teardown()
+
+    def _backoff(self, attempt: int) -> float:
+        ''' Return the delay before a reconnect attempt. '''
+        delay = min(self.max_backoff, self.initial_backoff * 2 ** attempt)
+        return delay * random.uniform(0.5, 1.0)
+
+    async def _reconnect(self) -> bool:
+        '''
+        Open a new WebSocket and restore the root session. Other sessions are
+        restored in the background.
+
+        :returns: false if the connection could not be restored
+        '''
+        reason = self.transport.closed
+        logger.warning('Connection lost (%s), reconnecting', reason)
+        self._replay.pause()
+        for session in self.sessions.values():
+            session._replay.pause()
+            self._orphans[session.target_id].append(session)
+            self._fail_interrupted(session, reason)
+        self.sessions.clear()
+        self._fail_interrupted(self, reason)
+
+        for attempt in range(self.max_attempts):
+            await trio.sleep(self._backoff(attempt))
+            if self._closing:
+                return False
+            try:
+                transport = await self._open_transport()
+            except (OSError, HandshakeError, DiscoveryError) as exc:
+                logger.info('Reconnect attempt %d failed: %s', attempt + 1, exc)
+                continue
+            break
+        else:
+            logger.error('Unable to reconnect after %d attempts',
+                self.max_attempts)
+            return False
+        if self._closing:
+            await transport.aclose()
+            return False
+
+        self.transport = transport
+        for orphans in self._orphans.values():
+            for session in orphans:
+                session.transport = transport
+        self.reconnects += 1
+        logger.info('Reconnected after %d attempts', attempt + 1)
+        await self._resume(self)
+        self._nursery.start_soon(self._restore_sessions)
+        return True
+
+    def _fail_interrupted(self, base, reason):
+        ''' Fail the in-flight commands that cannot be sent again, and release
+        the permits of abandoned commands, whose responses are lost. '''
+        base._release_abandoned()
+        for cmd_id, pending in list(base.inflight.items()):
+            if pending.request is None or \
+                    not self.idempotent(pending.request['method']):
+                del base.inflight[cmd_id]
+                base._fail_command(cmd_id, pending, CdpConnectionClosed(reason))
+
+    async def _resume(self, base):
+        '''
+        Restore the recorded state of a session (or the root session) and send
+        its interrupted commands again, then release new commands.
+
+        The responses are not awaited: the reader task resolves them, and
+        commands sent later on the same session are handled after them.
+        '''
+        inflight = list(base.inflight.values())
+        try:
+            for method, params in base._replay.requests():
+                await base._write_command(_raw_command(method, params))
+            for pending in inflight:
+                if base.session_id:
+                    pending.request['sessionId'] = base.session_id
+                await base._send_request(base.codec.dumps(pending.request),
+                    pending.request['method'])
+        except (ConnectionClosed, CdpSessionClosed):
+            # The new WebSocket closed too, and the reader task reconnects again,
+            # or the session was closed in the meantime.
+            return
+        finally:
+            base._replay.resume()
+        logger.debug('Restored %d commands and resent %d commands on %s',
+            len(base._replay), len(inflight), base.session_id or 'connection')
+
+    async def _restore_sessions(self):
+        '''
+        Attach again to the targets of sessions that were open before the
+        reconnect, and close the sessions whose targets are gone.
+
+        With auto-attach enabled, the browser attaches to the surviving targets
+        by itself, so this only closes the sessions of the missing targets.
+        '''
+        try:
+            infos = await self.execute(cdp.target.get_targets())
+            alive = {info.target_id for info in infos}
+            for target_id in list(self._orphans):
+                if target_id not in alive:
+                    self._close_orphans(target_id, 'target destroyed while '
+                        'reconnecting')
+                elif self.targets is None:
+                    for _ in range(len(self._orphans[target_id])):
+                        try:
+                            await self.connect_session(target_id)
+                        except BrowserError:
+                            self._close_orphans(target_id, 'unable to attach '
+                                'while reconnecting')
+                            break
+        except CdpConnectionClosed:
+            # The reader task reconnects again or tears everything down.
+            pass
+
+    def _close_orphans(self, target_id, reason):
+        for session in self._orphans.pop(target_id, ()):
+            logger.debug('Closing session %s: %s', session.session_id, reason)
+            session._close(reason)
+            session._replay.resume()
+        if self.targets is not None:
+            self.targets._remove(target_id)
+
+
+async def connect_resilient_cdp(nursery, url: Url, codec=None, **options) -> \
+        ResilientCdpConnection:
+    '''
+    Connect to the browser specified by ``url`` and spawn a background task in the
+    specified nursery. The connection reconnects when its WebSocket closes.
+
+    The :func:`open_resilient_cdp` context manager is preferred in most
+    situations. The keyword arguments are passed to
+    :class:`ResilientCdpConnection`.
+    '''
+    conn = ResilientCdpConnection(nursery, url, codec, **options)
+    await conn.connect()
+    return conn
+
+
+@asynccontextmanager
+async def open_resilient_cdp(url: Url, codec=None, **options) -> \
+        typing.AsyncIterator[ResilientCdpConnection]:
+    '''
+    This async context manager works like :func:`trio_cdp.open_cdp`, except
+    that the connection reconnects when its WebSocket closes unexpectedly. The
+    keyword arguments are passed to :class:`ResilientCdpConnection`.
+    '''
+    async with trio.open_nursery() as nursery:
+        conn = await connect_resilient_cdp(nursery, url, codec, **options)
+        try:
+            with connection_context(conn):
+                yield conn
+        finally:
+            await conn.aclose()
@@ -0,0 +1,408 @@
+'''
+Run jobs in several worker processes, each with its own Trio loop and browser
+connections.
+
+All of a connection's parsing and dispatch happens on one thread, so a single
+process can only use one CPU core for CDP traffic. A :class:`ShardPool` starts
+worker processes and divides the browsers among them. Each worker connects to its
+browsers with a :class:`trio_cdp.pool.BrowserPool` and runs the jobs it is sent.
+
+A job is a module-level ``async def`` function. The worker runs it with the least
+loaded connection installed as the connection context, so the same code works in
+a worker as it does in the main process:
+
+.. code::
+
+    async def get_title(url):
+        async with get_connection_context('get_title').open_session(...) as session:
+            ...
+        return title
+
+    async with open_shard_pool(browser_urls, workers=4) as shards:
+        title = await shards.run(get_title, 'https://example.com')
+
+Jobs, their arguments, and their results are pickled and sent over pipes as
+length-prefixed frames. The job function is pickled by reference, so the worker
+must be able to import it. A result that cannot be pickled or unpickled fails
+only its own job, with :class:`ShardWorkerError`. This requires a POSIX platform.
+
+If the task that called :meth:`ShardPool.run` is cancelled while its job is
+running, the supervisor sends the worker a cancel frame, and the worker cancels
+the job.
+'''
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+import itertools
+import logging
+import os
+import pickle
+import struct
+import sys
+import typing
+
+import trio # type: ignore
+
+from .context import connection_context
+from .pool import open_browser_pool
+from .transport import (BROWSER_READ_FD, BROWSER_WRITE_FD, PROCESS_EXIT_TIMEOUT,
+    open_process_with_pipes)
+
+
+logger = logging.getLogger('trio_cdp')
+_HEADER = struct.Struct('>I')
+# Workers are started through this module's import path rather than with
+# ``python -m``, so that classes defined here, like ShardWorkerError, pickle
+# with the same name in the worker and in the supervisor.
+_WORKER_COMMAND = [sys.executable, '-c',
+    'from trio_cdp.sharding import _worker_entry; _worker_entry()']
+
+
+class ShardWorkerError(Exception):
+    ''' Raised when a worker process exits while a job is running on it, or
+    when a job's exception cannot be sent back from the worker. '''
+
+
+class FrameChannel:
+    '''
+    Sends and receives pickled objects over a pair of byte streams. Each frame is
+    a 4-byte big-endian length followed by a pickle.
+    '''
+    def __init__(self, receive_stream: trio.abc.ReceiveStream,
+            send_stream: trio.abc.SendStream):
+        self._receive_stream = receive_stream
+        self._send_stream = send_stream
+        self._send_lock = trio.Lock()
+        self._buffer = bytearray()
+
+    async def send(self, obj):
+        ''' Send one object. Once sending has started, it cannot be cancelled,
+        since a partly sent frame would corrupt every later frame. '''
+        payload = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+        async with self._send_lock:
+            with trio.CancelScope(shield=True):
+                await self._send_stream.send_all(_HEADER.pack(len(payload)) +
+                    payload)
+
+    async def receive(self) -> typing.Any:
+        ''' Receive one object. Raises ``EOFError`` if the other side closed
+        the stream. '''
+        header = await self._receive_exactly(_HEADER.size)
+        (size,) = _HEADER.unpack(header)
+        return pickle.loads(await self._receive_exactly(size))
+
+    async def close_send(self):
+        ''' Close the sending stream, which signals the end of input to the
+        other side. '''
+        await self._send_stream.aclose()
+
+    async def aclose(self):
+        ''' Close both streams. '''
+        await self._send_stream.aclose()
+        await self._receive_stream.aclose()
+
+    async def _receive_exactly(self, size: int) -> bytes:
+        while len(self._buffer) < size:
+            data = await self._receive_stream.receive_some(max(65536, size -
+                len(self._buffer)))
+            if not data:
+                raise EOFError()
+            self._buffer += data
+        result = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return result
+
+
+@dataclass
+class WorkerStats:
+    ''' A snapshot of one worker's counters. '''
+    #: The worker's process ID.
+    pid: int
+    #: The browsers assigned to the worker.
+    urls: typing.List[str]
+    #: The number of jobs sent to the worker that have not finished.
+    pending: int
+    #: The number of jobs the worker has finished.
+    completed: int
+    #: The number of finished jobs that raised an exception.
+    failed: int
+
+
+class _Job:
+    ''' A job that has been sent to a worker and is waiting for its result. '''
+    __slots__ = ('result', 'error', '_event')
+
+    @property
+    def done(self) -> bool:
+        return self._event.is_set()
+
+    def __init__(self):
+        self.result: typing.Any = None
+        self.error: typing.Optional[BaseException] = None
+        self._event = trio.Event()
+
+    def set_result(self, result):
+        self.result = result
+        self._event.set()
+
+    def set_error(self, error: BaseException):
+        self.error = error
+        self._event.set()
+
+    async def wait(self):
+        ''' Wait for the job to finish and return its result or raise its
+        exception. '''
+        await self._event.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class _Worker:
+    ''' The supervisor's handle on one worker process. '''
+    def __init__(self, process, channel: FrameChannel, urls: typing.List[str]):
+        self.process = process
+        self.channel = channel
+        self.urls = urls
+        self.pending: typing.Dict[int, _Job] = dict()
+        self.completed = 0
+        self.failed = 0
+
+    def stats(self) -> WorkerStats:
+        return WorkerStats(pid=self.process.pid, urls=self.urls,
+            pending=len(self.pending), completed=self.completed,
+            failed=self.failed)
+
+
+class ShardPool:
+    '''
+    Sends jobs to worker processes and returns their results.
+
+    You should generally use :func:`open_shard_pool` instead of instantiating
+    this class directly.
+    '''
+    def __init__(self, nursery):
+        self.workers: typing.List[_Worker] = list()
+        self._nursery = nursery
+        self._job_ids = itertools.count()
+
+    async def start_worker(self, urls: typing.List[str], **pool_options):
+        '''
+        Start a worker process that connects to ``urls``. The keyword arguments
+        are passed to the worker's :class:`trio_cdp.pool.BrowserPool`.
+        '''
+        process, receive_stream, send_stream = await open_process_with_pipes(
+            _WORKER_COMMAND)
+        channel = FrameChannel(receive_stream, send_stream)
+        try:
+            await channel.send({'urls': urls, 'pool_options': pool_options})
+            ready = await channel.receive()
+        except (EOFError, trio.BrokenResourceError) as exc:
+            await channel.aclose()
+            await _stop_process(process)
+            raise ShardWorkerError('Worker process {} exited while starting'
+                .format(process.pid)) from exc
+        except BaseException:
+            await channel.aclose()
+            with trio.CancelScope(shield=True):
+                await _stop_process(process)
+            raise
+        if isinstance(ready, BaseException):
+            await channel.aclose()
+            await _stop_process(process)
+            raise ShardWorkerError('Worker failed to start') from ready
+        worker = _Worker(process, channel, urls)
+        self.workers.append(worker)
+        self._nursery.start_soon(self._result_task, worker)
+        return worker
+
+    async def run(self, fn: typing.Callable[..., typing.Awaitable[typing.Any]],
+            *args, **kwargs) -> typing.Any:
+        '''
+        Run ``await fn(*args, **kwargs)`` on the worker with the fewest pending
+        jobs and return its result. If the job raises an exception, the same
+        exception is raised here. If this is cancelled, the job is cancelled in
+        the worker too.
+        '''
+        if not self.workers:
+            raise RuntimeError('There are no workers in the shard pool')
+        worker = min(self.workers, key=lambda worker: len(worker.pending))
+        job_id = next(self._job_ids)
+        job = _Job()
+        worker.pending[job_id] = job
+        sent = False
+        try:
+            await worker.channel.send((job_id, fn, args, kwargs))
+            sent = True
+            return await job.wait()
+        finally:
+            worker.pending.pop(job_id, None)
+            if sent and not job.done:
+                await self._cancel_job(worker, job_id)
+
+    def stats(self) -> typing.List[WorkerStats]:
+        ''' Return a snapshot of each worker's counters. '''
+        return [worker.stats() for worker in self.workers]
+
+    async def _cancel_job(self, worker: _Worker, job_id: int):
+        ''' Ask a worker to cancel a job whose caller stopped waiting. '''
+        with trio.CancelScope(shield=True):
+            with trio.move_on_after(PROCESS_EXIT_TIMEOUT):
+                try:
+                    await worker.channel.send(('cancel', job_id))
+                except (trio.BrokenResourceError, trio.ClosedResourceError):
+                    # The worker is gone, so the job is not running anyway.
+                    pass
+
+    async def aclose(self):
+        '''
+        Stop every worker. Each worker finishes its running jobs and then exits.
+        A worker that does not exit in time is killed.
+        '''
+        workers = list(self.workers)
+        for worker in workers:
+            await worker.channel.close_send()
+        async with trio.open_nursery() as nursery:
+            for worker in workers:
+                nursery.start_soon(_stop_process, worker.process)
+
+    async def _result_task(self, worker: _Worker):
+        ''' Read results from a worker and resolve the corresponding jobs. '''
+        try:
+            while True:
+                job_id, ok, payload = await worker.channel.receive()
+                # The result is pickled separately from the frame, so a result
+                # that cannot be unpickled fails only its own job.
+                try:
+                    value = pickle.loads(payload)
+                except Exception as exc:
+                    ok = False
+                    value = ShardWorkerError('Unable to receive job result: '
+                        '{!r}'.format(exc))
+                job = worker.pending.pop(job_id, None)
+                worker.completed += 1
+                if not ok:
+                    worker.failed += 1
+                if job is None:
+                    continue
+                if ok:
+                    job.set_result(value)
+                else:
+                    job.set_error(value)
+        except (EOFError, trio.ClosedResourceError, trio.BrokenResourceError):
+            pass
+        finally:
+            if worker in self.workers:
+                self.workers.remove(worker)
+            for job in worker.pending.values():
+                job.set_error(ShardWorkerError('Worker process {} exited'
+                    .format(worker.process.pid)))
+            worker.pending.clear()
+
+
+@asynccontextmanager
+async def open_shard_pool(urls: typing.Sequence[str],
+        workers: typing.Optional[int] = None, **pool_options) -> \
+        typing.AsyncIterator[ShardPool]:
+    '''
+    This async context manager starts worker processes and divides ``urls``
+    among them before entering the block, then stops the workers when the block
+    exits.
+
+    :param urls: the browsers to connect to
+    :param workers: the number of worker processes. The default is the number
+        of CPU cores. There are never more workers than browsers.
+    :param pool_options: passed to each worker's
+        :class:`trio_cdp.pool.BrowserPool`
+    '''
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(urls)))
+    async with trio.open_nursery() as nursery:
+        pool = ShardPool(nursery)
+        try:
+            async with trio.open_nursery() as start_nursery:
+                for index in range(workers):
+                    start_nursery.start_soon(pool.start_worker,
+                        list(urls[index::workers]), **pool_options)
+            yield pool
+        finally:
+            await pool.aclose()
+
+
+async def _stop_process(process):
+    ''' Wait for a process to exit, and kill it if it does not exit in time. '''
+    with trio.move_on_after(PROCESS_EXIT_TIMEOUT):
+        await process.wait()
+    if process.returncode is None:
+        logger.warning('Worker process %d did not exit, killing it',
+            process.pid)
+        process.kill()
+        await process.wait()
+
+
+async def _run_job(channel: FrameChannel, browser_pool, scopes, job_id, fn,
+        args, kwargs):
+    '''
+    Run one job in a worker and send its result to the supervisor. Nothing is
+    sent for a job that the supervisor cancelled.
+
+    :param scopes: the cancel scopes of the running jobs, by job ID
+    '''
+    with trio.CancelScope() as scope:
+        scopes[job_id] = scope
+        try:
+            with connection_context(browser_pool.least_loaded()):
+                value = await fn(*args, **kwargs)
+            ok = True
+        except Exception as exc:
+            value = exc
+            ok = False
+        finally:
+            del scopes[job_id]
+    if scope.cancelled_caught:
+        return
+    try:
+        payload = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+    except Exception as exc:
+        ok = False
+        payload = pickle.dumps(ShardWorkerError('Unable to send job result: '
+            '{!r}'.format(exc)), protocol=pickle.HIGHEST_PROTOCOL)
+    await channel.send((job_id, ok, payload))
+
+
+async def _worker_main():
+    ''' The entry point of a worker process. '''
+    channel = FrameChannel(trio.lowlevel.FdStream(BROWSER_READ_FD),
+        trio.lowlevel.FdStream(BROWSER_WRITE_FD))
+    config = await channel.receive()
+    started = False
+    try:
+        async with open_browser_pool(config['urls'],
+                **config['pool_options']) as browser_pool:
+            await channel.send('ready')
+            started = True
+            scopes: typing.Dict[int, trio.CancelScope] = dict()
+            async with trio.open_nursery() as nursery:
+                while True:
+                    try:
+                        frame = await channel.receive()
+                    except EOFError:
+                        break
+                    if frame[0] == 'cancel':
+                        scope = scopes.get(frame[1])
+                        if scope is not None:
+                            scope.cancel()
+                        continue
+                    job_id, fn, args, kwargs = frame
+                    nursery.start_soon(_run_job, channel, browser_pool, scopes,
+                        job_id, fn, args, kwargs)
+    except Exception as exc:
+        if started:
+            raise
+        await channel.send(exc)
+
+
+def _worker_entry():
+    ''' Configure logging and run a worker, see ``_WORKER_COMMAND``. '''
+    logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'WARNING').upper())
+    trio.run(_worker_main)
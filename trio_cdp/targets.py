@@ -0,0 +1,87 @@
+'''
+A local registry of the browser's targets and the sessions attached to them.
+
+When auto-attach is enabled with :meth:`trio_cdp.CdpConnection.auto_attach`, the
+browser reports every target as it is created, changed, and destroyed, and it
+attaches to new targets before they start running. The connection's reader task
+applies these events to a :class:`TargetRegistry`, so looking up a target does not
+require a round trip to the browser.
+'''
+import typing
+
+import cdp
+
+
+class TargetRegistry:
+    '''
+    Tracks the browser's targets and the sessions attached to them.
+
+    The registry is updated by the connection's reader task. It should be treated
+    as read-only by other code.
+    '''
+    def __init__(self, types: typing.Optional[typing.Iterable[str]] = None):
+        '''
+        Constructor.
+
+        :param types: if set, only targets of these types (e.g. ``"page"``,
+            ``"iframe"``, ``"worker"``) get a session automatically
+        '''
+        self.types: typing.Optional[typing.FrozenSet[str]] = \
+            frozenset(types) if types is not None else None
+        self._targets: typing.Dict[cdp.target.TargetID, cdp.target.TargetInfo] = \
+            dict()
+        self._sessions: typing.Dict[cdp.target.TargetID, typing.Any] = dict()
+
+    def __len__(self) -> int:
+        return len(self._targets)
+
+    def __contains__(self, target_id) -> bool:
+        return target_id in self._targets
+
+    def __iter__(self) -> typing.Iterator[cdp.target.TargetInfo]:
+        return iter(list(self._targets.values()))
+
+    def get(self, target_id: cdp.target.TargetID) -> \
+            typing.Optional[cdp.target.TargetInfo]:
+        ''' Return the latest info for a target, or ``None`` if it is unknown. '''
+        return self._targets.get(target_id)
+
+    def session(self, target_id: cdp.target.TargetID):
+        ''' Return the session attached to a target, or ``None`` if there is
+        none. '''
+        return self._sessions.get(target_id)
+
+    def find(self, type_: typing.Optional[str] = None,
+            url: typing.Optional[str] = None,
+            browser_context_id: typing.Optional[str] = None) -> \
+            typing.List[cdp.target.TargetInfo]:
+        '''
+        Return the targets that match all of the given criteria.
+
+        :param type_: the target type, e.g. ``"page"``
+        :param url: the target's exact URL
+        :param browser_context_id: the browser context the target belongs to
+        '''
+        return [info for info in self._targets.values()
+            if (type_ is None or info.type_ == type_)
+            and (url is None or info.url == url)
+            and (browser_context_id is None or
+                info.browser_context_id == browser_context_id)]
+
+    def wants(self, info: cdp.target.TargetInfo) -> bool:
+        ''' Return true if a session should be kept for this target. '''
+        return self.types is None or info.type_ in self.types
+
+    def _update(self, info: cdp.target.TargetInfo):
+        self._targets[info.target_id] = info
+
+    def _remove(self, target_id: cdp.target.TargetID):
+        self._targets.pop(target_id, None)
+        self._sessions.pop(target_id, None)
+
+    def _add_session(self, session):
+        self._sessions[session.target_id] = session
+
+    def _remove_session(self, session):
+        if self._sessions.get(session.target_id) is session:
+            del self._sessions[session.target_id]
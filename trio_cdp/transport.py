@@ -0,0 +1,264 @@
+'''
+Transports carry CDP messages between a :class:`trio_cdp.CdpConnection` and the
+browser.
+
+A transport has the same contract as ``trio_websocket.WebSocketConnection``, so the
+WebSocket connection returned by ``trio_websocket`` can be used as a transport
+directly:
+
+* ``await send_message(message)`` sends one message (``str`` or ``bytes``).
+* ``await get_message()`` returns the next message (``str`` or ``bytes``).
+* ``await aclose()`` closes the transport.
+* ``closed`` is ``None`` while the transport is open, and the close reason after
+  it is closed.
+
+Both message methods raise ``trio_websocket.ConnectionClosed`` once the transport
+is closed.
+
+A transport may also implement ``await send_messages(messages)``, which sends a
+list of messages with as few writes as possible. The connection's writer task uses
+it to flush a batch of commands at once. It may also set ``last_arrival`` to the
+``time.perf_counter()`` time at which the message most recently returned by
+``get_message()`` arrived, which the reader profile uses to measure lag.
+
+This module also implements a pipe transport. When Chrome is started with
+``--remote-debugging-pipe``, it reads NUL-delimited JSON messages from file
+descriptor 3 and writes them to file descriptor 4. This avoids WebSocket framing
+and the TCP loopback hop, and it has no limit on message size.
+'''
+from collections import deque
+import logging
+import os
+import shutil
+import sys
+import time
+import typing
+
+import trio # type: ignore
+from trio_websocket import CloseReason, ConnectionClosed # type: ignore
+
+
+logger = logging.getLogger('trio_cdp')
+
+# Chrome uses these file descriptors for --remote-debugging-pipe.
+BROWSER_READ_FD = 3
+BROWSER_WRITE_FD = 4
+
+# How long to wait for a browser process to exit after its pipes are closed.
+PROCESS_EXIT_TIMEOUT = 5
+
+# Run by open_process_with_pipes() as ``python -c _EXEC_WITH_PIPES read_fd
+# write_fd executable args...``. The pipe ends are duplicated first in case one
+# of them is already 3 or 4.
+_EXEC_WITH_PIPES = '''
+import os, sys
+fds = [int(fd) for fd in sys.argv[1:3]]
+copies = [os.dup(fd) for fd in fds]
+os.dup2(copies[0], {read})
+os.dup2(copies[1], {write})
+os.set_inheritable({read}, True)
+os.set_inheritable({write}, True)
+for fd in set(fds + copies) - {{{read}, {write}}}:
+    os.close(fd)
+os.execv(sys.argv[3], sys.argv[3:])
+'''.format(read=BROWSER_READ_FD, write=BROWSER_WRITE_FD)
+
+# WebSocket close codes used to report why a pipe closed.
+_NORMAL_CLOSURE = 1000
+_ABNORMAL_CLOSURE = 1006
+_MESSAGE_TOO_BIG = 1009
+
+
+class PipeTransport:
+    '''
+    A transport that exchanges NUL-delimited messages over a pair of byte
+    streams.
+
+    Messages are returned by :meth:`get_message` as ``bytes``. Every codec in
+    :mod:`trio_cdp.codec` accepts bytes, so they are not decoded to ``str``.
+    '''
+    def __init__(self, receive_stream: trio.abc.ReceiveStream,
+            send_stream: trio.abc.SendStream,
+            max_message_size: typing.Optional[int] = None,
+            process: typing.Optional[trio.Process] = None):
+        '''
+        Constructor.
+
+        :param receive_stream: the stream that the browser writes to
+        :param send_stream: the stream that the browser reads from
+        :param max_message_size: if set, a message larger than this many bytes
+            closes the transport
+        :param process: the browser process, if this transport owns it. The
+            process is stopped when the transport is closed.
+        '''
+        self.max_message_size = max_message_size
+        self.process = process
+        self._receive_stream = receive_stream
+        self._send_stream = send_stream
+        self._send_lock = trio.Lock()
+        self._messages: typing.Deque[bytes] = deque()
+        self._partial: typing.List[bytes] = list()
+        self._partial_size = 0
+        self._close_reason: typing.Optional[CloseReason] = None
+        #: When the last message returned by :meth:`get_message` arrived, from
+        #: ``time.perf_counter()``.
+        self.last_arrival: typing.Optional[float] = None
+        # When the queued messages arrived. They all come from the same read.
+        self._received_at: typing.Optional[float] = None
+
+    @property
+    def closed(self) -> typing.Optional[CloseReason]:
+        ''' The reason the transport closed, or ``None`` if it is open. '''
+        return self._close_reason
+
+    async def send_message(self, message: typing.Union[str, bytes]):
+        ''' Send one message. '''
+        if isinstance(message, str):
+            message = message.encode('utf8')
+        await self._send_data(message + b'\0')
+
+    async def send_messages(self, messages: typing.Sequence[typing.Union[str,
+            bytes]]):
+        ''' Send several messages with a single write. '''
+        await self._send_data(b''.join((message.encode('utf8') if
+            isinstance(message, str) else message) + b'\0'
+            for message in messages))
+
+    async def get_message(self) -> bytes:
+        '''
+        Receive the next message. If no message is available immediately, this
+        blocks until one is ready.
+        '''
+        while not self._messages:
+            if self._close_reason is not None:
+                raise ConnectionClosed(self._close_reason)
+            try:
+                data = await self._receive_stream.receive_some(65536)
+            except (trio.BrokenResourceError, trio.ClosedResourceError):
+                data = b''
+            if not data:
+                self._set_closed(_ABNORMAL_CLOSURE if self._partial else
+                    _NORMAL_CLOSURE, 'Pipe closed')
+                continue
+            self._received_at = time.perf_counter()
+            self._receive_data(data)
+        self.last_arrival = self._received_at
+        return self._messages.popleft()
+
+    async def aclose(self):
+        '''
+        Close both pipes. If this transport owns a browser process, wait for it
+        to exit and kill it if it does not exit in time.
+
+        It is safe to call this multiple times.
+        '''
+        self._set_closed(_NORMAL_CLOSURE, 'Closed by client')
+        await self._send_stream.aclose()
+        await self._receive_stream.aclose()
+        if self.process is not None and self.process.returncode is None:
+            with trio.move_on_after(PROCESS_EXIT_TIMEOUT):
+                await self.process.wait()
+            if self.process.returncode is None:
+                logger.warning('Browser process %d did not exit, killing it',
+                    self.process.pid)
+                self.process.kill()
+                await self.process.wait()
+
+    async def _send_data(self, data: bytes):
+        if self._close_reason is not None:
+            raise ConnectionClosed(self._close_reason)
+        async with self._send_lock:
+            try:
+                await self._send_stream.send_all(data)
+            except (trio.BrokenResourceError, trio.ClosedResourceError):
+                self._set_closed(_ABNORMAL_CLOSURE, 'Pipe closed')
+                raise ConnectionClosed(self._close_reason) from None
+
+    def _receive_data(self, data: bytes):
+        ''' Split incoming data into complete messages. '''
+        parts = data.split(b'\0')
+        # The last part is the start of a message that is not complete yet.
+        tail = parts.pop()
+        if parts:
+            self._partial.append(parts[0])
+            self._messages.append(b''.join(self._partial))
+            self._messages.extend(parts[1:])
+            self._partial = list()
+            self._partial_size = 0
+        if tail:
+            self._partial.append(tail)
+            self._partial_size += len(tail)
+        if self.max_message_size is not None:
+            too_big = self._partial_size > self.max_message_size or \
+                any(len(message) > self.max_message_size
+                    for message in self._messages)
+            if too_big:
+                self._messages.clear()
+                self._set_closed(_MESSAGE_TOO_BIG, 'Exceeded maximum message '
+                    'size: {} bytes'.format(self.max_message_size))
+
+    def _set_closed(self, code: int, reason: str):
+        if self._close_reason is None:
+            self._close_reason = CloseReason(code, reason)
+
+
+async def open_pipe_process(command: typing.Sequence[str], **options) -> \
+        PipeTransport:
+    '''
+    Start a browser process that speaks CDP over pipes and return a transport
+    connected to it.
+
+    The command should include ``--remote-debugging-pipe``. The child process gets
+    the read end of one pipe as file descriptor 3 and the write end of another
+    pipe as file descriptor 4. This requires a POSIX platform.
+
+    :param command: the browser executable and its arguments
+    :param options: additional keyword arguments for
+        ``trio.lowlevel.open_process()``
+    '''
+    process, receive_stream, send_stream = await open_process_with_pipes(command,
+        **options)
+    return PipeTransport(receive_stream, send_stream, process=process)
+
+
+async def open_process_with_pipes(command: typing.Sequence[str], **options) -> \
+        typing.Tuple[trio.Process, trio.abc.ReceiveStream, trio.abc.SendStream]:
+    '''
+    Start a process that reads from file descriptor 3 and writes to file
+    descriptor 4, leaving its standard streams alone. This requires a POSIX
+    platform.
+
+    The descriptors are set up by a short-lived Python process that then execs
+    the command, so the command is looked up on ``PATH`` before it is started.
+
+    :param command: the executable and its arguments
+    :param options: additional keyword arguments for
+        ``trio.lowlevel.open_process()``
+    :returns: the process, a stream that receives what the process writes to
+        fd 4, and a stream that sends to the process's fd 3
+    :raises FileNotFoundError: if the executable does not exist
+    '''
+    if os.name != 'posix':
+        raise RuntimeError('The pipe transport requires a POSIX platform')
+    executable = shutil.which(command[0])
+    if executable is None:
+        raise FileNotFoundError('No such executable: {!r}'.format(command[0]))
+    # The child reads from child_read and writes to child_write.
+    child_read, parent_write = os.pipe()
+    parent_read, child_write = os.pipe()
+    # The pipe ends are passed to a small Python program that moves them to 3
+    # and 4 and then execs the command, since moving them in the child with
+    # preexec_fn is not safe when the parent has threads.
+    wrapper = [sys.executable, '-I', '-S', '-c', _EXEC_WITH_PIPES,
+        str(child_read), str(child_write), executable, *command[1:]]
+    try:
+        process = await trio.lowlevel.open_process(wrapper,
+            pass_fds=(child_read, child_write), **options)
+    except BaseException:
+        for fd in (child_read, parent_write, parent_read, child_write):
+            os.close(fd)
+        raise
+    os.close(child_read)
+    os.close(child_write)
+    return process, trio.lowlevel.FdStream(parent_read), \
+        trio.lowlevel.FdStream(parent_write)
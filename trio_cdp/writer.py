@@ -0,0 +1,295 @@
+'''
+A writer task that sends a connection's commands in priority order.
+
+Every command on a connection and its sessions is written to the same transport.
+Without a writer, commands are written in whatever order their tasks happen to
+run, so a burst of bulky commands from background jobs can delay a latency
+sensitive command queued behind them.
+
+Each command is sent with a :class:`Priority`. The :class:`CommandWriter` keeps a
+lane (a set of queues) for each priority and sends from the most urgent lane that
+has a command waiting. Within a lane, sessions take turns, so one busy session
+cannot hold up the others. Strict priority would let a steady stream of urgent
+commands starve the less urgent lanes, so a command that has waited longer than
+:attr:`FlushPolicy.promote_after` is sent ahead of more urgent ones.
+
+If a command does not specify a priority, one is chosen from its method with
+:func:`method_priority`.
+
+The writer also batches messages. When a message arrives while the writer is
+idle, it waits according to its :class:`FlushPolicy` so that other tasks can
+queue their messages too, and then writes everything that is queued in one
+batch. A transport that implements ``send_messages()``, such as the pipe
+transport, writes a batch with a single system call. Other transports, such as
+WebSockets, write the messages of a batch one frame at a time.
+'''
+from collections import deque
+from dataclasses import dataclass
+import enum
+import logging
+import typing
+
+import trio # type: ignore
+from trio_websocket import ConnectionClosed # type: ignore
+
+
+logger = logging.getLogger('trio_cdp')
+
+
+class Priority(enum.IntEnum):
+    ''' The priority of an outgoing command. Lower values are sent first. '''
+    #: Input and navigation, where a person or a test is waiting on the result.
+    INTERACTIVE = 0
+    #: Everything else.
+    NORMAL = 1
+    #: Large or slow commands that can wait, such as screenshots.
+    BULK = 2
+
+
+# The default priority of commands, by method. Methods that are not listed are
+# NORMAL, except for the domains in _INTERACTIVE_DOMAINS.
+_METHOD_PRIORITIES = {
+    'Page.navigate': Priority.INTERACTIVE,
+    'Page.reload': Priority.INTERACTIVE,
+    'Page.stopLoading': Priority.INTERACTIVE,
+    'Page.captureScreenshot': Priority.BULK,
+    'Page.captureSnapshot': Priority.BULK,
+    'Page.printToPDF': Priority.BULK,
+}
+_INTERACTIVE_DOMAINS = ('Input.',)
+
+
+def method_priority(method: str) -> Priority:
+    ''' Return the default priority for a CDP method. '''
+    priority = _METHOD_PRIORITIES.get(method)
+    if priority is not None:
+        return priority
+    if method.startswith(_INTERACTIVE_DOMAINS):
+        return Priority.INTERACTIVE
+    return Priority.NORMAL
+
+
+@dataclass
+class FlushPolicy:
+    ''' Controls how the writer task orders messages and groups them into
+    batches. '''
+    #: The largest number of messages to write in one batch.
+    max_batch: int = 64
+    #: How long to wait, in seconds, after a message arrives at an idle writer
+    #: before writing the batch. Zero waits until the tasks that are ready to
+    #: run have run, which lets concurrent callers share a batch without adding
+    #: latency. ``None`` writes each message as soon as it arrives.
+    delay: typing.Optional[float] = 0
+    #: How long, in seconds, a message can wait before it is sent ahead of
+    #: messages with a more urgent priority. ``None`` always sends the most
+    #: urgent messages first, even if less urgent messages wait indefinitely.
+    promote_after: typing.Optional[float] = 0.5
+
+
+@dataclass
+class LaneStats:
+    ''' A snapshot of one priority lane's counters. '''
+    priority: Priority
+    #: The number of messages waiting to be sent.
+    queued: int
+    #: The number of messages sent.
+    sent: int
+    #: The average time, in seconds, that sent messages waited in the queue.
+    mean_wait: float
+    #: The longest time, in seconds, that a sent message waited in the queue.
+    max_wait: float
+
+
+class _Outgoing:
+    ''' A message waiting to be written. '''
+    __slots__ = ('message', 'enqueued', 'done', 'error', 'cancelled')
+
+    def __init__(self, message):
+        self.message = message
+        self.enqueued = trio.current_time()
+        self.done = trio.Event()
+        self.error: typing.Optional[BaseException] = None
+        self.cancelled = False
+
+
+class _Lane:
+    ''' The queues for one priority, with one queue per session. '''
+    def __init__(self, priority: Priority):
+        self.priority = priority
+        self.queues: typing.Dict[typing.Any, typing.Deque[_Outgoing]] = dict()
+        # Sessions with queued messages, in the order they take turns.
+        self.order: typing.Deque[typing.Any] = deque()
+        self.queued = 0
+        self.sent = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def push(self, key, item: _Outgoing):
+        queue = self.queues.get(key)
+        if queue is None:
+            queue = self.queues[key] = deque()
+            self.order.append(key)
+        queue.append(item)
+        self.queued += 1
+
+    def peek(self) -> _Outgoing:
+        ''' Return the message that :meth:`pop` would return. '''
+        return self.queues[self.order[0]][0]
+
+    def pop(self) -> _Outgoing:
+        ''' Return the next session's oldest message. The lane must not be
+        empty. '''
+        key = self.order.popleft()
+        queue = self.queues[key]
+        item = queue.popleft()
+        self.queued -= 1
+        if queue:
+            self.order.append(key)
+        else:
+            del self.queues[key]
+        return item
+
+    def record_wait(self, wait: float):
+        self.sent += 1
+        self.total_wait += wait
+        if wait > self.max_wait:
+            self.max_wait = wait
+
+    def stats(self) -> LaneStats:
+        return LaneStats(priority=self.priority, queued=self.queued,
+            sent=self.sent, mean_wait=self.total_wait / self.sent if self.sent
+            else 0.0, max_wait=self.max_wait)
+
+
+class CommandWriter:
+    '''
+    Sends messages for a connection and its sessions from a background task.
+
+    Callers of :meth:`send` wait until their message has been written, so errors
+    from the transport are raised to the caller just as if it had written the
+    message itself.
+    '''
+    def __init__(self, conn, flush_policy: typing.Optional[FlushPolicy] = None):
+        '''
+        Constructor.
+
+        :param trio_cdp.CdpConnection conn: the connection whose transport
+            receives the messages. The transport is looked up for each batch, so
+            it may be replaced while the writer is running.
+        :param flush_policy: how to batch messages. The default is
+            ``FlushPolicy()``.
+        '''
+        self._conn = conn
+        self.flush_policy = flush_policy or FlushPolicy()
+        #: The number of batches written.
+        self.batches = 0
+        #: The number of messages written.
+        self.messages = 0
+        self._lanes = [_Lane(priority) for priority in Priority]
+        self._wakeup = trio.Event()
+        self._closed = False
+
+    async def send(self, message: typing.Union[str, bytes],
+            priority: Priority = Priority.NORMAL, key: typing.Any = None):
+        '''
+        Queue a message and wait until it has been written.
+
+        :param message: the serialized request
+        :param priority: the lane to queue the message in
+        :param key: identifies the session that sends the message. Sessions in
+            the same lane take turns.
+        :raises trio_websocket.ConnectionClosed: if the transport is closed
+        '''
+        if self._closed:
+            raise ConnectionClosed(self._conn.transport.closed)
+        item = _Outgoing(message)
+        self._lanes[priority].push(key, item)
+        self._wakeup.set()
+        try:
+            await item.done.wait()
+        except BaseException:
+            # If the message has not been written yet, it never will be.
+            item.cancelled = True
+            raise
+        if item.error is not None:
+            raise item.error
+
+    def stats(self) -> typing.List[LaneStats]:
+        ''' Return a snapshot of each lane's counters, most urgent first. '''
+        return [lane.stats() for lane in self._lanes]
+
+    def close(self):
+        ''' Stop the writer task. Messages that are still queued raise
+        ``ConnectionClosed``. '''
+        self._closed = True
+        self._wakeup.set()
+
+    def _take(self, limit: int) -> typing.List[_Outgoing]:
+        ''' Remove and return up to ``limit`` messages in the order they should
+        be written. '''
+        batch: typing.List[_Outgoing] = list()
+        now = trio.current_time()
+        promote_after = self.flush_policy.promote_after
+        if promote_after is not None:
+            # Messages that have waited too long in a less urgent lane go
+            # first. Sessions take turns, so each session's oldest message is
+            # checked in turn.
+            for lane in self._lanes[1:]:
+                while lane.queued and len(batch) < limit and \
+                        now - lane.peek().enqueued >= promote_after:
+                    self._take_one(lane, batch, now)
+        for lane in self._lanes:
+            while lane.queued and len(batch) < limit:
+                self._take_one(lane, batch, now)
+        return batch
+
+    def _take_one(self, lane: _Lane, batch: typing.List[_Outgoing],
+            now: float):
+        ''' Move a lane's next message to the batch, unless its sender was
+        cancelled. '''
+        item = lane.pop()
+        if not item.cancelled:
+            lane.record_wait(now - item.enqueued)
+            batch.append(item)
+
+    async def run(self):
+        ''' The writer task. It runs until :meth:`close` is called. '''
+        policy = self.flush_policy
+        while True:
+            batch = self._take(policy.max_batch)
+            if not batch:
+                if self._closed:
+                    break
+                await self._wakeup.wait()
+                self._wakeup = trio.Event()
+                if policy.delay is not None:
+                    await trio.sleep(policy.delay)
+                continue
+            if self._closed:
+                error = ConnectionClosed(self._conn.transport.closed)
+                for item in batch:
+                    item.error = error
+            else:
+                await self._write(batch)
+            for item in batch:
+                item.done.set()
+
+    async def _write(self, batch: typing.List[_Outgoing]):
+        ''' Write a batch, recording any error on the messages that were not
+        sent. '''
+        transport = self._conn.transport
+        self.batches += 1
+        self.messages += len(batch)
+        send_messages = getattr(transport, 'send_messages', None)
+        if send_messages is not None and len(batch) > 1:
+            try:
+                await send_messages([item.message for item in batch])
+            except Exception as exc:
+                for item in batch:
+                    item.error = exc
+            return
+        for item in batch:
+            try:
+                await transport.send_message(item.message)
+            except Exception as exc:
+                item.error = exc